@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import io
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib import parse
+
+from crawler import Crawler
+from database import URLDatabase
+from extractor import ENGINES
+from main import Main
+from metrics import METRICS
+from sinks import ProductWriter
+
+# orders of the category pages of the fake shop
+SORTS = ('preco', 'nome', 'avaliacao', 'novidades', 'vendidos')
+
+# a clock of the cpu used by the current thread
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+class ShopSite:
+    def __init__(self, categories=10, products=50, per_page=20, filler=20000, seed=2018, sorts=()):
+        """
+        ShopSite creates the web pages of a fake shop, with category pages
+        split in pages, product pages ending in '/p' and the same navigation
+        links in every web page, as the real web site.
+        Each sort of the category pages lists the same products in another
+        order, so its web pages seldom have new products.
+
+        :param categories: amount of categories
+        :param products: amount of products in each category
+        :param per_page: amount of products listed in each category page
+        :param filler: bytes of text added to each web page
+        :param seed: seed of the random related products
+        :param sorts: names of the orders of the category pages
+
+        :type categories: int
+        :type products: int
+        :type per_page: int
+        :type filler: int
+        :type seed: int
+        :type sorts: tuple
+        """
+        self.categories = categories
+        self.sorts = tuple(sorts)
+        self.products = products
+        self.per_page = per_page
+        self.__filler = '<p>{}</p>'.format(('Lorem ipsum dolor sit amet. ' * (filler // 28 + 1))[:filler])
+        self.__seed = seed
+        nav = ['<a href="/categoria-{0}">Categoria {0}</a>'.format(category) for category in range(categories)]
+        nav += ['<a href="/institucional/sobre">Sobre</a>', '<a href="/checkout/#/cart">Carrinho</a>',
+                '<a href="mailto:sac@loja.com">SAC</a>', '<a href="#">Topo</a>']
+        self.__nav = '<nav>{}</nav>'.format(''.join(nav))
+
+    @property
+    def total_products(self):
+        """
+        Amount of product pages in the shop
+
+        :rtype: int
+        """
+        return self.categories * self.products
+
+    def __html(self, title, body):
+        return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>{}</title></head>'
+                '<body>{}{}{}</body></html>').format(title, self.__nav, body, self.__filler).encode('utf-8')
+
+    @staticmethod
+    def __product_href(category, product):
+        return '/categoria-{}/produto-{}/p'.format(category, product)
+
+    def __category(self, category, page, order=None):
+        pages = (self.products + self.per_page - 1) // self.per_page
+        first = (page - 1) * self.per_page
+        listed = list(range(self.products))
+        if order is not None:
+            # every sort shows the products in the inverse order
+            listed.reverse()
+        links = ['<a href="{}">Produto {}</a>'.format(self.__product_href(category, product), product)
+                 for product in listed[first:first + self.per_page]]
+        links += ['<a href="/categoria-{}?page={}&utm_source=menu">{}</a>'.format(category, number, number)
+                  for number in range(1, pages + 1)]
+        links += ['<a href="/categoria-{}?order={}&page={}">{}</a>'.format(category, sort, number, sort)
+                  for sort in self.sorts for number in range(1, pages + 1)]
+        return self.__html('Categoria {} - Página {}'.format(category, page),
+                           '<h2>Categoria {}</h2>{}'.format(category, ''.join(links)))
+
+    def __product(self, category, product):
+        generator = random.Random('{}-{}-{}'.format(self.__seed, category, product))
+        related = [generator.randrange(self.products) for _ in range(4)]
+        links = ['<a href="{}">Relacionado</a>'.format(self.__product_href(category, other)) for other in related]
+        body = '<a href="/categoria-{0}">Voltar</a><h1>Produto {0}-{1}</h1>{2}'.format(
+            category, product, ''.join(links))
+        return self.__html('Produto {}-{} | Loja'.format(category, product), body)
+
+    def __sitemap(self, root, item, locations):
+        """
+        Creates a sitemap file.
+
+        :param root: 'urlset' or 'sitemapindex'
+        :param item: 'url' or 'sitemap'
+        :param locations: the urls listed
+
+        :type root: str
+        :type item: str
+        :type locations: iterable
+
+        :rtype: bytes
+        """
+        items = ''.join('<{0}><loc>{1}</loc></{0}>'.format(item, location) for location in locations)
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<{0} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">{1}</{0}>').format(root, items).encode()
+
+    def file(self, path, main_url):
+        """
+        Gets the robots.txt or a sitemap of the shop.
+
+        :param path: the path of a url
+        :param main_url: the main url of the shop, used in the absolute urls
+
+        :type path: str
+        :type main_url: str
+
+        :return: the file content or None if the path is not a file
+        """
+        if path == '/robots.txt':
+            return 'User-agent: *\nDisallow: /checkout\nSitemap: {}/sitemap.xml\n'.format(main_url).encode()
+        if path == '/sitemap.xml':
+            return self.__sitemap('sitemapindex', 'sitemap', [main_url + '/sitemap-categorias.xml',
+                                                              main_url + '/sitemap-produtos.xml.gz'])
+        if path == '/sitemap-categorias.xml':
+            return self.__sitemap('urlset', 'url', ['{}/categoria-{}'.format(main_url, category)
+                                                    for category in range(self.categories)])
+        if path == '/sitemap-produtos.xml.gz':
+            return gzip.compress(self.__sitemap('urlset', 'url', (
+                main_url + self.__product_href(category, product)
+                for category in range(self.categories) for product in range(self.products))))
+        return None
+
+    def page(self, path):
+        """
+        Gets the web page of a path.
+
+        :param path: the path and query of a url
+
+        :type path: str
+
+        :return: the web page content or None if the path does not exist
+
+        :rtype: bytes
+        """
+        parts = parse.urlsplit(path)
+        segments = [segment for segment in parts.path.split('/') if segment]
+        query = dict(parse.parse_qsl(parts.query))
+        try:
+            if not segments:
+                return self.__html('Loja', '<h2>Ofertas</h2>' + ''.join(
+                    '<a href="{}">Oferta</a>'.format(self.__product_href(category, 0))
+                    for category in range(self.categories)))
+            if segments == ['institucional', 'sobre']:
+                return self.__html('Sobre', '<h2>Sobre a loja</h2>')
+            category = int(segments[0][len('categoria-'):]) if segments[0].startswith('categoria-') else -1
+            if not 0 <= category < self.categories:
+                return None
+            if len(segments) == 1:
+                page = int(query.get('page', 1))
+                pages = (self.products + self.per_page - 1) // self.per_page
+                order = query.get('order')
+                if order is not None and order not in self.sorts:
+                    return None
+                return self.__category(category, page, order) if 1 <= page <= pages else None
+            if len(segments) == 3 and segments[2] == 'p' and segments[1].startswith('produto-'):
+                product = int(segments[1][len('produto-'):])
+                return self.__product(category, product) if 0 <= product < self.products else None
+        except ValueError:
+            pass
+        return None
+
+
+class ShopHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the content are sent without waiting for the client ack
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        content = server.site.file(self.path, 'http://' + self.headers.get('Host', ''))
+        if content is None:
+            content = server.site.page(self.path)
+        with server.served.get_lock():
+            server.served.value += 1
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            content = gzip.compress(content, 6)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', etag)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class ShopServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, site, latency, served):
+        """
+        ShopServer serves a ShopSite in a local port, waiting some time
+        before each answer as a distant web site.
+
+        :param site: the web pages served
+        :param latency: seconds waited before each answer
+        :param served: shared counter of requests answered
+
+        :type site: ShopSite
+        :type latency: float
+        :type served: multiprocessing.Value
+        """
+        super().__init__(('127.0.0.1', 0), ShopHandler)
+        self.site = site
+        self.latency = latency
+        self.served = served
+
+
+def serve(site, latency, served, ports):
+    """
+    Runs a ShopServer until the process is stopped.
+    It runs in another process, so its cpu is not measured with the crawler.
+
+    :type site: ShopSite
+    :type latency: float
+    :type served: multiprocessing.Value
+    :type ports: multiprocessing.Queue
+    """
+    server = ShopServer(site, latency, served)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StageTimer:
+    # methods measured as each stage of the search
+    STAGES = [
+        ('fetch', Crawler, ['fetch']),
+        ('parse', Crawler, ['parse_page']),
+        ('database', URLDatabase, ['set_visited', 'claim', 'claim_batch', 'get_unvisited_url',
+                                   'get_unvisited_product', 'get_validators', 'insert_new_url']),
+        ('csv', ProductWriter, ['write', 'flush']),
+    ]
+
+    def __init__(self):
+        """
+        StageTimer adds the cpu time used by the methods of each stage of
+        the search, in every thread. The web pages processed by parser
+        processes are measured as the cpu of the child processes.
+        """
+        self.cpu = {stage: 0.0 for stage, _, _ in self.STAGES}
+        self.calls = {stage: 0 for stage, _, _ in self.STAGES}
+        self.__lock = threading.Lock()
+        self.__originals = []
+        # the time of a method called by another measured method is not counted twice
+        self.__local = threading.local()
+
+    def __wrap(self, stage, method):
+        def measured(*args, **kwargs):
+            if getattr(self.__local, 'inside', False):
+                return method(*args, **kwargs)
+            self.__local.inside = True
+            start = thread_time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                used = thread_time() - start
+                self.__local.inside = False
+                with self.__lock:
+                    self.cpu[stage] += used
+                    self.calls[stage] += 1
+        return measured
+
+    def __enter__(self):
+        for stage, owner, names in self.STAGES:
+            for name in names:
+                method = getattr(owner, name)
+                self.__originals.append((owner, name, method))
+                setattr(owner, name, self.__wrap(stage, method))
+        return self
+
+    def __exit__(self, *args):
+        for owner, name, method in reversed(self.__originals):
+            setattr(owner, name, method)
+        self.__originals = []
+
+
+class ProductCurve:
+    # counters of the web pages whose answer was saved in the database
+    PERSISTED = ('pages_visited', 'fetch_retries', 'urls_failed')
+
+    def __init__(self):
+        """
+        ProductCurve keeps how many web pages were saved in the database when
+        each new product was saved, so a search that finds the products with
+        fewer web pages can be compared with another. The web pages are
+        counted when they are saved, not when they are answered, so the web
+        pages downloaded ahead by the pipeline are not counted yet.
+        """
+        self.pages = []
+        self.__original = None
+
+    @classmethod
+    def persisted(cls):
+        """
+        Gets the amount of web pages saved in the database.
+
+        :rtype: int
+        """
+        counters = METRICS.snapshot()['counters']
+        return sum(counters.get(name, 0) for name in cls.PERSISTED)
+
+    def __enter__(self):
+        self.__original = original = ProductWriter.write
+        start = self.persisted()
+
+        def write(writer, page_values):
+            written = original(writer, page_values)
+            if written:
+                self.pages.append(self.persisted() - start)
+            return written
+        ProductWriter.write = write
+        return self
+
+    def __exit__(self, *args):
+        ProductWriter.write = self.__original
+
+
+def count_rows(csv_file_name):
+    """
+    Counts the products saved in a csv file.
+
+    :param csv_file_name: the csv file name
+
+    :type csv_file_name: str
+
+    :rtype: int
+    """
+    if not os.path.exists(csv_file_name):
+        return 0
+    with open(csv_file_name, encoding='utf-8') as csv_file:
+        return max(0, sum(1 for _ in csv_file) - 1)
+
+
+def run(main_url, mode, options, served):
+    """
+    Searches the whole fake shop with one mode and measures it.
+
+    :param main_url: the main url of the fake shop
+    :param mode: 'sync', 'async' or 'parallel'
+    :param options: the command line arguments
+    :param served: shared counter of requests answered
+
+    :type main_url: str
+    :type mode: str
+    :type options: argparse.Namespace
+    :type served: multiprocessing.Value
+
+    :return: dict with the measures of the search
+
+    :rtype: dict
+    """
+    params = {'domain': main_url, 'product_pattern': main_url + '%/p'}
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    current = os.getcwd()
+    os.chdir(directory)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    served.value = 0
+    try:
+        with StageTimer() as timer, ProductCurve() as curve, contextlib.redirect_stdout(io.StringIO()):
+            start, cpu_start = time.monotonic(), time.process_time()
+            main = Main(params, options.wal, options.seen_memory * 1024 * 1024, options.engine,
+                        parsers=options.parsers, quiet=True, sitemap=options.sitemap,
+                        sitemap_only=options.sitemap_only, compact=options.compact,
+                        compact_every=options.compact_every, skip_duplicates=options.skip_duplicates)
+            if mode == 'parallel':
+                main.search_for_products_parallel(options.workers)
+            elif mode == 'async':
+                main.search_for_products_async(options.concurrency, options.per_host)
+            else:
+                main.search_for_products(options.fetchers)
+            savings = main.duplicate_savings()
+            # the parser processes finish here, so their cpu can be measured
+            main.close()
+            elapsed, cpu = time.monotonic() - start, time.process_time() - cpu_start
+        children_cpu = (resource.getrusage(resource.RUSAGE_CHILDREN).ru_utime - children.ru_utime +
+                        resource.getrusage(resource.RUSAGE_CHILDREN).ru_stime - children.ru_stime)
+        products = count_rows(main.csv_file_name)
+    finally:
+        os.chdir(current)
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'mode': mode,
+        'seconds': elapsed,
+        'pages': served.value,
+        'products': products,
+        'pages/s': served.value / elapsed,
+        'products/s': products / elapsed,
+        # web pages read until the last product was found
+        'pages to all': curve.pages[-1] if curve.pages else 0,
+        'products/page': products / max(curve.pages[-1] if curve.pages else served.value, 1),
+        'pages to half': curve.pages[(len(curve.pages) - 1) // 2] if curve.pages else 0,
+        'skipped': savings['pages'],
+        'skipped MB': savings['bytes'] / 1024 / 1024,
+        'skipped s': savings['seconds'],
+        'cpu': cpu,
+        'stages': timer.cpu,
+        'parsers cpu': children_cpu,
+        # the peak of this process alone, as each mode runs in its own process, see run_apart
+        'peak rss MB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+
+def measure(results, main_url, mode, options, served):
+    """
+    Puts in a queue the measures of a search, or the error that stopped it.
+
+    :type results: multiprocessing.Queue
+    :type main_url: str
+    :type mode: str
+    :type options: argparse.Namespace
+    :type served: multiprocessing.Value
+    """
+    try:
+        results.put(run(main_url, mode, options, served))
+    except Exception as error:
+        results.put(error)
+
+
+def run_apart(main_url, mode, options, served):
+    """
+    Searches the whole fake shop with one mode in a new process, so the
+    peak memory of a mode does not include the peaks of the modes measured
+    before it.
+
+    :param main_url: the main url of the fake shop
+    :param mode: 'sync', 'async' or 'parallel'
+    :param options: the command line arguments
+    :param served: shared counter of requests answered
+
+    :type main_url: str
+    :type mode: str
+    :type options: argparse.Namespace
+    :type served: multiprocessing.Value
+
+    :return: dict with the measures of the search, see run
+
+    :rtype: dict
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(results, main_url, mode, options, served))
+    process.start()
+    result = results.get()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def report(result, expected):
+    """
+    Shows the measures of a search.
+
+    :param result: the measures returned by run
+    :param expected: amount of products in the fake shop
+
+    :type result: dict
+    :type expected: int
+    """
+    print('{mode:>8}: {seconds:7.2f} s  {pages:6d} pages  {pages/s:8.1f} pages/s  '
+          '{products:6d} products  {products/s:8.1f} products/s'.format(**result))
+    print('          {products/page:.3f} products/page  half of the products in {pages to half} pages  '
+          'all in {pages to all} pages'.format(**result))
+    if result['skipped']:
+        print('          {skipped} near duplicate pages skipped, about {skipped MB:.1f} MB and '
+              '{skipped s:.2f} s saved'.format(**result))
+    stages = '  '.join('{} {:.2f}s'.format(stage, cpu) for stage, cpu in result['stages'].items())
+    print('          cpu {:.2f}s ({}  parsers {:.2f}s)  peak rss {:.1f} MB'.format(
+        result['cpu'], stages, result['parsers cpu'], result['peak rss MB']))
+    if result['products'] != expected:
+        print('          {} of {} products found'.format(result['products'], expected))
+
+
+def parse_arguments():
+    """
+    Reads the command line arguments.
+
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Measures the search in a fake shop served locally.')
+    parser.add_argument('--modes', nargs='+', choices=['sync', 'async', 'parallel'], default=['sync', 'async'],
+                        help='search modes measured (default: sync async)')
+    parser.add_argument('--categories', type=int, default=10, help='categories of the shop (default: 10)')
+    parser.add_argument('--products', type=int, default=50,
+                        help='products in each category (default: 50)')
+    parser.add_argument('--filler', type=int, default=20000,
+                        help='bytes of text in each web page (default: 20000)')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds the server waits before each answer (default: 0.01)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='web pages downloaded at the same time in async mode (default: 16)')
+    parser.add_argument('--per-host', type=int, default=None,
+                        help='web pages downloaded at the same time from the same host in async mode')
+    parser.add_argument('--workers', type=int, default=4, help='workers in parallel mode (default: 4)')
+    parser.add_argument('--fetchers', type=int, default=1,
+                        help='threads that download the web pages in sync mode (default: 1)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='soup',
+                        help='how the web pages are processed (default: soup)')
+    parser.add_argument('--parsers', type=int, default=0,
+                        help='processes that process the web pages (default: 0)')
+    parser.add_argument('--wal', action='store_true', help='use the sqlite write ahead log journal')
+    parser.add_argument('--sitemap', action='store_true', help='insert the urls of the shop sitemaps first')
+    parser.add_argument('--sitemap-only', action='store_true',
+                        help='insert the urls of the shop sitemaps and follow only product urls')
+    parser.add_argument('--skip-duplicates', action='store_true',
+                        help='do not read the url patterns that give near duplicate web pages')
+    parser.add_argument('--compact', action='store_true', help='save the urls without their scheme and host')
+    parser.add_argument('--compact-every', type=int, default=0,
+                        help='keep only fingerprints of the visited web pages after each N (default: 0)')
+    parser.add_argument('--sorts', type=int, default=0,
+                        help='sorts of the category pages, with the same products (default: 0)')
+    parser.add_argument('--seen-memory', type=int, default=8,
+                        help='megabytes of the seen filter, 0 disables it (default: 8)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    shop = ShopSite(arguments.categories, arguments.products, filler=arguments.filler,
+                    sorts=SORTS[:arguments.sorts])
+    answered = multiprocessing.Value('i', 0)
+    queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve, args=(shop, arguments.latency, answered, queue),
+                                             daemon=True)
+    server_process.start()
+    url = 'http://127.0.0.1:{}'.format(queue.get(timeout=10))
+    print('Fake shop with {} products in {}'.format(shop.total_products, url))
+    try:
+        for search_mode in arguments.modes:
+            report(run_apart(url, search_mode, arguments, answered), shop.total_products)
+    finally:
+        server_process.terminate()
+        server_process.join()
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import re
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from urllib import parse
+
+
+# query parameters that only track where the visitor came from
+TRACKING_PARAMS = ('utm_*', 'gclid', 'gclsrc', 'dclid', 'fbclid', 'msclkid', 'mc_cid', 'mc_eid',
+                   '_ga', '_gl', 'yclid', 'igshid')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# characters that are not escaped in a path or in a query parameter, the
+# escapes already written are kept, so '%2B' is still not a '+'
+PATH_SAFE = "/%:@!$&'()*+,;=-._~"
+QUERY_SAFE = "%:@!$'()*+,;=/?-._~"
+
+ESCAPE = re.compile('%[0-9a-fA-F]{2}')
+
+
+def remove_dot_segments(path):
+    """
+    Removes the '.' and '..' segments of a url path, as in RFC 3986.
+
+    :param path: a url path
+
+    :type path: str
+
+    :rtype: str
+    """
+    if '.' not in path:
+        return path
+    segments = []
+    parts = path.split('/')
+    for part in parts:
+        if part == '..':
+            if len(segments) > 1:
+                segments.pop()
+        elif part != '.':
+            segments.append(part)
+    # a path ending in a dot segment is a directory
+    if parts[-1] in ('.', '..'):
+        segments.append('')
+    return '/'.join(segments)
+
+
+class URLCanonicalizer:
+    def __init__(self, main_url, strip_fragment=True, same_scheme=True, sort_query=True,
+                 drop_params=TRACKING_PARAMS, strip_trailing_slash=True, cache_size=100000):
+        """
+        URLCanonicalizer gives the same name to every way of writing the url
+        of a web page, so the same page is saved and visited only once.
+
+        :param main_url: the main page of the web site
+        :param strip_fragment: removes the '#fragment' of the urls
+        :param same_scheme: uses the scheme of the main url in every url of its host
+        :param sort_query: sorts the query parameters by name
+        :param drop_params: patterns of query parameters names that are removed
+        :param strip_trailing_slash: removes the '/' in the end of the path, but the root one
+        :param cache_size: amount of hrefs whose canonical url is kept in memory
+
+        :type main_url: str
+        :type strip_fragment: bool
+        :type same_scheme: bool
+        :type sort_query: bool
+        :type drop_params: tuple
+        :type strip_trailing_slash: bool
+        :type cache_size: int
+        """
+        self.__strip_fragment = strip_fragment
+        self.__same_scheme = same_scheme
+        self.__sort_query = sort_query
+        self.__drop_params = tuple(drop_params)
+        self.__strip_trailing_slash = strip_trailing_slash
+        # the main url rules must be known before normalizing it
+        self.__main_scheme = None
+        self.__main_host = None
+        main = parse.urlsplit(self.__normalize(main_url))
+        self.__main_scheme, self.__main_host = main.scheme, main.netloc
+        self.__cached = lru_cache(maxsize=cache_size)(self.__canonical)
+
+    @property
+    def main_host(self):
+        """
+        Host of the main url, without the default port
+
+        :rtype: str
+        """
+        return self.__main_host
+
+    def __dropped(self, name):
+        """
+        Checks if a query parameter must be removed.
+
+        :param name: the parameter name
+
+        :type name: str
+
+        :rtype: bool
+        """
+        return any(fnmatchcase(name.lower(), pattern) for pattern in self.__drop_params)
+
+    def __query(self, query):
+        """
+        Normalizes the query of a url. The parameters are kept as they were
+        written, only escaping the characters that can not be in a url, so
+        an escaped '+' or '&' and a parameter without '=' keep their meaning.
+
+        :param query: the query of a url
+
+        :type query: str
+
+        :rtype: str
+        """
+        if not query:
+            return ''
+        params = [param for param in query.split('&')
+                  if param and not self.__dropped(parse.unquote_plus(param.split('=', 1)[0]))]
+        params = [ESCAPE.sub(lambda escape: escape.group(0).upper(), parse.quote(param, QUERY_SAFE))
+                  for param in params]
+        if self.__sort_query:
+            # the sort is stable, so repeated names keep their order
+            params.sort(key=lambda param: param.split('=', 1)[0])
+        return '&'.join(params)
+
+    def __normalize(self, url):
+        """
+        Normalizes an absolute url.
+
+        :param url: an absolute url
+
+        :type url: str
+
+        :return: the canonical url or None if it is not a http url
+
+        :rtype: str
+        """
+        parts = parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in DEFAULT_PORTS or not parts.hostname:
+            return None
+        host = parts.hostname.rstrip('.')
+        try:
+            port = parts.port
+        except ValueError:
+            return None
+        netloc = host if port in (None, DEFAULT_PORTS[scheme]) else '{}:{}'.format(host, port)
+        if netloc == self.__main_host and self.__same_scheme:
+            scheme = self.__main_scheme
+        path = remove_dot_segments(parse.quote(parts.path, PATH_SAFE)) or '/'
+        if self.__strip_trailing_slash and len(path) > 1:
+            path = path.rstrip('/') or '/'
+        path = ESCAPE.sub(lambda escape: escape.group(0).upper(), path)
+        fragment = '' if self.__strip_fragment else parts.fragment
+        return parse.urlunsplit((scheme, netloc, path, self.__query(parts.query), fragment))
+
+    def __canonical(self, href, base):
+        """
+        Joins a href with the url of its web page and normalizes it.
+
+        :param href: a reference to a web page, absolute or relative
+
+        :type href: str
+
+        :param base: the url of the web page where the href was found
+
+        :type base: str
+
+        :rtype: str
+        """
+        return self.__normalize(parse.urljoin(base, href) if base else href)
+
+    def canonical(self, href, base=None):
+        """
+        Gets the canonical url of a href found in a web page.
+        The result of each href is kept in memory.
+
+        :param href: a reference to a web page, absolute or relative
+
+        :type href: str
+
+        :param base: the url of the web page where the href was found,
+        if it is None the main url is used
+
+        :type base: str
+
+        :return: the canonical url or None if it is not a http url
+
+        :rtype: str
+        """
+        href = href.strip()
+        if parse.urlsplit(href).scheme:
+            # an absolute href does not depend on the web page
+            base = None
+        elif base is None or href.startswith('/'):
+            # a href from the root only depends on the host of the web page
+            base_parts = parse.urlsplit(base) if base else None
+            if base_parts and base_parts.scheme:
+                base = '{}://{}/'.format(base_parts.scheme, base_parts.netloc)
+            else:
+                base = '{}://{}/'.format(self.__main_scheme, self.__main_host)
+        return self.__cached(href, base)
+
+    def same_site(self, url):
+        """
+        Checks if a canonical url belongs to the main url host.
+
+        :param url: a canonical url
+
+        :type url: str
+
+        :rtype: bool
+        """
+        return url is not None and parse.urlsplit(url).netloc == self.__main_host
@@ -3,10 +3,26 @@
 
 
 import csv
+import hashlib
+import http.client
+import re
 import time
-from urllib import request, parse
 from bs4 import BeautifulSoup
 
+from canonical import URLCanonicalizer
+from extractor import ENGINES, soup_page
+from httppool import HTTPPool
+from metrics import METRICS
+from simhash import simhash
+from sinks import ProductWriter
+
+
+# errors of a request that can succeed if it is sent again later
+TRANSIENT_ERRORS = (OSError, http.client.HTTPException)
+
+# statuses of a web page that can be read if it is asked again later
+TRANSIENT_STATUSES = {408, 425, 429}
+
 
 class PageValues:
     def __init__(self, product_name, title, url, csv_file_name):
@@ -53,6 +69,21 @@ class PageValues:
         """
         return self.__values['product_name']
 
+    @property
+    def values(self):
+        """
+        Returns a dictionary with the values saved in csv file
+        :rtype: dict
+        """
+        return dict(self.__values)
+
+    def show(self):
+        """
+        Displays on the screen the values of the product.
+        """
+        for key, value in self.__values.items():
+            print('{}: {}'.format(key, value), end='; ' if key != 'url' else '\n')
+
     def __is_csv(self):
         """
         Checks if the csv file already exists.
@@ -86,19 +117,64 @@ class PageValues:
             # creates the csv file if it did not exist.
             self.__create_csv()
         try:
-            with open(self.__csv_file_name, 'a', newline='', encoding='utf-8') as csv_file:
+            with METRICS.timer('csv_write'), open(self.__csv_file_name, 'a', newline='',
+                                                  encoding='utf-8') as csv_file:
                 writer = csv.DictWriter(csv_file, fieldnames=self.__csv_fields, delimiter=';')
                 writer.writerow(self.__values)
         except IOError:  # this exception avoid a product does not have saved in csv file
             time.sleep(0.5)
             self.save_csv()
         # display on the screen what is being record on csv
-        for key, value in self.__values.items():
-            print('{}: {}'.format(key, value), end='; ' if key != 'url' else '\n')
+        self.show()
+
+
+class Response:
+    def __init__(self, url, status, content=b'', etag=None, last_modified=None, final_url=None, error=None,
+                 transient=False):
+        """
+        Response keeps what the server answered when a web page was opened.
+
+        :param url: the url requested
+        :param status: the http status, 0 if it was not possible open the url
+        :param content: the web page content
+        :param etag: the ETag header of the web page
+        :param last_modified: the Last-Modified header of the web page
+        :param final_url: the url of the web page after the redirects
+        :param error: why the web page could not be read, None if it was read
+        :param transient: True if the error can go away if the web page is asked again later
+
+        :type url: str
+        :type status: int
+        :type content: bytes
+        :type etag: str
+        :type last_modified: str
+        :type final_url: str
+        :type error: str
+        :type transient: bool
+        """
+        self.url = url
+        self.status = status
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+        self.final_url = final_url if final_url else url
+        self.error = error
+        self.transient = transient
+
+    @property
+    def content_hash(self):
+        """
+        Hash of the web page content
+
+        :rtype: str
+        """
+        return hashlib.sha1(self.content).hexdigest()
 
 
 class Crawler:
-    def __init__(self, main_url, file_name):
+    def __init__(self, main_url, file_name, flush_rows=100, flush_interval=5.0, engine='soup',
+                 canonicalizer=None, page_cache=None, http_pool=None, scheduler=None,
+                 quiet=False, output='csv'):
         """
         Crawler is a class responsible to look for every links in a given main_url
         It is able to localize and distinguish if each link in a url page passed
@@ -107,16 +183,53 @@ class Crawler:
         :param main_url: must be the main page of a web site.
         :param file_name: is the file name where the products will have his
         parameters saves
+        :param flush_rows: amount of products kept in memory before writing them
+        :param flush_interval: maximum seconds between writes of products in the file
+        :param engine: how the web pages are processed, 'soup' builds the whole
+        tree of the page with BeautifulSoup and 'stream' only reads the links,
+        the title and the h1 from the html events
+        :param canonicalizer: gives the same name to every way of writing a url,
+        if it is None the default rules are used
+        :param page_cache: saves the web pages read, so a web page that did not
+        change can be processed again without downloading it
+        :param http_pool: keeps the connections with the web site open between
+        the web pages, if it is None a new one is used and closed with the crawler
+        :param scheduler: decides when a web page can be opened, following the
+        robots.txt and the speed of the web site, if it is None the web pages
+        are opened as soon as they are asked
+        :param quiet: if True, the products saved are not shown
+        :param output: the format of the products file, 'csv', 'jsonl' or 'parquet'
 
         :type main_url: str
         :type file_name: str
+        :type flush_rows: int
+        :type flush_interval: float
+        :type engine: str
+        :type canonicalizer: URLCanonicalizer
+        :type page_cache: PageCache
+        :type http_pool: HTTPPool
+        :type scheduler: PolitenessScheduler
+        :type quiet: bool
+        :type output: str
         """
+        if engine not in ENGINES:
+            raise ValueError('unknown engine {}, use one of {}'.format(engine, ', '.join(ENGINES)))
         self.main_url = main_url
         self.__csv_file_name = file_name
+        self.__writer = ProductWriter(file_name, flush_rows, flush_interval, output)
+        self.__extract = ENGINES[engine]
+        self.__canonicalizer = canonicalizer if canonicalizer else URLCanonicalizer(main_url)
+        self.__page_cache = page_cache
+        self.__http_pool = http_pool if http_pool else HTTPPool()
+        # a pool given by the caller can be shared, so it is closed by the caller
+        self.__own_http_pool = http_pool is None
+        self.__scheduler = scheduler
+        self.__quiet = quiet
 
     def __verify(self, href):
         """
-        Checks if a reference in a link belong to the same domain of main url
+        Checks if a reference in a link can be followed.
+        The domain is checked after the canonicalization of the link.
 
         :param href: is a reference to another web page in a 'a' tag.
 
@@ -124,72 +237,221 @@ class Crawler:
 
         :rtype: bool
         """
-        # change main url to avoid mistakes with http ou https
-        main = self.main_url.replace('https://', '').replace('http://', '')
         forbiden = {"#", 'None'}  # forbidden possible urls
         if (href is None) or (href in forbiden):
             return False
         for item in ['tel:', 'mailto:', 'javascript:']:
             if item in href:  # verify if is a link to telephone, e-mail or javascript
                 return False
-        if main in href and ("/checkout/cart/add" in href or "/checkout/#/cart" in href):
+        if "/checkout/cart/add" in href or "/checkout/#/cart" in href:
             return False  # prevents a purchase from being made
-        elif main in href or (main not in href and href[:4] != "http"):
-            return True  # possible case of a valid link
-        else:
-            return False  # any other link is not valid
+        return True  # possible case of a valid link
 
-    def __add_main_site(self, href):
+    def canonical(self, href, base=None):
         """
-        Check if the href has the main url in it
+        Gets the canonical url of a reference to a web page of the main url.
 
-        :param href: is a reference to another web page in a 'a' tag.
+        :param href: is a reference to another web page, absolute or relative
 
         :type href: str
+
+        :param base: is the url of the web page where the reference was found
+
+        :type base: str
+
+        :return: the canonical url or None if it is not a web page of the main url
+
+        :rtype: str
+        """
+        url = self.__canonicalizer.canonical(href, base)
+        return url if self.__canonicalizer.same_site(url) else None
+
+    def __open_page(self, url, headers=None):
         """
-        if self.main_url[8:] not in href:
-            return self.main_url + href
-        else:
-            return href
+        Opens a web page and reads all its content.
+
+        :param url: is a given url
+
+        :type url: str
+
+        :param headers: is a dict of headers sent with the request
+
+        :type headers: dict
+
+        :return: the answer of the server, it raises an exception if it was
+        not possible open the web page
 
-    def __open_page(self, url):
+        :rtype: PooledResponse
         """
-        Opens a web page and returns a bytearray.
+        def send():
+            # Opens the url with a connection kept alive
+            with METRICS.timer('fetch') as timer:
+                answer = self.__http_pool.request(url, headers)
+                timer.failed = answer.status >= 400
+            METRICS.count('bytes_downloaded', len(answer.content))
+            return answer
+
+        # the scheduler waits until the web site accepts one more request
+        page = self.__scheduler.run(url, send) if self.__scheduler else send()
+        # a not modified web page is not an error
+        if page.status >= 400:
+            print('HTTP Error {}: {}'.format(page.status, page.reason), url)
+        return page
+
+    def fetch(self, url, etag=None, last_modified=None):
+        """
+        Opens a web page and reads all its content.
+        If the validators of the last time the page was read are given,
+        the server can answer that the page did not change (status 304);
+        in this case the content is read from the page cache, if it is there.
+        This method blocks until the whole page is read, so it can be
+        executed in a worker thread by a concurrent fetcher.
 
         :param url: is a given url
 
         :type url: str
 
-        :return: a open web page
+        :param etag: is the ETag header received the last time
+
+        :type etag: str
+
+        :param last_modified: is the Last-Modified header received the last time
+
+        :type last_modified: str
 
-        :rtype: bytearray
+        :rtype: Response
         """
+        if self.__scheduler and not self.__scheduler.allowed(url):
+            print('The robots.txt does not allow to open', url)
+            return Response(url, 0, error='disallowed by robots.txt')
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
         try:
-            # Opens the url
-            page = request.urlopen(url)
+            page = self.__open_page(url, headers)
         except Exception as e:
             print(e, url)
-            return ''
-        else:
-            # Avoid that None will be returned to that, try to open the web page again.
-            return page if page is not None else self.__open_page(url)
+            # a timeout or a connection error can be tried again, a wrong url can not
+            return Response(url, 0, error='{}: {}'.format(type(e).__name__, e),
+                            transient=isinstance(e, TRANSIENT_ERRORS))
+        if page.status == 304:
+            content = self.__page_cache.get(url) if self.__page_cache else None
+            return Response(url, page.status, content or b'', etag, last_modified)
+        if page.status >= 300:
+            transient = page.status >= 500 or page.status in TRANSIENT_STATUSES
+            return Response(url, page.status, error='HTTP Error {}: {}'.format(page.status, page.reason),
+                            transient=transient)
+        if self.__page_cache:
+            self.__page_cache.put(url, page.content)
+        return Response(url, page.status, page.content, page.headers.get('ETag'),
+                        page.headers.get('Last-Modified'), page.url)
+
+    def download(self, url):
+        """
+        Opens a web page and reads all its content.
+
+        :param url: is a given url
+
+        :type url: str
+
+        :return: the web page content or an empty bytes if it was not possible read it
+
+        :rtype: bytes
+        """
+        return self.fetch(url).content
+
+    def open(self, url):
+        """
+        Opens a file of the web site without reading its content, so a big
+        file, as a sitemap, can be read while it is received.
 
-    def __url_list(self, page):
+        :param url: is a given url
+
+        :type url: str
+
+        :return: the answer of the server, that must be closed after it is
+        read, or None if it was not possible open the file
+
+        :rtype: StreamedResponse
+        """
+        if self.__scheduler and not self.__scheduler.allowed(url):
+            print('The robots.txt does not allow to open', url)
+            return None
+        try:
+            # the scheduler waits until the web site accepts one more request
+            answer = (self.__scheduler.run(url, lambda: self.__http_pool.open(url)) if self.__scheduler
+                      else self.__http_pool.open(url))
+        except Exception as e:
+            print(e, url)
+            return None
+        if answer.status != 200:
+            print('HTTP Error {}: {}'.format(answer.status, answer.reason), url)
+            answer.close()
+            return None
+        return answer
+
+    @property
+    def extract(self):
+        """
+        Function of the engine chosen that processes the content of a web
+        page. It can be sent to another process.
+
+        :rtype: callable
+        """
+        return self.__extract
+
+    def parse_page(self, content):
+        """
+        Processes the content of a downloaded web page with the engine
+        chosen, keeping only its links, title and h1.
+
+        :param content: is a web page content
+
+        :type content: bytes
+
+        :rtype: ParsedPage
+        """
+        with METRICS.timer('parse'):
+            return self.__extract(content)
+
+    @staticmethod
+    def __parsed(page):
+        """
+        Converts a web page processed by BeautifulSoup to ParsedPage,
+        so the methods that receive a page accept both of them.
+
+        :param page: a processed web page
+
+        :type page: ParsedPage or BeautifulSoup
+
+        :rtype: ParsedPage
+        """
+        return soup_page(page) if isinstance(page, BeautifulSoup) else page
+
+    def __url_list(self, page, base=None):
             """
             Finds all the links to the main url in a given page.
 
-            :param page: is a processed web page with BeautifulSoup class
+            :param page: is a processed web page
+
+            :type page: ParsedPage
 
-            :type page: BeautifulSoup
+            :param base: is the url of the page, used to join relative links
+
+            :type base: str
 
             :rtype: list
             """
-            url_list = []
-            for tag_a in page.find_all('a'):
-                href = str(tag_a.get('href'))
-                if self.__verify(href):
-                    url = parse.quote(self.__add_main_site(href), '/:#')
-                    url_list.append(url)
+            with METRICS.timer('url_list'):
+                url_list = []
+                for href in page.links:
+                    if self.__verify(href):
+                        url = self.canonical(href, base)
+                        if url:
+                            url_list.append(url)
+            METRICS.count('links_found', len(url_list))
             return url_list
 
     def get_links_list(self, url):
@@ -203,58 +465,110 @@ class Crawler:
         :rtype: list
         """
         page = self.get_page(url)
-        return self.__url_list(page)
+        return self.__url_list(page, url)
 
     def get_page(self, url):
         """
-        Opens a url and returns his processed page by BeautifulSoup.
+        Opens a url and returns his processed page.
 
         :param url: is a url to some page.
 
         :type url: str
 
-        :rtype: BeautifulSoup
+        :rtype: ParsedPage
         """
-        page = self.__open_page(url)
-        soup = BeautifulSoup(page, 'html.parser')
-        return soup
+        with METRICS.timer('get_page'):
+            return self.parse_page(self.download(url))
 
-    def get_product_urls(self, page):
+    def get_product_urls(self, page, url=None):
         """
-        Get all the url from a given BeautifulSoup object
+        Get all the url from a given processed web page
+
+        :param page: is a processed web page
 
-        :param page: is a processed web page by BeautifulSoup
+        :type page: ParsedPage or BeautifulSoup
 
-        :type page: BeautifulSoup
+        :param url: is the url of the page, used to join relative links
+
+        :type url: str
 
-        :return: a list of all urls of the main url
+        :return: a list of all canonical urls of the main url
 
         :rtype: list
         """
-        return self.__url_list(page)
+        return self.__url_list(self.__parsed(page), url)
+
+    def page_simhash(self, page, url_list):
+        """
+        Gets the SimHash of a processed web page from the links found in it
+        and the words of its title and h1, so the web pages that list the
+        same links, as the filters and sorts of a category, have near hashes.
+
+        :param page: is a processed web page
+
+        :type page: ParsedPage or BeautifulSoup
+
+        :param url_list: the canonical urls found in the web page
+
+        :type url_list: list
+
+        :rtype: int
+        """
+        page = self.__parsed(page)
+        text = '{} {}'.format(page.title or '', page.product_name or '').lower()
+        return simhash(list(url_list) + re.findall(r'\w+', text))
 
-    def save_data(self, soup, url):
+    def save_data(self, page, url):
         """
         Saves the data in a csv file usin PageValues class
 
-        :param soup: is a processed web page with BeautifulSoup class
+        :param page: is a processed web page
+
+        :type page: ParsedPage or BeautifulSoup
+
+        :param url: is a url of a product
+        """
+        with METRICS.timer('save_data') as timer:
+            timer.failed = not self.__save_data(self.__parsed(page), url)
+
+    def __save_data(self, page, url):
+        """
+        Saves the data of a product in the products file if the web page has a h1.
 
-        :type soup: BeautifulSoup
+        :param page: is a processed web page
+
+        :type page: ParsedPage
 
         :param url: is a url of a product
+
+        :type url: str
+
+        :return: True if the product was saved
+
+        :rtype: bool
         """
-        # get the web page title
-        title = soup.find('title').string
-        # get the h1 tag of the page
-        h1 = soup.find('h1')
         # checks if there is a h1 tag in the page
         # because is possible that a product url redirects to
         # another page.
         # In this way, only a valid product will be save.
-        if h1:
-            product_name = h1.contents[0].string
-            page_values = PageValues(product_name, title, url, self.__csv_file_name)
-            page_values.save_csv()
-        else:
-            # Shows the web page that have some problem.
-            print('It was not possible to open {}'.format(url))
+        if page.has_h1:
+            page_values = PageValues(page.product_name, page.title, url, self.__csv_file_name)
+            # a product already saved with the same values is not saved again
+            if self.__writer.write(page_values):
+                # display on the screen what is being record on csv
+                if not self.__quiet:
+                    page_values.show()
+                METRICS.count('products_saved')
+            return True
+        # Shows the web page that have some problem.
+        print('It was not possible to open {}'.format(url))
+        return False
+
+    def close(self):
+        """
+        Writes in the products file the products still in memory and closes it,
+        and closes the connections with the web site, if they are not shared.
+        """
+        self.__writer.close()
+        if self.__own_http_pool:
+            self.__http_pool.close()
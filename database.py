@@ -2,21 +2,160 @@
 # author: Thiago da Cunha Borges
 
 
+import hashlib
+import math
+import random
+import re
 import sqlite3
 import time
+from urllib import parse
+
+from metrics import METRICS
+
+
+# states of a url saved in the visited column of the links table
+PENDING = 0
+VISITED = 1
+IN_FLIGHT = 2
+WAITING = 3
+FAILED = 4
+# visited urls kept only by their fingerprint, counted in the link_stats table
+COMPACTED = 5
+# urls not read because their url pattern gives near duplicate web pages
+SKIPPED = 6
+
+# seconds that a worker can hold a url before it returns to pending
+LEASE_TIME = 300.0
+
+# columns added to the links table after the first version, in the order
+# they were created, so older database files can receive them
+COLUMNS = [('worker', 'TEXT'), ('lease_expiry', 'REAL'), ('kind', 'INTEGER DEFAULT 0'),
+           ('etag', 'TEXT'), ('last_modified', 'TEXT'), ('content_hash', 'TEXT'),
+           ('first_fetched', 'REAL'), ('last_fetched', 'REAL'), ('last_changed', 'REAL'),
+           ('fetches', 'INTEGER DEFAULT 0'), ('changes', 'INTEGER DEFAULT 0'),
+           ('failures', 'INTEGER DEFAULT 0'), ('last_error', 'TEXT'), ('next_attempt', 'REAL'),
+           ('depth', 'INTEGER DEFAULT 0'), ('score', 'REAL DEFAULT 0'), ('simhash', 'INTEGER'),
+           ('pattern', 'INTEGER')]
+
+# columns of the pattern_stats table added after its first version
+PATTERN_COLUMNS = [('duplicates', 'INTEGER NOT NULL DEFAULT 0')]
+
+# weights of the score of a url: the links of a web page that had new
+# products and of a url pattern whose web pages had products come first,
+# and the urls far from the main page come last
+YIELD_WEIGHT = 1.0
+PATTERN_WEIGHT = 1.0
+DEPTH_WEIGHT = 0.5
+
+# maximum of values in a sql statement
+MAX_VARIABLES = 500
+
+# a url pattern gives near duplicates when at least MIN_DUPLICATES of its
+# web pages, and DUPLICATE_RATE of them, were near duplicates without new
+# products; its other urls lose DUPLICATE_WEIGHT of their score
+MIN_DUPLICATES = 3
+DUPLICATE_RATE = 0.8
+DUPLICATE_WEIGHT = 10.0
+
+# seconds between two reads of a web page whose change rate is still unknown
+REFRESH_PRIOR = 24 * 60 * 60.0
+
+# estimated seconds between two changes of a web page: the time it has been
+# read divided by the changes seen, kept between a minimum and a maximum
+REFRESH_INTERVAL = ('MAX(:minimum, MIN(:maximum, '
+                    '(last_fetched - first_fetched + :prior) / (changes + 0.5)))')
+
+# attempts of a url with transient errors before it is failed
+MAX_RETRIES = 5
+
+# seconds waited before the first new attempt of a url, doubled after each failure
+RETRY_DELAY = 10.0
+
+# maximum of seconds waited before a new attempt of a url
+MAX_RETRY_DELAY = 3600.0
+
+# returns to pending the urls held by a worker after its lease expired
+RELEASE_EXPIRED_LEASES = ('UPDATE links SET visited = 0, worker = NULL, lease_expiry = NULL '
+                          'WHERE visited = 2 AND lease_expiry < ?;')
+
+# returns to pending the urls whose time to be tried again arrived
+RELEASE_DUE_RETRIES = 'UPDATE links SET visited = 0 WHERE visited = 3 AND next_attempt <= ?;'
+
+# the scheme and host of a url, and the rest of it
+ORIGIN_REGEX = re.compile(r'([a-z][a-z0-9+.-]*://[^/?#]*)(.*)\Z', re.IGNORECASE | re.DOTALL)
+
+# a compact key: the id of the host of the url and the rest of it
+KEY_REGEX = re.compile(r'(\d+)(.*)\Z', re.DOTALL)
+
+
+def fingerprint(key):
+    """
+    Gets a 64 bits hash of a key of the links table, saved as a sqlite integer.
+
+    :param key: a url or a compact key
+
+    :type key: str
+
+    :rtype: int
+    """
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+
+def url_pattern(url):
+    """
+    Gets the pattern of a url: the first directory of its path, the amount
+    of other directories and the names of its query parameters, so the
+    pages of a category, of its filters or of the institutional section
+    share their pattern.
+
+    :param url: a url
+
+    :type url: str
+
+    :rtype: str
+    """
+    parts = parse.urlsplit(url)
+    directories = [directory for directory in parts.path.split('/') if directory]
+    pattern = '/' + re.sub(r'\d+', '#', directories[0]) if directories else '/'
+    pattern += '/*' * (len(directories) - 1)
+    names = sorted({name for name, _ in parse.parse_qsl(parts.query, keep_blank_values=True)})
+    return pattern + ('?' + '&'.join(names) if names else '')
+
+
+def like_to_regex(pattern):
+    """
+    Converts a sql LIKE pattern to a regular expression that matches the
+    same strings as sqlite does: '%' is any sequence, '_' is any character
+    and the case of ascii letters is ignored.
+
+    :param pattern: a sql LIKE pattern
+
+    :type pattern: str
+
+    :rtype: re.Pattern
+    """
+    translation = {'%': '.*', '_': '.'}
+    regex = ''.join(translation.get(char, re.escape(char)) for char in pattern)
+    return re.compile(regex + r'\Z', re.IGNORECASE | re.ASCII | re.DOTALL)
 
 
 class Connect:
-    def __init__(self, db_name):
+    def __init__(self, db_name, timeout=30.0, wal=False):
         """
         Class connect represents the database connection.
         It opens a connection with a database file.
 
         :param db_name: name of the database file.
+        :param timeout: seconds waiting for a database locked by another connection.
+        :param wal: if True, uses the write ahead log journal with synchronous NORMAL,
+        so a commit does not wait for the disk and readers do not block the writer.
         """
         try:
             # Connects with the database
-            self.conn = sqlite3.connect(db_name)
+            self.conn = sqlite3.connect(db_name, timeout=timeout)
+            if wal:
+                self.conn.execute('PRAGMA journal_mode=WAL;')
+                self.conn.execute('PRAGMA synchronous=NORMAL;')
         except sqlite3.Error as e:
             print('Error. It was not possible open database: {}'.format(e))
             exit(1)
@@ -32,6 +171,14 @@ class Connect:
         if self.conn:
             self.conn.commit()
 
+    def rollback_db(self):
+        """
+        Discards the changes of the current transaction.
+        """
+        # Check if the connection with database is active
+        if self.conn:
+            self.conn.rollback()
+
     def close_db(self):
         """
         Closes the connection with the database.
@@ -42,7 +189,8 @@ class Connect:
 
 
 class URLDatabase:
-    def __init__(self, db_name, product_pattern):
+    def __init__(self, db_name, product_pattern, wal=False, seen_filter=None, router=None, compact=False,
+                 near_duplicates=None, skip_duplicates=False):
         """
         Class that manager the links table of a sqlite database.
         This class will allow to insert one or a list of given urls,
@@ -57,10 +205,56 @@ class URLDatabase:
         this links.
 
         :type product_pattern: str
+
+        :param wal: if True, the database uses the write ahead log journal
+
+        :type wal: bool
+
+        :param seen_filter: filter of the urls already in the database, it can
+        be shared by many connections with the same database file
+
+        :type seen_filter: SeenFilter
+
+        :param router: sends the urls of other shards to their nodes, so only
+        the urls of the shard of this node are inserted, None inserts every url
+
+        :type router: ShardRouter
+
+        :param compact: if True, a new database saves each url as the id of
+        its host, kept in the hosts table, and the rest of the url, in a
+        table without rowid. A database already created keeps its layout.
+
+        :type compact: bool
+
+        :param near_duplicates: the SimHashes of the last web pages read, it
+        can be shared by many connections, None does not look for near
+        duplicate web pages
+
+        :type near_duplicates: NearDuplicateIndex
+
+        :param skip_duplicates: if True, the urls of a url pattern that gives
+        near duplicate web pages are not read, if False they are read last
+
+        :type skip_duplicates: bool
         """
-        self.connection = Connect(db_name)
+        self.connection = Connect(db_name, wal=wal)
+        self.__near_duplicates = near_duplicates
+        self.__skip_duplicates = skip_duplicates
+        self.__seen_filter = seen_filter
+        self.__router = router
         self.cursor = self.connection.cursor
         self.product_pattern = product_pattern
+        # the product pattern is a sql LIKE pattern, the same test is done
+        # in python to classify a url once when it is inserted
+        self.__product_regex = like_to_regex(product_pattern)
+        # the layout of a database file is decided when it is created
+        tables = {line[0] for line in self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+        self.__compact = 'hosts' in tables if 'links' in tables else compact
+        # the ids of the hosts of a compact database, in both directions
+        self.__host_ids = {}
+        self.__origins = {}
+        # the ids of the url patterns, saved in the patterns table
+        self.__pattern_ids = {}
 
     def create_schema(self):
         """
@@ -73,17 +267,293 @@ class URLDatabase:
 
         The visited column is set to default 0 when a url is inserted and
         set to 1, so it will be possible to know if a given url has already
-        been visited or not.
+        been visited or not. While a worker is processing a url the visited
+        column is set to 2 and the worker and lease_expiry columns tell who
+        claimed the url and until when.
+
+        The etag, last_modified and content_hash columns keep how the web page
+        was the last time it was read, so it is possible to ask the server
+        if it changed.
+        The first_fetched, last_fetched and last_changed columns, with the
+        amount of fetches and of changes seen, estimate how often the web page
+        changes, so it is read again only when it is probably changed.
+
+        A url whose web page could not be read by a transient error (a
+        timeout, a connection error or a 5xx status) waits in the visited
+        state 3 until its next_attempt time, with the amount of failures and
+        the last_error. After too many failures it is kept failed in the
+        visited state 4, so it is never lost and can be tried again later.
+
+        The kind column is set to 1 for product urls and 0 for the others
+        when a url is inserted, and an index on the state, kind and score of
+        the urls allows taking the best unvisited urls without reading the
+        whole table.
+        The depth column is how many links the url is from the main page.
+        The score column is given when the url is inserted: it is higher
+        for the links of a web page that had many new products and for the
+        url patterns whose web pages had many products, kept in the
+        pattern_stats table, and lower for deep urls. The unvisited urls
+        with the highest scores are read first.
+
+        A compact database saves in the url column the id of the host of the
+        url, kept in the hosts table, followed by the rest of the url, so the
+        scheme and host repeated in every url are saved once. Its links table
+        has no rowid, so the urls are saved only once, in the b-tree of the
+        primary key, instead of in the table and in the index of the key.
+
+        The simhash column keeps a hash of the links and words of the web
+        page read. A web page near to another one read before, that had no
+        new product, is counted as a duplicate of its url pattern in the
+        pattern_stats table. When most web pages of a pattern are duplicates,
+        its other urls are read last or, if they are skipped, kept in the
+        visited state 6. The pattern column keeps the id of the url pattern
+        of the urls that are not products, saved in the patterns table, and
+        an index of the unvisited urls by their pattern changes the urls of
+        a pattern without reading the whole table.
+
+        The visited urls that are not products can be compacted: they are
+        removed from the links table and only a 64 bits fingerprint of each
+        one is kept in the visited_fingerprints table, so they are not
+        inserted again. They are counted in the link_stats table with the
+        visited state 5.
+
+        The link_stats table keeps the amount of urls of each kind and state.
+        It is updated by triggers in the same transaction that changes the
+        links table and it is counted again once when the schema is created,
+        so the amounts are read without counting the links table.
         """
         schema = ('CREATE TABLE IF NOT EXISTS links (\n'
                   '    url TEXT NOT NULL PRIMARY KEY,'
-                  '    visited INTEGER DEFAULT 0);')
+                  '    visited INTEGER DEFAULT 0,'
+                  '    {}){};'.format(', '.join('{} {}'.format(*column) for column in COLUMNS),
+                                  ' WITHOUT ROWID' if self.__compact else ''))
+        index = 'CREATE INDEX IF NOT EXISTS links_frontier ON links (visited, kind, score, url);'
+        patterns = ('CREATE TABLE IF NOT EXISTS pattern_stats (\n'
+                    '    pattern TEXT NOT NULL PRIMARY KEY,'
+                    '    pages INTEGER NOT NULL DEFAULT 0,'
+                    '    products INTEGER NOT NULL DEFAULT 0,'
+                    '    duplicates INTEGER NOT NULL DEFAULT 0);')
+        fingerprints = 'CREATE TABLE IF NOT EXISTS visited_fingerprints (fingerprint INTEGER NOT NULL PRIMARY KEY);'
+        pattern_index = ('CREATE INDEX IF NOT EXISTS links_pattern ON links (pattern) '
+                         'WHERE visited = 0 AND kind = 0;')
         try:
             self.cursor.execute(schema)
+            self.cursor.execute(patterns)
+            self.cursor.execute(fingerprints)
+            self.cursor.execute('CREATE TABLE IF NOT EXISTS patterns (\n'
+                                '    id INTEGER PRIMARY KEY,'
+                                '    pattern TEXT NOT NULL UNIQUE);')
+            if self.__compact:
+                self.cursor.execute('CREATE TABLE IF NOT EXISTS hosts (\n'
+                                    '    id INTEGER PRIMARY KEY,'
+                                    '    origin TEXT NOT NULL UNIQUE);')
+            added = self.__add_missing_columns(COLUMNS)
+            self.__add_missing_columns(PATTERN_COLUMNS, 'pattern_stats')
+            if 'kind' in added:
+                # classifies the urls saved before the kind column exists
+                self.cursor.execute('UPDATE links SET kind = 1 WHERE url LIKE ?;', (self.product_pattern, ))
+            # the index of the score replaces the index of the first versions
+            self.cursor.execute('DROP INDEX IF EXISTS links_state_kind;')
+            self.cursor.execute(index)
+            self.cursor.execute(pattern_index)
+            self.__create_stats()
+            self.connection.commit_db()
+            if 'pattern' in added:
+                # the urls saved before the pattern column exists
+                self.__fill_patterns()
+            if self.__seen_filter is not None:
+                self.__load_seen_filter()
+            if self.__near_duplicates is not None:
+                # the web pages read last by a resumed search
+                query = ('SELECT simhash FROM (SELECT simhash, last_fetched FROM links WHERE simhash IS NOT NULL '
+                         'ORDER BY last_fetched DESC LIMIT ?) ORDER BY last_fetched;')
+                self.__near_duplicates.load(line[0] for line in self.cursor.execute(
+                    query, (self.__near_duplicates.capacity, )))
         except sqlite3.Error as e:
             print('It was not possible create a table in the data base:\n{}'.format(e))
             exit(1)
 
+    def __fill_patterns(self):
+        """
+        Saves the url pattern of the urls that are not products of a
+        database created before the pattern column exists.
+        """
+        keys = [line[0] for line in self.cursor.execute('SELECT url FROM links WHERE kind = 0;').fetchall()]
+        values = [(self.__pattern_id(url_pattern(self.__url(key))), key) for key in keys]
+        self.__write_many([('UPDATE links SET pattern = ? WHERE url = ?;', values)])
+
+    def __load_seen_filter(self):
+        """
+        Rebuilds the seen filter from the urls in the database, so a resumed
+        search does not go to the database to know the urls found before.
+        The first urls found start in the LRU because they are the links of
+        the first web page, repeated in every page of the site.
+        """
+        # a compact table has no rowid, the urls nearest to the main page come first
+        order = 'depth' if self.__compact else 'rowid'
+        all_urls = (self.__url(line[0]) for line in self.connection.conn.execute('SELECT url FROM links;'))
+        first_urls = (self.__url(line[0]) for line in self.connection.conn.execute(
+            'SELECT url FROM links ORDER BY {} LIMIT ?;'.format(order), (self.__seen_filter.capacity, )))
+        self.__seen_filter.load(all_urls, first_urls)
+
+    def __create_stats(self):
+        """
+        Creates the link_stats table with the triggers that keep it updated
+        and counts the urls of each kind and state again.
+        """
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS link_stats (\n'
+                            '    kind INTEGER NOT NULL,'
+                            '    visited INTEGER NOT NULL,'
+                            '    amount INTEGER NOT NULL DEFAULT 0,'
+                            '    PRIMARY KEY (kind, visited));')
+        self.cursor.execute('CREATE TRIGGER IF NOT EXISTS link_stats_insert AFTER INSERT ON links BEGIN\n'
+                            '    INSERT OR IGNORE INTO link_stats (kind, visited) VALUES (NEW.kind, NEW.visited);'
+                            '    UPDATE link_stats SET amount = amount + 1'
+                            '    WHERE kind = NEW.kind AND visited = NEW.visited;'
+                            'END;')
+        self.cursor.execute('CREATE TRIGGER IF NOT EXISTS link_stats_update AFTER UPDATE OF visited, kind ON links\n'
+                            'WHEN OLD.visited IS NOT NEW.visited OR OLD.kind IS NOT NEW.kind BEGIN\n'
+                            '    UPDATE link_stats SET amount = amount - 1'
+                            '    WHERE kind = OLD.kind AND visited = OLD.visited;'
+                            '    INSERT OR IGNORE INTO link_stats (kind, visited) VALUES (NEW.kind, NEW.visited);'
+                            '    UPDATE link_stats SET amount = amount + 1'
+                            '    WHERE kind = NEW.kind AND visited = NEW.visited;'
+                            'END;')
+        self.cursor.execute('CREATE TRIGGER IF NOT EXISTS link_stats_delete AFTER DELETE ON links BEGIN\n'
+                            '    UPDATE link_stats SET amount = amount - 1'
+                            '    WHERE kind = OLD.kind AND visited = OLD.visited;'
+                            'END;')
+        # counts again the urls, so the amounts are right even if the
+        # database was changed by an older version of the program
+        self.cursor.execute('DELETE FROM link_stats;')
+        self.cursor.execute('INSERT INTO link_stats (kind, visited, amount) '
+                            'SELECT kind, visited, COUNT(*) FROM links GROUP BY kind, visited;')
+        self.cursor.execute('INSERT INTO link_stats (kind, visited, amount) '
+                            'SELECT 0, ?, COUNT(*) FROM visited_fingerprints;', (COMPACTED, ))
+
+    def __add_missing_columns(self, columns, table='links'):
+        """
+        Adds to a table the columns that a database file created by an
+        older version of the program does not have.
+
+        :param columns: list of tuples with a column name and its definition
+
+        :type columns: list
+
+        :param table: the table name
+
+        :type table: str
+
+        :return: the names of the added columns
+
+        :rtype: list
+        """
+        existing = {line[1] for line in self.cursor.execute('PRAGMA table_info({});'.format(table))}
+        added = []
+        for name, definition in columns:
+            if name not in existing:
+                self.cursor.execute('ALTER TABLE {} ADD COLUMN {} {};'.format(table, name, definition))
+                added.append(name)
+        return added
+
+    def is_product(self, url):
+        """
+        Check if a url matches the product pattern.
+
+        :param url: a url
+
+        :type url: str
+
+        :rtype: bool
+        """
+        return self.__product_regex.match(url) is not None
+
+    @property
+    def compact(self):
+        """
+        If True, the urls are saved as the id of their host and the rest of the url
+
+        :rtype: bool
+        """
+        return self.__compact
+
+    def __host_id(self, origin):
+        """
+        Gets the id of the scheme and host of a url, saving it the first time.
+
+        :param origin: the scheme and host, as 'https://www.site.com'
+
+        :type origin: str
+
+        :rtype: int
+        """
+        if origin not in self.__host_ids:
+            # another connection can save the same host at the same time
+            self.__write_database('INSERT OR IGNORE INTO hosts (origin) VALUES (?);', (origin, ))
+            host_id = self.__fetchone('SELECT id FROM hosts WHERE origin = ?;', (origin, ))
+            self.__host_ids[origin] = host_id
+            self.__origins[host_id] = origin
+        return self.__host_ids[origin]
+
+    def __pattern_id(self, pattern):
+        """
+        Gets the id of a url pattern, saving it the first time.
+
+        :param pattern: a url pattern, see url_pattern
+
+        :type pattern: str
+
+        :rtype: int
+        """
+        if pattern not in self.__pattern_ids:
+            # another connection can save the same pattern at the same time
+            self.__write_database('INSERT OR IGNORE INTO patterns (pattern) VALUES (?);', (pattern, ))
+            self.__pattern_ids[pattern] = self.__fetchone('SELECT id FROM patterns WHERE pattern = ?;', (pattern, ))
+        return self.__pattern_ids[pattern]
+
+    def __key(self, url):
+        """
+        Gets the value saved in the url column for a url.
+
+        :param url: a url
+
+        :type url: str
+
+        :return: the url or, in a compact database, its host id and the rest of it
+
+        :rtype: str
+        """
+        if not self.__compact:
+            return url
+        match = ORIGIN_REGEX.match(url)
+        if match is None:
+            # a url without host is saved as it is
+            return url
+        return '{}{}'.format(self.__host_id(match.group(1).lower()), match.group(2))
+
+    def __url(self, key):
+        """
+        Gets the url of a value saved in the url column.
+
+        :param key: a value of the url column
+
+        :type key: str
+
+        :rtype: str
+        """
+        if not self.__compact:
+            return key
+        match = KEY_REGEX.match(key)
+        if match is None:
+            return key
+        host_id = int(match.group(1))
+        if host_id not in self.__origins:
+            # the host was saved by another connection
+            origin = self.__fetchone('SELECT origin FROM hosts WHERE id = ?;', (host_id, ))
+            self.__host_ids[origin] = host_id
+            self.__origins[host_id] = origin
+        return self.__origins[host_id] + match.group(2)
+
     def close(self):
         """
         Close the conection with the database file.
@@ -108,7 +578,8 @@ class URLDatabase:
         :rtype: sqlite3.Cursor
         """
         try:
-            answer = self.cursor.execute(query, values)
+            with METRICS.timer('db_read'):
+                answer = self.cursor.execute(query, values)
         except sqlite3.Error as e:
             print(e)
             time.sleep(0.5)
@@ -144,27 +615,11 @@ class URLDatabase:
         :return: the total of urls in the database
         :rtype: int
         """
-        query = 'SELECT COUNT(*) FROM links'
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats'
         result = self.__fetchone(query, ())
         # check if result is different of None, if is, does again the same query
         return result if result is not None else self.total()
 
-    def __is_new(self, url):
-        """
-        Check if there is a given url in the database.
-
-        :param url: a url that will be conferred if is in the database
-
-        :type url: str
-
-        :return: True if there is not this url in the database and False if do not exist
-
-        :rtype: bool
-        """
-        query = 'SELECT COUNT(*) FROM links WHERE url = ?;'
-        result = self.__fetchone(query, (url, ))
-        return True if result == 0 else False
-
     def get_unvisited_url(self):
         """
         Get a unvisited url from the database
@@ -173,9 +628,9 @@ class URLDatabase:
 
         :rtype: str
         """
-        query = 'SELECT url FROM links WHERE visited = 0 LIMIT 1;'
+        query = 'SELECT url FROM links WHERE visited = 0 ORDER BY kind DESC, score DESC LIMIT 1;'
         result = self.__fetchone(query, ())
-        return result if result else self.get_unvisited_url()
+        return self.__url(result) if result else self.get_unvisited_url()
 
     def get_unvisited_product(self):
         """
@@ -185,10 +640,34 @@ class URLDatabase:
 
         :rtype: str
         """
-        query = 'SELECT url FROM links WHERE visited = 0 AND url like ? LIMIT 1;'
-        result = self.__fetchone(query, (self.product_pattern, ))
+        query = 'SELECT url FROM links WHERE visited = 0 AND kind = 1 ORDER BY score DESC LIMIT 1;'
+        result = self.__fetchone(query, ())
         # check if result is different of None, if is, does again the same query
-        return result if result else self.get_unvisited_product()
+        return self.__url(result) if result else self.get_unvisited_product()
+
+    def get_unvisited_urls(self, amount, product=False):
+        """
+        Get a list of unvisited urls from the database.
+
+        :param amount: maximum of urls returned
+
+        :type amount: int
+
+        :param product: if True, only product urls will be returned
+
+        :type product: bool
+
+        :return: a list of unvisited urls
+
+        :rtype: list
+        """
+        if product:
+            query = 'SELECT url FROM links WHERE visited = 0 AND kind = 1 ORDER BY score DESC LIMIT ?;'
+            values = (amount, )
+        else:
+            query = 'SELECT url FROM links WHERE visited = 0 ORDER BY kind DESC, score DESC LIMIT ?;'
+            values = (amount, )
+        return [self.__url(line[0]) for line in self.__read_database(query, values).fetchall()]
 
     def unvisited(self):
         """
@@ -198,7 +677,7 @@ class URLDatabase:
 
         :rtype: int
         """
-        query = 'SELECT COUNT(*) FROM links WHERE visited = 0'
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats WHERE visited = 0'
         result = self.__fetchone(query, ())
         # check if result is different of None, if is, does again the same query
         return result if result is not None else self.unvisited()
@@ -211,8 +690,8 @@ class URLDatabase:
 
         :rtype: int
         """
-        query = 'SELECT COUNT(*) FROM links WHERE visited = 0 AND url LIKE ?'
-        result = self.__fetchone(query, (self.product_pattern, ))
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats WHERE visited = 0 AND kind = 1'
+        result = self.__fetchone(query, ())
         # check if result is different of None, if is, does again the same query
         return result if result is not None else self.unvisited_product()
 
@@ -244,8 +723,8 @@ class URLDatabase:
 
         :rtype: int
         """
-        query = 'SELECT COUNT(*) FROM links WHERE url LIKE ?'
-        result = self.__fetchone(query, (self.product_pattern, ))
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats WHERE kind = 1'
+        result = self.__fetchone(query, ())
         # check if result is different of None, if is, does again the same query
         return result if result is not None else self.total_products()
 
@@ -262,8 +741,9 @@ class URLDatabase:
         :type values: tuple
         """
         try:
-            self.cursor.execute(statement, values)
-            self.connection.commit_db()
+            with METRICS.timer('db_write'):
+                self.cursor.execute(statement, values)
+                self.connection.commit_db()
         except sqlite3.Error as e:
             print('Error writing in the database.')
             print(e)
@@ -273,6 +753,281 @@ class URLDatabase:
                 time.sleep(0.5)
                 self.__write_database(statement, values)
 
+    def __write_many(self, statements):
+        """
+        Does many writes in the database in only one transaction.
+
+        :param statements: list of tuples with a statement and a list of
+        values tuples to that statement
+
+        :type statements: list
+
+        :return: True if the transaction was saved
+
+        :rtype: bool
+        """
+        try:
+            with METRICS.timer('db_write'):
+                for statement, values in statements:
+                    self.cursor.executemany(statement, values)
+                self.connection.commit_db()
+        except sqlite3.Error as e:
+            self.connection.rollback_db()
+            print('Error writing in the database.')
+            print(e)
+            # if the database is locked, wait 0.5 seconds and try
+            # to write again in the database
+            if str(e) == 'database is locked':
+                time.sleep(0.5)
+                return self.__write_many(statements)
+            return False
+        return True
+
+    def __unknown_urls(self, url_list):
+        """
+        Removes the repeated urls of a list and the ones that the seen filter
+        knows that are in the database.
+
+        :param url_list: list of urls
+
+        :type url_list: list
+
+        :return: the urls that must be inserted
+
+        :rtype: list
+        """
+        # dict.fromkeys removes the repeated urls keeping their order
+        url_list = list(dict.fromkeys(url_list))
+        if self.__seen_filter is None:
+            return url_list
+        return self.__seen_filter.unknown(url_list)
+
+    def __pattern_stats(self, patterns):
+        """
+        Reads the statistics of url patterns. They are read again for each
+        web page, in the transaction that changes them, so the web pages
+        read by the other connections are counted.
+
+        :param patterns: the url patterns, see url_pattern
+
+        :type patterns: set
+
+        :return: dict of each pattern mapped to a tuple with the web pages
+        read, the new products found and the near duplicate web pages
+
+        :rtype: dict
+        """
+        stats = dict.fromkeys(patterns, (0, 0, 0))
+        patterns = list(patterns)
+        for start in range(0, len(patterns), MAX_VARIABLES):
+            chunk = patterns[start:start + MAX_VARIABLES]
+            query = 'SELECT pattern, pages, products, duplicates FROM pattern_stats WHERE pattern IN ({});'.format(
+                ', '.join('?' * len(chunk)))
+            for line in self.__read_database(query, tuple(chunk)).fetchall():
+                stats[line[0]] = tuple(line[1:])
+        return stats
+
+    @staticmethod
+    def __pattern_rate(stats):
+        """
+        Gets the new products found by web page read of a url pattern. An
+        unknown pattern starts with one product in two web pages, so the
+        first web pages of a pattern do not decide it alone.
+
+        :param stats: the web pages read, the new products found and the
+        near duplicate web pages of a url pattern
+
+        :type stats: tuple
+
+        :rtype: float
+        """
+        pages, products, _ = stats
+        return (products + 1) / (pages + 2)
+
+    @staticmethod
+    def __duplicate_pattern(stats):
+        """
+        Checks if most web pages of a url pattern are near duplicates.
+
+        :param stats: the web pages read, the new products found and the
+        near duplicate web pages of a url pattern
+
+        :type stats: tuple
+
+        :rtype: bool
+        """
+        pages, _, duplicates = stats
+        return duplicates >= MIN_DUPLICATES and duplicates >= DUPLICATE_RATE * pages
+
+    def __demote_statement(self, pattern):
+        """
+        Creates the statement that changes the unvisited urls of a url
+        pattern that gives near duplicates, so they are read last or skipped.
+
+        :param pattern: a url pattern, see url_pattern
+
+        :type pattern: str
+
+        :return: a tuple with the statement and its values
+
+        :rtype: tuple
+        """
+        if self.__skip_duplicates:
+            change = 'visited = {}'.format(SKIPPED)
+        else:
+            change = 'score = score - {}'.format(DUPLICATE_WEIGHT)
+        statement = 'UPDATE links SET {} WHERE visited = 0 AND kind = 0 AND pattern = ?;'.format(change)
+        return statement, [(self.__pattern_id(pattern), )]
+
+    def __score(self, stats, depth, found):
+        """
+        Gets the score of a url when it is inserted.
+
+        :param stats: the statistics of the url pattern of a url that is not a product
+        :param depth: how many links the url is from the main page
+        :param found: new products found in the web page where the url was found
+
+        :type stats: tuple
+        :type depth: int
+        :type found: int
+
+        :rtype: float
+        """
+        return (YIELD_WEIGHT * math.log1p(found) + PATTERN_WEIGHT * math.log1p(self.__pattern_rate(stats)) -
+                DEPTH_WEIGHT * depth)
+
+    def __insert_statement(self, url_list, stats, depth=0, found=0):
+        """
+        Creates the statement that inserts the urls that are not in the
+        database yet. The urls already saved are ignored by sqlite, so
+        their depth and score do not change, and the compacted urls are
+        ignored by their fingerprint.
+
+        :param url_list: list of urls without repetition
+        :param stats: the statistics of the url patterns of the urls, see __pattern_stats
+        :param depth: how many links the urls are from the main page
+        :param found: new products found in the web page where the urls were found
+
+        :type url_list: list
+        :type stats: dict
+        :type depth: int
+        :type found: int
+
+        :return: a tuple with the statement and its values
+
+        :rtype: tuple
+        """
+        statement = ('INSERT OR IGNORE INTO links (url, visited, kind, depth, score, pattern) SELECT ?, ?, ?, ?, ?, ? '
+                     'WHERE NOT EXISTS (SELECT 1 FROM visited_fingerprints WHERE fingerprint = ?);')
+        values = []
+        for url in url_list:
+            product = self.is_product(url)
+            visited = PENDING
+            pattern_id = None
+            if product:
+                # the products are always read before the other urls, they are only ordered by their depth
+                score = -DEPTH_WEIGHT * depth
+            else:
+                pattern = url_pattern(url)
+                pattern_id = self.__pattern_id(pattern)
+                score = self.__score(stats[pattern], depth, found)
+                if self.__duplicate_pattern(stats[pattern]):
+                    if self.__skip_duplicates:
+                        visited = SKIPPED
+                    score -= DUPLICATE_WEIGHT
+            key = self.__key(url)
+            values.append((key, visited, 1 if product else 0, depth, score, pattern_id, fingerprint(key)))
+        return statement, values
+
+    def __new_products(self, url_list):
+        """
+        Counts the product urls of a list that are not in the database yet.
+
+        :param url_list: list of urls without repetition
+
+        :type url_list: list
+
+        :rtype: int
+        """
+        products = [self.__key(url) for url in url_list if self.is_product(url)]
+        known = 0
+        for start in range(0, len(products), MAX_VARIABLES):
+            chunk = products[start:start + MAX_VARIABLES]
+            query = 'SELECT COUNT(*) FROM links WHERE url IN ({});'.format(', '.join('?' * len(chunk)))
+            known += self.__fetchone(query, tuple(chunk))
+        return len(products) - known
+
+    def __insert_urls(self, url_list, statements=(), parent=None, simhash=None):
+        """
+        Inserts the unknown urls of a list in the same transaction of
+        other statements, updating the seen filter when it is saved.
+        When the urls were found in the web page of a parent url, they are
+        one link deeper than it and the new products found in it, and if
+        it is a near duplicate, are counted in the statistics of its url
+        pattern.
+
+        :param url_list: list of urls
+        :param statements: other statements done in the same transaction
+        :param parent: the url whose web page has the urls
+        :param simhash: the SimHash of the web page of the parent url
+
+        :type url_list: list
+        :type statements: tuple
+        :type parent: str
+        :type simhash: int
+        """
+        if self.__router is not None:
+            url_list = self.__router.split(url_list)
+        url_list = self.__unknown_urls(url_list)
+        pattern = None
+        found = 0
+        depth = 0
+        duplicate = False
+        if parent is not None:
+            # the urls known by the seen filter are not new products
+            found = self.__new_products(url_list)
+            depth = self.__fetchone('SELECT depth FROM links WHERE url = ?;', (self.__key(parent), ))
+            depth = (depth or 0) + 1
+            pattern = url_pattern(parent)
+            if simhash is not None and self.__near_duplicates is not None:
+                # a near duplicate web page with new products was still worth reading
+                duplicate = self.__near_duplicates.check(simhash) and not found
+            if duplicate:
+                METRICS.count('pages_near_duplicate')
+        patterns = {url_pattern(url) for url in url_list if not self.is_product(url)}
+        if pattern is not None:
+            patterns.add(pattern)
+        # a new host or url pattern is saved in its own transaction, before the statistics are read
+        for pattern_name in patterns:
+            self.__pattern_id(pattern_name)
+        if self.__compact:
+            for url in url_list:
+                self.__key(url)
+        if patterns:
+            # the statistics are read holding the write lock until the commit,
+            # so the changes of another connection are not lost nor missed
+            self.__begin_immediate()
+        stats = self.__pattern_stats(patterns)
+        demote = False
+        if pattern is not None:
+            pages, products, duplicates = stats[pattern]
+            # the pattern is demoted once, by the web page that makes it give near duplicates
+            demote = (not self.__duplicate_pattern(stats[pattern]) and
+                      self.__duplicate_pattern((pages + 1, products + found, duplicates + int(duplicate))))
+            statements = tuple(statements) + (
+                ('INSERT OR IGNORE INTO pattern_stats (pattern) VALUES (?);', [(pattern, )]),
+                ('UPDATE pattern_stats SET pages = pages + 1, products = products + ?, '
+                 'duplicates = duplicates + ? WHERE pattern = ?;', [(found, int(duplicate), pattern)]))
+        if url_list:
+            statements = (self.__insert_statement(url_list, stats, depth, found), ) + tuple(statements)
+        if demote:
+            # the pattern has just been found giving near duplicates, its
+            # unvisited urls change in the same transaction
+            statements = tuple(statements) + (self.__demote_statement(pattern), )
+        if statements and self.__write_many(statements):
+            if self.__seen_filter is not None:
+                self.__seen_filter.add(url_list)
+
     def insert_new_url(self, url):
         """
         Insert a new url to the database, if this url is not in the database yet.
@@ -281,29 +1036,452 @@ class URLDatabase:
 
         :type url: str
         """
-        # check if there is the url given in the database
-        if self.__is_new(url):
-            statement = 'INSERT INTO links (url) VALUES (?);'
-            self.__write_database(statement, (url, ))
+        self.insert_url_list([url])
 
     def insert_url_list(self, url_list):
         """
-        Insert a list of urls in the database.
+        Insert a list of urls in the database in only one transaction.
 
         :param url_list: list of urls
 
         :type url_list: list
         """
-        for url in url_list:
-            self.insert_new_url(url)
+        self.__insert_urls(url_list)
 
-    def set_visited(self, url):
+    def set_visited(self, url, url_list=(), etag=None, last_modified=None, content_hash=None, fetched=None,
+                    error=None, simhash=None):
         """
         Changes the state of a url to visited.
+        The urls found in its web page can be inserted in the same transaction.
+        The validators of the web page are only changed if they are given.
+        When the web page was read, the time it was read is saved and, if its
+        content hash changed, it is counted as a change of the web page.
+
+        :param url: a url
+
+        :type url: str
+
+        :param url_list: list of urls found in the web page of the url
+
+        :type url_list: list
+
+        :param etag: the ETag header of the web page
+
+        :type etag: str
+
+        :param last_modified: the Last-Modified header of the web page
+
+        :type last_modified: str
+
+        :param content_hash: a hash of the web page content
+
+        :type content_hash: str
+
+        :param fetched: when the web page was read, None if it was not possible read it
+
+        :type fetched: float
+
+        :param error: the error that will not change if the web page is read
+        again, as a 404 status, None if the web page was read
+
+        :type error: str
+
+        :param simhash: the SimHash of the links and words of the web page,
+        None if it is not known
+
+        :type simhash: int
+        """
+        # the expressions use the values of the row before the update
+        statement = ('UPDATE links SET visited = 1, worker = NULL, lease_expiry = NULL, '
+                     'etag = COALESCE(:etag, etag), last_modified = COALESCE(:last_modified, last_modified), '
+                     'changes = changes + (:hash IS NOT NULL AND content_hash IS NOT NULL AND content_hash != :hash), '
+                     'last_changed = CASE WHEN :hash IS NOT NULL AND (content_hash IS NULL OR content_hash != :hash) '
+                     'THEN :fetched ELSE last_changed END, '
+                     'content_hash = COALESCE(:hash, content_hash), '
+                     'first_fetched = COALESCE(first_fetched, :fetched), '
+                     'last_fetched = COALESCE(:fetched, last_fetched), '
+                     'fetches = fetches + (:fetched IS NOT NULL), next_attempt = NULL, last_error = :error, '
+                     'failures = CASE WHEN :error IS NULL THEN 0 ELSE failures + 1 END, '
+                     'simhash = COALESCE(:simhash, simhash) WHERE url = :url;')
+        values = {'etag': etag, 'last_modified': last_modified, 'hash': content_hash, 'fetched': fetched,
+                  'url': self.__key(url), 'error': error, 'simhash': simhash}
+        # only a web page whose links were read counts in the statistics of its url pattern
+        parent = url if url_list and error is None else None
+        self.__insert_urls(url_list, [(statement, [values])], parent=parent, simhash=simhash)
+
+    def retry_later(self, url, error, now=None, max_retries=MAX_RETRIES, delay=RETRY_DELAY,
+                    max_delay=MAX_RETRY_DELAY):
+        """
+        Keeps a url whose web page could not be read by a transient error
+        waiting to be tried again, without blocking the other urls.
+        The wait doubles after each failure, with a random part so many
+        urls that failed together are not tried together. After too many
+        failures the url is kept as failed.
 
         :param url: a url
 
         :type url: str
+
+        :param error: why the web page could not be read
+
+        :type error: str
+
+        :param now: the current time, if it is None time.time() is used
+
+        :type now: float
+
+        :param max_retries: maximum of failures before the url is failed
+
+        :type max_retries: int
+
+        :param delay: seconds waited after the first failure
+
+        :type delay: float
+
+        :param max_delay: maximum of seconds waited
+
+        :type max_delay: float
+
+        :return: True if the url will be tried again, False if it is failed
+
+        :rtype: bool
+        """
+        now = time.time() if now is None else now
+        key = self.__key(url)
+        failures = (self.__fetchone('SELECT failures FROM links WHERE url = ?;', (key, )) or 0) + 1
+        retry = failures < max_retries
+        wait = min(max_delay, delay * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+        statement = ('UPDATE links SET visited = ?, worker = NULL, lease_expiry = NULL, failures = ?, '
+                     'last_error = ?, next_attempt = ? WHERE url = ?;')
+        self.__write_database(statement, (WAITING if retry else FAILED, failures, error,
+                                          now + wait if retry else None, key))
+        return retry
+
+    def release_due_retries(self, now=None):
+        """
+        Returns to pending the urls whose time to be tried again arrived.
+
+        :param now: the current time, if it is None time.time() is used
+
+        :type now: float
+        """
+        now = time.time() if now is None else now
+        due = self.next_attempt()
+        if due is not None and due <= now:
+            self.__write_database(RELEASE_DUE_RETRIES, (now, ))
+
+    def next_attempt(self):
+        """
+        Gets when the first url waiting to be tried again can be tried.
+
+        :return: the time or None if there is no url waiting
+
+        :rtype: float
+        """
+        return self.__fetchone('SELECT MIN(next_attempt) FROM links WHERE visited = 3;', ())
+
+    def failed(self):
+        """
+        Get the amount of urls that failed too many times.
+
+        :return: the amount of failed urls
+
+        :rtype: int
+        """
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats WHERE visited = 4'
+        result = self.__fetchone(query, ())
+        # check if result is different of None, if is, does again the same query
+        return result if result is not None else self.failed()
+
+    def requeue_failed(self):
+        """
+        Changes every failed url to unvisited, with its failures forgotten.
+        """
+        self.__write_database('UPDATE links SET visited = 0, failures = 0, next_attempt = NULL '
+                              'WHERE visited = 4;', ())
+
+    def get_validators(self, url):
+        """
+        Get how a web page was the last time it was read.
+
+        :param url: a url
+
+        :type url: str
+
+        :return: a tuple with the ETag, the Last-Modified and the content hash
+        of the web page, each one is None if it is not known
+
+        :rtype: tuple
+        """
+        query = 'SELECT etag, last_modified, content_hash FROM links WHERE url = ?;'
+        answer = self.__read_database(query, (self.__key(url), )).fetchone()
+        return tuple(answer) if answer else (None, None, None)
+
+    def requeue_visited(self):
+        """
+        Changes every visited url to unvisited, so the whole site is read again.
+        """
+        self.__write_database('UPDATE links SET visited = 0 WHERE visited = 1;', ())
+
+    def requeue_due(self, amount=None, now=None, minimum=3600.0, maximum=30 * 24 * 3600.0,
+                    prior=REFRESH_PRIOR):
+        """
+        Changes to unvisited the visited urls that are due to be read again.
+        A url is due when the time since it was read is longer than the
+        estimated time between two changes of its web page. Product urls
+        come first and, then, the most overdue urls.
+        The urls visited before the fetch times were saved are due at once.
+
+        :param amount: maximum of urls changed, None changes every due url
+
+        :type amount: int
+
+        :param now: the current time, if it is None time.time() is used
+
+        :type now: float
+
+        :param minimum: minimum of seconds between two reads of a web page
+
+        :type minimum: float
+
+        :param maximum: maximum of seconds between two reads of a web page
+
+        :type maximum: float
+
+        :param prior: seconds between two reads of a web page never seen changing
+
+        :type prior: float
+
+        :return: amount of urls changed to unvisited
+
+        :rtype: int
+        """
+        values = {'now': time.time() if now is None else now, 'minimum': minimum, 'maximum': maximum,
+                  'prior': prior, 'amount': -1 if amount is None else amount}
+        query = ('SELECT url FROM links WHERE visited = 1 AND (last_fetched IS NULL OR '
+                 'last_fetched + {0} <= :now) ORDER BY kind DESC, last_fetched IS NOT NULL, '
+                 '(:now - last_fetched) / {0} DESC LIMIT :amount;').format(REFRESH_INTERVAL)
+        self.__begin_immediate()
+        try:
+            urls = [line[0] for line in self.cursor.execute(query, values)]
+            self.cursor.executemany('UPDATE links SET visited = 0 WHERE url = ?;', [(url, ) for url in urls])
+            self.connection.commit_db()
+        except sqlite3.Error as e:
+            self.connection.rollback_db()
+            print('Error changing the due urls in the database.')
+            print(e)
+            return 0
+        return len(urls)
+
+    def next_due(self, minimum=3600.0, maximum=30 * 24 * 3600.0, prior=REFRESH_PRIOR):
+        """
+        Gets when the first visited url will be due to be read again,
+        with the same estimate of requeue_due.
+
+        :param minimum: minimum of seconds between two reads of a web page
+
+        :type minimum: float
+
+        :param maximum: maximum of seconds between two reads of a web page
+
+        :type maximum: float
+
+        :param prior: seconds between two reads of a web page never seen changing
+
+        :type prior: float
+
+        :return: the time the first url will be due or None if there is no visited url
+
+        :rtype: float
+        """
+        query = ('SELECT MIN(COALESCE(last_fetched + {}, 0)) FROM links '
+                 'WHERE visited = 1;').format(REFRESH_INTERVAL)
+        values = {'minimum': minimum, 'maximum': maximum, 'prior': prior}
+        return self.__read_database(query, values).fetchone()[0]
+
+    def __begin_immediate(self):
+        """
+        Starts a transaction that holds the database write lock, so no other
+        connection can claim the same url between the read and the update.
+        """
+        try:
+            self.cursor.execute('BEGIN IMMEDIATE;')
+        except sqlite3.Error as e:
+            # if the database is locked, wait 0.5 seconds and try again
+            if str(e) == 'database is locked':
+                time.sleep(0.5)
+                self.__begin_immediate()
+            else:
+                raise
+
+    def claim_batch(self, worker, amount, product=False, lease=LEASE_TIME):
+        """
+        Atomically moves many pending urls of the same kind to in flight,
+        recording the worker that claimed them and when the lease expires.
+        Urls whose lease has expired and urls whose time to be tried again
+        arrived return to pending before the claim.
+
+        :param worker: identification of the worker claiming the urls
+
+        :type worker: str
+
+        :param amount: maximum of urls claimed
+
+        :type amount: int
+
+        :param product: if True product urls will be claimed, if False the others
+
+        :type product: bool
+
+        :param lease: seconds the worker can hold the urls
+
+        :type lease: float
+
+        :return: the claimed urls, an empty list if there is no pending url
+
+        :rtype: list
+        """
+        now = time.time()
+        self.__begin_immediate()
+        try:
+            with METRICS.timer('db_claim'):
+                self.cursor.execute(RELEASE_EXPIRED_LEASES, (now, ))
+                self.cursor.execute(RELEASE_DUE_RETRIES, (now, ))
+                query = 'SELECT url FROM links WHERE visited = 0 AND kind = ? ORDER BY score DESC LIMIT ?;'
+                keys = [line[0] for line in self.cursor.execute(query, (1 if product else 0, amount))]
+                statement = 'UPDATE links SET visited = 2, worker = ?, lease_expiry = ? WHERE url = ?;'
+                self.cursor.executemany(statement, [(worker, now + lease, key) for key in keys])
+                self.connection.commit_db()
+        except sqlite3.Error as e:
+            self.connection.rollback_db()
+            print('Error claiming urls in the database.')
+            print(e)
+            return []
+        return [self.__url(key) for key in keys]
+
+    def claim(self, worker, product=False, lease=LEASE_TIME):
+        """
+        Atomically moves one pending url to in flight, as claim_batch does.
+
+        :param worker: identification of the worker claiming the url
+
+        :type worker: str
+
+        :param product: if True a product url will be claimed, if False another url
+
+        :type product: bool
+
+        :param lease: seconds the worker can hold the url
+
+        :type lease: float
+
+        :return: the claimed url or None if there is no pending url
+
+        :rtype: str
+        """
+        urls = self.claim_batch(worker, 1, product, lease)
+        return urls[0] if urls else None
+
+    def compact_visited(self, amount=None):
+        """
+        Removes from the links table the visited urls that are not products,
+        keeping only their fingerprints, so they are not inserted again. A
+        compacted url is never read again, not even by requeue_visited and
+        requeue_due. A new url with the same fingerprint of a compacted one
+        is taken as visited, what only becomes likely with billions of urls.
+
+        :param amount: maximum of urls compacted, None compacts every one
+
+        :type amount: int
+
+        :return: amount of urls compacted
+
+        :rtype: int
+        """
+        query = 'SELECT url FROM links WHERE visited = 1 AND kind = 0 LIMIT ?;'
+        self.__begin_immediate()
+        try:
+            keys = [line[0] for line in self.cursor.execute(query, (-1 if amount is None else amount, ))]
+            self.cursor.executemany('INSERT OR IGNORE INTO visited_fingerprints (fingerprint) VALUES (?);',
+                                    [(fingerprint(key), ) for key in keys])
+            self.cursor.executemany('DELETE FROM links WHERE url = ?;', [(key, ) for key in keys])
+            # the delete trigger forgets the urls, they are counted as compacted
+            self.cursor.execute('INSERT OR IGNORE INTO link_stats (kind, visited) VALUES (0, ?);', (COMPACTED, ))
+            self.cursor.execute('UPDATE link_stats SET amount = amount + ? WHERE kind = 0 AND visited = ?;',
+                                (len(keys), COMPACTED))
+            self.connection.commit_db()
+        except sqlite3.Error as e:
+            self.connection.rollback_db()
+            print('Error compacting the visited urls in the database.')
+            print(e)
+            return 0
+        return len(keys)
+
+    def skipped(self):
+        """
+        Get the amount of urls not read because their url pattern gives
+        near duplicate web pages.
+
+        :return: the amount of skipped urls
+
+        :rtype: int
+        """
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats WHERE visited = 6'
+        result = self.__fetchone(query, ())
+        # check if result is different of None, if is, does again the same query
+        return result if result is not None else self.skipped()
+
+    def compacted(self):
+        """
+        Get the amount of visited urls kept only by their fingerprints.
+
+        :return: the amount of compacted urls
+
+        :rtype: int
+        """
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats WHERE visited = 5'
+        result = self.__fetchone(query, ())
+        # check if result is different of None, if is, does again the same query
+        return result if result is not None else self.compacted()
+
+    def release_expired_leases(self):
+        """
+        Returns to pending the urls whose worker did not finish them before
+        the lease expires, for example because the worker crashed.
+        """
+        self.__write_database(RELEASE_EXPIRED_LEASES, (time.time(), ))
+
+    def release_worker(self, worker):
+        """
+        Returns to pending the urls held by a worker that stopped before
+        finishing them.
+
+        :param worker: identification of the worker
+
+        :type worker: str
+        """
+        self.__write_database('UPDATE links SET visited = 0, worker = NULL, lease_expiry = NULL '
+                              'WHERE visited = 2 AND worker = ?;', (worker, ))
+
+    def in_flight(self):
+        """
+        Get the amount of urls claimed by some worker.
+
+        :return: the amount of urls in flight
+
+        :rtype: int
+        """
+        query = 'SELECT COALESCE(SUM(amount), 0) FROM link_stats WHERE visited = 2'
+        result = self.__fetchone(query, ())
+        # check if result is different of None, if is, does again the same query
+        return result if result is not None else self.in_flight()
+
+    def has_in_flight(self):
+        """
+        Check if some worker is processing urls.
+
+        :return: True if there is urls in flight and False if not
+
+        :rtype: bool
         """
-        statement = 'UPDATE links SET visited = 1 WHERE url = ?;'
-        self.__write_database(statement, (url, ))
+        return True if self.in_flight() > 0 else False
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import codecs
+import re
+from html.parser import HTMLParser
+
+
+# tags that bs4 closes as soon as they are opened
+VOID_TAGS = {'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame',
+             'hr', 'image', 'img', 'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta',
+             'nextid', 'param', 'source', 'spacer', 'track', 'wbr'}
+
+# finds the charset declared in the beginning of a web page
+CHARSET = re.compile(br'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_.:-]+)', re.IGNORECASE)
+
+BOMS = ((codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'), (codecs.BOM_UTF16_BE, 'utf-16-be'))
+
+
+class ParsedPage:
+    def __init__(self, links, title, product_name, has_h1):
+        """
+        ParsedPage keeps only what the search needs from a web page.
+
+        :param links: the href of every 'a' tag, 'None' for a tag without href
+        :param title: the web page title, None if there is no title
+        :param product_name: the first content of the first h1 tag
+        :param has_h1: True if the first h1 tag has some content
+
+        :type links: list
+        :type title: str
+        :type product_name: str
+        :type has_h1: bool
+        """
+        self.links = links
+        self.title = title
+        self.product_name = product_name
+        self.has_h1 = has_h1
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedPage) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return 'ParsedPage({links!r}, {title!r}, {product_name!r}, {has_h1!r})'.format(**vars(self))
+
+
+# characters that bs4 considers spaces in a text
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+
+class SpecialString(str):
+    """
+    Text of a comment, a CDATA section or a processing instruction.
+    bs4 keeps it apart from the text around it and never collapses it.
+    """
+
+
+def node_string(node):
+    """
+    Gets the string of a node in the same way as bs4 Tag.string: a tag with
+    exactly one child has the string of that child, any other tag has none.
+    A text with only spaces is collapsed to one space or one new line.
+
+    :param node: a text or a list with the tag name and its children
+
+    :rtype: str
+    """
+    if isinstance(node, SpecialString):
+        return str(node)
+    if isinstance(node, str):
+        if node.strip(ASCII_SPACES):
+            return node
+        return '\n' if '\n' in node else ' '
+    children = node[1]
+    if len(children) != 1:
+        return None
+    return node_string(children[0])
+
+
+class PageParser(HTMLParser):
+    def __init__(self):
+        """
+        PageParser reads a web page as a stream of html events, without
+        building the tree of the page. It saves the href of the 'a' tags
+        and only the subtrees of the first 'title' and 'h1' tags.
+        """
+        super().__init__(convert_charrefs=True)
+        self.links = []
+        self.title = None
+        self.h1 = None
+        # each open tag is saved with its node if it is inside a saved subtree
+        self.__open_tags = []
+        # bs4 joins texts only if there is no tag between them
+        self.__joinable = False
+
+    def __add_node(self, tag):
+        """
+        Creates the node of a tag if it must be saved.
+
+        :param tag: the tag name
+
+        :type tag: str
+
+        :return: the tag node or None if the tag is not saved
+
+        :rtype: list
+        """
+        parent = self.__open_tags[-1][1] if self.__open_tags else None
+        node = None
+        if parent is not None:
+            node = [tag, []]
+            parent[1].append(node)
+        if tag == 'title' and self.title is None:
+            self.title = node = node or [tag, []]
+        elif tag == 'h1' and self.h1 is None:
+            self.h1 = node = node or [tag, []]
+        return node
+
+    def handle_starttag(self, tag, attrs):
+        self.__joinable = False
+        if tag == 'a':
+            # the last repeated attribute wins, as in bs4
+            attributes = dict(attrs)
+            if 'href' not in attributes:
+                self.links.append('None')
+            else:
+                # an attribute without value is empty
+                self.links.append(attributes['href'] or '')
+        node = self.__add_node(tag)
+        if tag not in VOID_TAGS:
+            self.__open_tags.append((tag, node))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self.__joinable = False
+        # closes the tag and every tag opened inside it, as bs4 does
+        for index in range(len(self.__open_tags) - 1, -1, -1):
+            if self.__open_tags[index][0] == tag:
+                del self.__open_tags[index:]
+                return
+
+    def __add_text(self, text):
+        """
+        Adds a text to the node of the current tag, if it is saved.
+
+        :param text: a text or a special string
+
+        :type text: str
+        """
+        joinable = self.__joinable
+        self.__joinable = not isinstance(text, SpecialString)
+        if not self.__open_tags or self.__open_tags[-1][1] is None:
+            return
+        children = self.__open_tags[-1][1][1]
+        if joinable and self.__joinable:
+            children[-1] += text
+        else:
+            children.append(text)
+
+    def handle_data(self, data):
+        self.__add_text(data)
+
+    def handle_comment(self, data):
+        self.__add_text(SpecialString(data))
+
+    def handle_pi(self, data):
+        self.__add_text(SpecialString(data))
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            self.__add_text(SpecialString(data[len('CDATA['):]))
+
+    def page(self):
+        """
+        Gets what was found in the web page.
+
+        :rtype: ParsedPage
+        """
+        title = node_string(self.title) if self.title else None
+        has_h1 = bool(self.h1 and self.h1[1])
+        product_name = node_string(self.h1[1][0]) if has_h1 else None
+        return ParsedPage(self.links, title, product_name, has_h1)
+
+
+def decode(content):
+    """
+    Decodes a web page using its byte order mark, the charset declared in it,
+    utf-8 or windows-1252, in this order.
+
+    :param content: a web page content
+
+    :type content: bytes
+
+    :rtype: str
+    """
+    if isinstance(content, str):
+        return content
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return content[len(bom):].decode(encoding, 'replace')
+    declared = CHARSET.search(content[:2048])
+    if declared:
+        try:
+            return content.decode(declared.group(1).decode('ascii'))
+        except (LookupError, UnicodeDecodeError):
+            pass
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('windows-1252', 'replace')
+
+
+def stream_extract(content):
+    """
+    Extracts the links, the title and the h1 of a web page without
+    building the tree of the page.
+
+    :param content: a web page content
+
+    :type content: bytes
+
+    :rtype: ParsedPage
+    """
+    parser = PageParser()
+    parser.feed(decode(content))
+    parser.close()
+    return parser.page()
+
+
+def soup_page(soup):
+    """
+    Extracts the links, the title and the h1 of a web page processed by
+    BeautifulSoup.
+
+    :param soup: a processed web page
+
+    :type soup: BeautifulSoup
+
+    :rtype: ParsedPage
+    """
+    links = [str(tag_a.get('href')) for tag_a in soup.find_all('a')]
+    title_tag = soup.find('title')
+    title = str(title_tag.string) if title_tag and title_tag.string is not None else None
+    h1 = soup.find('h1')
+    # a h1 without content can not have a product name
+    has_h1 = h1 is not None and len(h1.contents) > 0
+    product_name = None
+    if has_h1 and h1.contents[0].string is not None:
+        product_name = str(h1.contents[0].string)
+    return ParsedPage(links, title, product_name, has_h1)
+
+
+def soup_extract(content):
+    """
+    Extracts the links, the title and the h1 of a web page building its
+    whole tree with BeautifulSoup.
+
+    :param content: a web page content
+
+    :type content: bytes
+
+    :rtype: ParsedPage
+    """
+    # bs4 is imported here, so the stream engine does not need it
+    from bs4 import BeautifulSoup
+    return soup_page(BeautifulSoup(content, 'html.parser'))
+
+
+# engines that can be used to extract the data of a web page
+ENGINES = {'soup': soup_extract, 'stream': stream_extract}
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+
+
+class AsyncFetcher:
+    def __init__(self, download, concurrency=10, per_host=None):
+        """
+        AsyncFetcher keeps many downloads in flight at the same time.
+        The downloads are done by a blocking function executed in a pool
+        of threads, while asyncio limits how many of them run at once in
+        total and for each host.
+
+        :param download: function that receives a url, and optionally other
+        arguments, and returns its content
+
+        :type download: callable
+
+        :param concurrency: maximum of downloads in flight at the same time
+
+        :type concurrency: int
+
+        :param per_host: maximum of downloads in flight for the same host,
+        if it is None the concurrency is used
+
+        :type per_host: int
+        """
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self.__download = download
+        self.__concurrency = concurrency
+        self.__per_host = per_host if per_host else concurrency
+        self.__executor = ThreadPoolExecutor(max_workers=concurrency)
+        # the semaphores are created inside the running event loop
+        self.__global_limit = None
+        self.__host_limits = {}
+
+    @property
+    def concurrency(self):
+        """
+        Maximum of downloads in flight at the same time
+
+        :rtype: int
+        """
+        return self.__concurrency
+
+    def __host_limit(self, url):
+        """
+        Gets the semaphore that limits the downloads of the url host.
+
+        :param url: a url that will be downloaded
+
+        :type url: str
+
+        :rtype: asyncio.Semaphore
+        """
+        host = parse.urlsplit(url).netloc
+        if host not in self.__host_limits:
+            self.__host_limits[host] = asyncio.Semaphore(self.__per_host)
+        return self.__host_limits[host]
+
+    async def fetch(self, url, *arguments):
+        """
+        Downloads a url without blocking the event loop.
+
+        :param url: a url to be downloaded
+
+        :type url: str
+
+        :param arguments: other arguments given to the download function
+
+        :return: what the download function returns for the url
+        """
+        if self.__global_limit is None:
+            self.__global_limit = asyncio.Semaphore(self.__concurrency)
+        loop = asyncio.get_event_loop()
+        async with self.__global_limit:
+            async with self.__host_limit(url):
+                return await loop.run_in_executor(self.__executor, self.__download, url, *arguments)
+
+    def close(self):
+        """
+        Waits the downloads in flight and stops the threads.
+        """
+        self.__executor.shutdown(wait=True)
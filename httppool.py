@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import gzip
+import http.client
+import socket
+import ssl
+import threading
+import time
+import zlib
+from urllib import parse, request
+
+
+# statuses that send the client to the url in the Location header
+REDIRECTS = {301, 302, 303, 307, 308}
+
+# errors of a kept alive connection that the server closed while it was idle
+STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                BrokenPipeError, ConnectionAbortedError)
+
+USER_AGENT = 'Python-urllib/{}'.format(request.__version__)
+
+
+class DNSCache:
+    def __init__(self, ttl=300.0):
+        """
+        DNSCache keeps the addresses of the hosts already resolved, so a
+        new connection to the same host does not wait for the resolver.
+
+        :param ttl: seconds that the addresses of a host are kept
+
+        :type ttl: float
+        """
+        self.__ttl = ttl
+        self.__addresses = {}
+        self.__lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """
+        Gets the addresses of a host.
+
+        :param host: a host name
+        :param port: a port number
+
+        :type host: str
+        :type port: int
+
+        :return: list of tuples with the family and the address of a socket
+
+        :rtype: list
+        """
+        key = (host, port)
+        with self.__lock:
+            cached = self.__addresses.get(key)
+            if cached and cached[1] > time.monotonic():
+                return cached[0]
+        addresses = [(family, address) for family, _, _, _, address
+                     in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+        with self.__lock:
+            self.__addresses[key] = (addresses, time.monotonic() + self.__ttl)
+        return addresses
+
+    def forget(self, host, port):
+        """
+        Removes the addresses of a host, so they are resolved again.
+
+        :param host: a host name
+        :param port: a port number
+
+        :type host: str
+        :type port: int
+        """
+        with self.__lock:
+            self.__addresses.pop((host, port), None)
+
+    def create_connection(self, host, port, timeout):
+        """
+        Opens a socket with the first address of a host that answers.
+
+        :param host: a host name
+        :param port: a port number
+        :param timeout: seconds to wait for the connection
+
+        :type host: str
+        :type port: int
+        :type timeout: float
+
+        :rtype: socket.socket
+        """
+        last_error = None
+        for family, address in self.resolve(host, port):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.connect(address)
+                return sock
+            except OSError as e:
+                sock.close()
+                last_error = e
+        # the addresses may have changed
+        self.forget(host, port)
+        raise last_error if last_error else OSError('no address found for {}'.format(host))
+
+
+class PooledHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, host, port, timeout, dns):
+        """
+        HTTP connection that gets the address of the host from a DNSCache.
+
+        :type host: str
+        :type port: int
+        :type timeout: float
+        :type dns: DNSCache
+        """
+        super().__init__(host, port, timeout=timeout)
+        self.__dns = dns
+
+    def connect(self):
+        self.sock = self.__dns.create_connection(self.host, self.port, self.timeout)
+
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host, port, timeout, dns, context, sessions):
+        """
+        HTTPS connection that gets the address of the host from a DNSCache
+        and resumes the TLS session of the last connection to the same host,
+        skipping most of the handshake.
+
+        :type host: str
+        :type port: int
+        :type timeout: float
+        :type dns: DNSCache
+        :type context: ssl.SSLContext
+        :type sessions: dict
+        """
+        super().__init__(host, port, timeout=timeout, context=context)
+        self.__dns = dns
+        self.__tls_context = context
+        self.__sessions = sessions
+
+    def connect(self):
+        key = (self.host, self.port)
+        sock = self.__dns.create_connection(self.host, self.port, self.timeout)
+        try:
+            self.sock = self.__tls_context.wrap_socket(sock, server_hostname=self.host,
+                                                       session=self.__sessions.get(key))
+        except (ssl.SSLError, ValueError):
+            # a session the server does not accept any more is discarded
+            self.__sessions.pop(key, None)
+            sock.close()
+            sock = self.__dns.create_connection(self.host, self.port, self.timeout)
+            self.sock = self.__tls_context.wrap_socket(sock, server_hostname=self.host)
+        if self.sock.session is not None:
+            self.__sessions[key] = self.sock.session
+
+
+class PooledResponse:
+    def __init__(self, url, status, reason, headers, content):
+        """
+        PooledResponse keeps a whole answer of the server, already decompressed.
+
+        :param url: the url of the answer, after the redirects
+        :param status: the http status
+        :param reason: the http reason phrase
+        :param headers: the headers of the answer
+        :param content: the content of the answer
+
+        :type url: str
+        :type status: int
+        :type reason: str
+        :type headers: http.client.HTTPMessage
+        :type content: bytes
+        """
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+
+class StreamedResponse:
+    def __init__(self, url, answer, release):
+        """
+        StreamedResponse is an answer of the server whose content is read
+        while it is received, so a big file is not kept in memory.
+        A content compressed with gzip by the server is decompressed while
+        it is read. It must be closed after it is read.
+
+        :param url: the url of the answer, after the redirects
+        :param answer: the answer whose content was not read yet
+        :param release: function called with the answer when it is closed,
+        to keep its connection open if the whole content was read
+
+        :type url: str
+        :type answer: http.client.HTTPResponse
+        :type release: callable
+        """
+        self.url = url
+        self.status = answer.status
+        self.reason = answer.reason
+        self.headers = answer.msg
+        self.__answer = answer
+        self.__release = release
+        encoding = (answer.getheader('Content-Encoding') or '').strip().lower()
+        self.__stream = gzip.GzipFile(fileobj=answer) if encoding in ('gzip', 'x-gzip') else answer
+
+    def read(self, size=-1):
+        """
+        Reads a part of the content.
+
+        :param size: maximum of bytes read, all the content if it is negative
+
+        :type size: int
+
+        :rtype: bytes
+        """
+        return self.__stream.read(size)
+
+    def peek(self, size=1):
+        """
+        Gets the next bytes of the content without taking them.
+
+        :param size: minimum of bytes wanted, less if the content ends before
+
+        :type size: int
+
+        :rtype: bytes
+        """
+        return self.__stream.peek(size)
+
+    def close(self):
+        """
+        Gives back the connection of the answer.
+        """
+        if self.__release is not None:
+            self.__release(self.__answer)
+            self.__release = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def decompress(content, encoding):
+    """
+    Decodes the content of an answer compressed by the server.
+
+    :param content: the content received
+    :param encoding: the Content-Encoding header
+
+    :type content: bytes
+    :type encoding: str
+
+    :rtype: bytes
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.decompress(content)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            # some servers send deflate without the zlib header
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    return content
+
+
+class HTTPPool:
+    def __init__(self, timeout=30.0, max_idle=10, max_redirects=5, dns_ttl=300.0):
+        """
+        HTTPPool keeps the connections with each host open between the
+        requests (HTTP/1.1 keep alive), so a web page does not pay for a new
+        TCP connection and TLS handshake. The addresses of the hosts and the
+        TLS sessions are kept too, so even a new connection is cheaper, and
+        the web pages are asked compressed with gzip or deflate.
+        It can be used by many threads at the same time.
+
+        :param timeout: seconds to wait for the server
+        :param max_idle: maximum of idle connections kept for each host
+        :param max_redirects: maximum of redirects followed in a request
+        :param dns_ttl: seconds that the address of a host is kept
+
+        :type timeout: float
+        :type max_idle: int
+        :type max_redirects: int
+        :type dns_ttl: float
+        """
+        self.__timeout = timeout
+        self.__max_idle = max_idle
+        self.__max_redirects = max_redirects
+        self.__dns = DNSCache(dns_ttl)
+        self.__context = ssl.create_default_context()
+        self.__sessions = {}
+        # idle connections of each scheme, host and port
+        self.__idle = {}
+        self.__lock = threading.Lock()
+        # amount of connections opened, the others requests reused one
+        self.opened = 0
+
+    def __connect(self, key):
+        """
+        Opens a new connection.
+
+        :param key: tuple with the scheme, the host and the port
+
+        :type key: tuple
+
+        :rtype: http.client.HTTPConnection
+        """
+        scheme, host, port = key
+        with self.__lock:
+            self.opened += 1
+        if scheme == 'https':
+            return PooledHTTPSConnection(host, port, self.__timeout, self.__dns, self.__context,
+                                         self.__sessions)
+        return PooledHTTPConnection(host, port, self.__timeout, self.__dns)
+
+    def __acquire(self, key):
+        """
+        Gets an idle connection to a host or None if there is no one.
+
+        :param key: tuple with the scheme, the host and the port
+
+        :type key: tuple
+
+        :rtype: http.client.HTTPConnection
+        """
+        with self.__lock:
+            idle = self.__idle.get(key)
+            return idle.pop() if idle else None
+
+    def __release(self, key, connection):
+        """
+        Keeps a connection open to be used by the next request to its host.
+
+        :param key: tuple with the scheme, the host and the port
+        :param connection: a connection whose answer was read
+
+        :type key: tuple
+        :type connection: http.client.HTTPConnection
+        """
+        with self.__lock:
+            idle = self.__idle.setdefault(key, [])
+            if len(idle) < self.__max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def __send(self, key, target, headers, stream=False):
+        """
+        Sends a GET request and reads the whole answer.
+        A kept alive connection closed by the server is replaced by a new one.
+
+        :param key: tuple with the scheme, the host and the port
+        :param target: the path and the query of the url
+        :param headers: headers sent with the request
+        :param stream: if True, the content is not read and the connection
+        is returned instead of it, to be given back after the content is read
+
+        :type key: tuple
+        :type target: str
+        :type headers: dict
+        :type stream: bool
+
+        :return: the answer and its content or its connection
+
+        :rtype: tuple
+        """
+        connection = self.__acquire(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = self.__connect(key)
+            try:
+                connection.request('GET', target, headers=headers)
+                answer = connection.getresponse()
+                if stream and not (answer.status in REDIRECTS and answer.getheader('Location')):
+                    return answer, connection
+                content = answer.read()
+            except STALE_ERRORS:
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed the idle connection, so a new one is opened
+                connection, reused = None, False
+                continue
+            except Exception:
+                connection.close()
+                raise
+            if answer.will_close:
+                connection.close()
+            else:
+                self.__release(key, connection)
+            return answer, content
+
+    def __follow(self, url, headers, stream):
+        """
+        Sends a GET request to a url following its redirects.
+
+        :param url: an absolute http or https url
+        :param headers: headers sent with the request
+        :param stream: if True, the content of the last answer is not read
+
+        :type url: str
+        :type headers: dict
+        :type stream: bool
+
+        :return: the final url, the key of its host, the answer and its
+        content or its connection
+
+        :rtype: tuple
+        """
+        for _ in range(self.__max_redirects + 1):
+            parts = parse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                raise ValueError('unknown url type: {}'.format(url))
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            key = (parts.scheme, parts.hostname, port)
+            target = parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            answer, content = self.__send(key, target, headers, stream)
+            location = answer.getheader('Location')
+            if answer.status in REDIRECTS and location:
+                url = parse.urldefrag(parse.urljoin(url, location))[0]
+                continue
+            return url, key, answer, content
+        raise http.client.HTTPException('too many redirects: {}'.format(url))
+
+    def request(self, url, headers=None):
+        """
+        Gets a url following its redirects.
+
+        :param url: an absolute http or https url
+        :param headers: headers sent with the request
+
+        :type url: str
+        :type headers: dict
+
+        :rtype: PooledResponse
+        """
+        sent = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip, deflate'}
+        sent.update(headers or {})
+        url, _, answer, content = self.__follow(url, sent, False)
+        content = decompress(content, answer.getheader('Content-Encoding'))
+        return PooledResponse(url, answer.status, answer.reason, answer.msg, content)
+
+    def open(self, url, headers=None):
+        """
+        Gets a url following its redirects, without reading its content,
+        so a big file can be read while it is received.
+
+        :param url: an absolute http or https url
+        :param headers: headers sent with the request
+
+        :type url: str
+        :type headers: dict
+
+        :return: the answer, that must be closed after it is read
+
+        :rtype: StreamedResponse
+        """
+        # deflate can not be read while it is received by a file object, so only gzip is asked
+        sent = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+        sent.update(headers or {})
+        url, key, answer, connection = self.__follow(url, sent, True)
+
+        def release(closed):
+            # the connection is kept only if the whole content was read
+            if closed.isclosed() and not closed.will_close:
+                self.__release(key, connection)
+            else:
+                connection.close()
+
+        return StreamedResponse(url, answer, release)
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
@@ -2,10 +2,30 @@
 # author: Thiago da Cunha Borges
 
 
+import argparse
+import asyncio
+import itertools
 import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib import parse
 
-from crawler import Crawler
-from database import URLDatabase
+from crawler import Crawler, Response
+from database import URLDatabase, LEASE_TIME, MAX_RETRIES, RETRY_DELAY
+from extractor import ENGINES
+from fetcher import AsyncFetcher
+from httppool import HTTPPool
+from metrics import METRICS, MetricsServer, MetricsWriter, PageProfiler
+from pagecache import PageCache
+from pipeline import Pipeline
+from politeness import PolitenessScheduler
+from seenfilter import SeenFilter
+from shards import ShardRouter, SpoolTransport
+from simhash import NearDuplicateIndex
+from sinks import SINKS
+from sitemap import SitemapSeeder
 
 
 MAIN = {
@@ -15,26 +35,265 @@ MAIN = {
 
 
 class Main:
-    def __init__(self, params):
+    def __init__(self, params, wal=False, seen_memory=8 * 1024 * 1024, engine='soup', recrawl=False,
+                 cache_dir=None, cache_compression='gzip', polite=False, max_rate=10.0, parsers=0,
+                 quiet=False, metrics_file=None, metrics_interval=10.0, metrics_port=None, profile_every=0,
+                 sitemap=False, sitemap_only=False, refresh=0, shard=0, shards=1, spool_dir=None,
+                 shard_wait=30.0, output='csv', max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY,
+                 queue_size=64, max_memory=64 * 1024 * 1024, compact=False, compact_every=0,
+                 near_duplicates=10000, skip_duplicates=False, parse_pool=None, http_pool=None):
         """
         Main class, responsible to run the crawler correctly.
 
         :param params: dict with domain and product pattern
 
         :type params: dict
+
+        :param wal: if True, the database uses the write ahead log journal
+
+        :type wal: bool
+
+        :param seen_memory: bytes used to remember the urls already in the
+        database without reading it, 0 disables the seen filter
+
+        :type seen_memory: int
+
+        :param engine: how the crawler processes the web pages, 'soup' or 'stream'
+
+        :type engine: str
+
+        :param recrawl: if True, the web pages already visited are read again,
+        asking the server if they changed since the last search
+
+        :type recrawl: bool
+
+        :param cache_dir: directory where the web pages are saved compressed,
+        if it is None the web pages are not saved
+
+        :type cache_dir: str
+
+        :param cache_compression: 'gzip' or 'zstd'
+
+        :type cache_compression: str
+
+        :param polite: if True, the robots.txt of the web site is followed and
+        the requests are adapted to how fast the web site answers
+
+        :type polite: bool
+
+        :param max_rate: maximum of web pages opened per second when polite is True
+
+        :type max_rate: float
+
+        :param parsers: amount of processes that process the web pages content,
+        0 processes them in the same thread that downloaded them
+
+        :type parsers: int
+
+        :param quiet: if True, the status of the search and the products found
+        are not shown
+
+        :type quiet: bool
+
+        :param metrics_file: file where the metrics of the search are saved from
+        time to time, in the Prometheus format if it ends with '.prom' and in
+        json otherwise
+
+        :type metrics_file: str
+
+        :param metrics_interval: seconds between two saves of the metrics file
+
+        :type metrics_interval: float
+
+        :param metrics_port: local port where the metrics are answered by http
+
+        :type metrics_port: int
+
+        :param profile_every: one web page in each profile_every is profiled with
+        cProfile, 0 disables the profiler
+
+        :type profile_every: int
+
+        :param sitemap: if True, the urls listed in the sitemaps of the web site
+        are inserted in the database before the search
+
+        :type sitemap: bool
+
+        :param sitemap_only: if True, the sitemaps are read and only the product
+        urls found in the web pages are followed
+
+        :type sitemap_only: bool
+
+        :param refresh: maximum of visited urls read again, the ones whose web
+        pages probably changed, products first; 0 does not read them again
+
+        :type refresh: int
+
+        :param shard: the shard of the urls read by this node, from 0 to shards - 1
+
+        :type shard: int
+
+        :param shards: amount of nodes that share the search, each one reads
+        the urls whose hash falls in its shard
+
+        :type shards: int
+
+        :param spool_dir: directory shared by the nodes where the urls found
+        for the other shards are sent
+
+        :type spool_dir: str
+
+        :param shard_wait: seconds that a node without unvisited urls waits for
+        the urls sent by the other nodes before the search ends
+
+        :type shard_wait: float
+
+        :param output: the format of the products file, 'csv', 'jsonl' (gzip
+        json lines) or 'parquet'
+
+        :type output: str
+
+        :param max_retries: attempts of a web page with transient errors, as
+        timeouts and 5xx statuses, before it is kept as failed
+
+        :type max_retries: int
+
+        :param retry_delay: seconds waited before the first new attempt of a
+        web page, doubled after each failure
+
+        :type retry_delay: float
+
+        :param queue_size: maximum of urls between the stages of the search
+
+        :type queue_size: int
+
+        :param max_memory: maximum of bytes of web pages kept between the
+        stages of the search
+
+        :type max_memory: int
+
+        :param compact: if True, a new database saves the urls without their
+        repeated scheme and host, in a table without rowid
+
+        :type compact: bool
+
+        :param compact_every: after each compact_every web pages that are not
+        products, the visited ones are kept only by their fingerprints, 0
+        keeps them; the compacted web pages are not read again
+
+        :type compact_every: int
+
+        :param near_duplicates: amount of web pages remembered to find the near
+        duplicate ones, as the sorts and filters of a category; the urls of a
+        url pattern that gives near duplicates are read last; 0 does not look
+        for near duplicates
+
+        :type near_duplicates: int
+
+        :param skip_duplicates: if True, the urls of a url pattern that gives
+        near duplicates are not read
+
+        :type skip_duplicates: bool
+
+        :param parse_pool: parser processes shared with the searches of other
+        web sites, it is not closed with this search; if it is None, the
+        search has its own parsers processes
+
+        :type parse_pool: concurrent.futures.Executor
+
+        :param http_pool: connections shared with the searches of other web
+        sites, if it is None the search has its own connections
+
+        :type http_pool: HTTPPool
         """
+        if shards > 1 and not spool_dir:
+            raise ValueError('a search with many shards needs a spool directory')
+        if output not in SINKS:
+            raise ValueError('unknown output {}, use one of {}'.format(output, ', '.join(SINKS)))
+        if compact_every and (recrawl or refresh):
+            raise ValueError('the compacted web pages can not be read again by recrawl or refresh')
+        # hold the journal option to open other connections with the database
+        self.__wal = wal
+        # the seen filter is shared by all connections with the database
+        self.__seen_filter = SeenFilter(seen_memory) if seen_memory else None
+        # so are the hashes of the web pages read
+        self.__near_duplicates = NearDuplicateIndex(near_duplicates) if near_duplicates else None
+        self.__skip_duplicates = skip_duplicates
+        # hold the limits of the stages of the search
+        self.__parsers = parsers
+        self.__queue_size = queue_size
+        self.__max_memory = max_memory
+        # hold how the web pages with transient errors are tried again
+        self.__max_retries = max_retries
+        self.__retry_delay = retry_delay
+        # hold the format of the products file
+        self.__output = output
+        # the visited web pages are compacted after each compact_every ones
+        self.__compact_every = compact_every
+        self.__visited_pages = itertools.count(1)
         # hold the domain in a attribute
         self.__domain = params['domain']
-        # create a name for database and csv file using the domain
-        self.__file_name = self.domain.replace('https://www.', '').replace('.', '-')
+        # hold if the status of the search is shown
+        self.__quiet = quiet
+        # create a name for database and csv file using the host of the domain
+        host = parse.urlsplit(self.domain).netloc
+        if host.startswith('www.'):
+            host = host[len('www.'):]
+        self.__file_name = host.replace('.', '-').replace(':', '-')
+        # the urls of the other shards are sent to their nodes
+        self.__router = None
+        self.__shard_wait = shard_wait
+        if shards > 1:
+            self.__router = ShardRouter(shard, shards, SpoolTransport(spool_dir))
+            # each node has its own database and csv file
+            self.__file_name += '-shard{}'.format(shard)
+        # hold if only the product urls are followed
+        self.__sitemap_only = sitemap_only
+        # hold if the web pages already visited are read again
+        self.__recrawl = recrawl or refresh > 0
+        # the web pages saved let a page that did not change be processed again
+        page_cache = PageCache(cache_dir, cache_compression) if cache_dir else None
+        # the connections are shared by the crawler and the scheduler, that reads the robots.txt
+        self.__own_http_pool = http_pool is None
+        self.__http_pool = http_pool if http_pool is not None else HTTPPool()
+        # the scheduler is shared by every worker, so the web site sees a single client
+        scheduler = PolitenessScheduler(max_rate, http_pool=self.__http_pool) if polite else None
         # starts the crawler with domain and the csv file name
-        self.__crawler = Crawler(self.domain, self.csv_file_name)
+        self.__crawler = Crawler(self.domain, self.output_file_name, engine=engine, page_cache=page_cache,
+                                 http_pool=self.__http_pool, scheduler=scheduler, quiet=quiet, output=output)
+        # the web pages are processed in other processes, so every core is used
+        self.__own_parse_pool = parse_pool is None
+        if parse_pool is None and parsers:
+            parse_pool = ProcessPoolExecutor(parsers)
+        self.__parse_pool = parse_pool
+        # hold the product pattern to open other connections with the database
+        self.__product_pattern = params['product_pattern']
         # starts the database with database file name and the product pattern
-        self.__database = URLDatabase(self.database_file_name, params['product_pattern'])
+        self.__database = URLDatabase(self.database_file_name, self.__product_pattern, wal,
+                                      self.__seen_filter, self.__router, compact, self.__near_duplicates,
+                                      skip_duplicates)
         # creates the schema of the database
         self.__database.create_schema()
-        # insert the domain in the database
-        self.__database.insert_new_url(self.domain)
+        # insert the domain in the database with the same name its links will have,
+        # with many shards it is sent to the node of its shard
+        root = self.__crawler.canonical(self.domain)
+        self.__database.insert_new_url(root)
+        if recrawl:
+            # the visited and failed web pages become pending, keeping how they were read
+            self.__database.requeue_visited()
+            self.__database.requeue_failed()
+        if refresh:
+            self.refresh(refresh)
+        if (sitemap or sitemap_only) and (self.__router is None or self.__router.owns(root)):
+            # the products listed in the sitemaps do not need the category pages,
+            # only the node of the domain reads them
+            found = SitemapSeeder(self.__crawler, self.__database, products_only=sitemap_only).seed()
+            if not quiet:
+                print('{} urls found in the sitemaps'.format(found))
+        # the metrics of the search can be read while it runs
+        self.__metrics_writer = MetricsWriter(metrics_file, metrics_interval) if metrics_file else None
+        self.__metrics_server = MetricsServer(metrics_port) if metrics_port is not None else None
+        self.__profiler = PageProfiler(profile_every, self.__file_name + '.prof') if profile_every else None
 
     @property
     def domain(self):
@@ -69,53 +328,646 @@ class Main:
         """
         return self.__file_name + '.csv'
 
-    def search_for_products(self):
+    @property
+    def output_file_name(self):
+        """
+        Products file name, with the extension of its format
+
+        :return: the products file name
+
+        :rtype: str
+        """
+        return self.__file_name + SINKS[self.__output].extension
+
+    def refresh(self, amount=None):
+        """
+        Changes to unvisited the visited urls whose web pages probably
+        changed, estimated by how often they changed before.
+
+        :param amount: maximum of urls changed, None changes every due url
+
+        :type amount: int
+
+        :return: amount of urls that will be read again
+
+        :rtype: int
+        """
+        return self.__database.requeue_due(amount)
+
+    def next_refresh(self):
+        """
+        Gets when the first visited url will be due to be read again.
+
+        :return: the time or None if there is no visited url
+
+        :rtype: float
+        """
+        return self.__database.next_due()
+
+    def duplicate_savings(self):
+        """
+        Estimates what the urls skipped because their url pattern gives near
+        duplicate web pages saved, by the mean size and the mean download
+        and processing time of the web pages read.
+
+        :return: dict with the skipped 'pages', the 'bytes' and the 'seconds' saved
+
+        :rtype: dict
+        """
+        skipped = self.__database.skipped()
+        snapshot = METRICS.snapshot()
+        visited = snapshot['counters'].get('pages_visited', 0)
+        page_bytes = snapshot['counters'].get('bytes_downloaded', 0) / visited if visited else 0.0
+        page_seconds = sum(snapshot['stages'][stage]['mean'] for stage in ('fetch', 'parse')
+                           if stage in snapshot['stages'])
+        return {'pages': skipped, 'bytes': skipped * page_bytes, 'seconds': skipped * page_seconds}
+
+    def search_for_products(self, fetchers=1):
         """
         Search for products in the web site.
         Every time a product is found his web page will be open.
+
+        The search is done in stages connected by bounded queues: the urls
+        are claimed from the database (dequeue), downloaded (fetch),
+        processed (parse) and saved with the urls found (persist). Only
+        this thread uses the database, and the pipeline limits how many
+        urls and bytes of web pages are kept between the stages, so the
+        memory does not grow with the web site.
+
+        :param fetchers: amount of threads that download the web pages
+
+        :type fetchers: int
         """
+        pipeline = Pipeline(self.fetch_stage, self.parse_stage, fetchers, max(1, self.__parsers),
+                            self.__queue_size, self.__max_memory, self.failed_stage)
+        worker = self.__worker_id('pipeline')
         # just show search details
         self.show_status()
-        # search for urls while has urls unvisited
-        while self.__database.has_unvisited():
-            # gives preferences to product urls
-            if self.__database.has_unvisited_product():
-                self.__search_in_product_url()
+        try:
+            while True:
+                self.__dequeue(pipeline, worker)
+                if pipeline.empty():
+                    # search for urls while has urls unvisited
+                    if not self.__has_unvisited(self.__database):
+                        break
+                    continue
+                done = pipeline.result(timeout=1.0)
+                if done is None:
+                    continue
+                self.persist(*done)
+        finally:
+            pipeline.close()
+            # the urls still in the pipeline return to pending
+            self.release_worker(worker)
+
+    def __dequeue(self, pipeline, worker):
+        """
+        Claims unvisited urls and puts them in the pipeline, product urls
+        first. Only two urls for each fetch thread wait to be downloaded, so
+        a claimed url does not wait longer than its lease, and they are
+        claimed in blocks, so the database is not written for every url.
+
+        :param pipeline: the pipeline of the search
+
+        :type pipeline: Pipeline
+
+        :param worker: the identification used to claim the urls
+
+        :type worker: str
+        """
+        if not pipeline.empty() and pipeline.waiting() > pipeline.fetchers:
+            return
+        for item in self.claim(worker, min(pipeline.free, pipeline.fetchers * 2 - pipeline.waiting())):
+            pipeline.put(item)
+
+    def claim(self, worker, amount):
+        """
+        Claims unvisited urls to be read by a pipeline, product urls first.
+
+        :param worker: the identification used to claim the urls
+
+        :type worker: str
+
+        :param amount: maximum of urls claimed
+
+        :type amount: int
+
+        :return: list of tuples with the url, if it is a product and its validators
+
+        :rtype: list
+        """
+        self.__receive(self.__database)
+        items = []
+        for product in (True, False):
+            if amount - len(items) <= 0:
+                break
+            for url in self.__database.claim_batch(worker, amount - len(items), product):
+                items.append((url, product) + self.__validators(self.__database, url))
+        return items
+
+    def persist(self, item, response, page):
+        """
+        Saves a web page that finished the parse stage of a pipeline.
+
+        :param item: tuple with the url, if it is a product and its validators
+
+        :type item: tuple
+
+        :param response: the downloaded web page
+
+        :type response: Response
+
+        :param page: the processed web page or None if it was not processed
+
+        :type page: ParsedPage
+        """
+        url, product, etag, last_modified, content_hash = item
+        self.__profiled(self.__save_response, self.__database, response, product, content_hash, page)
+        if not product:
+            # show search details
+            self.show_status()
+
+    def has_work(self):
+        """
+        Checks, without waiting, if there are urls to be read now or waiting
+        to be tried again.
+
+        :rtype: bool
+        """
+        self.__receive(self.__database)
+        self.__database.release_due_retries()
+        return self.__database.has_unvisited() or self.__database.next_attempt() is not None
+
+    def release_worker(self, worker):
+        """
+        Returns to pending the urls claimed by a pipeline that stopped.
+
+        :param worker: the identification used to claim the urls
+
+        :type worker: str
+        """
+        self.__database.release_worker(worker)
+
+    def fetch_stage(self, item):
+        """
+        Downloads the web page of a url claimed, in a fetch thread.
+
+        :param item: tuple with the url, if it is a product and its validators
+
+        :type item: tuple
+
+        :rtype: Response
+        """
+        url, product, etag, last_modified, content_hash = item
+        return self.__crawler.fetch(url, etag, last_modified)
+
+    def parse_stage(self, item, response):
+        """
+        Processes a downloaded web page, in a parse thread.
+
+        :param item: tuple with the url, if it is a product and its validators
+
+        :type item: tuple
+
+        :param response: the downloaded web page
+
+        :type response: Response
+
+        :return: the processed web page or None if it does not need to be processed
+
+        :rtype: ParsedPage
+        """
+        url, product, etag, last_modified, content_hash = item
+        if response.transient or not self.__must_parse(response, product, content_hash):
+            return None
+        return self.__parse(response.content)
+
+    def failed_stage(self, item, response, error):
+        """
+        Gets the Response persisted for a url whose fetch or parse stage
+        raised an exception, so only this url waits to be tried again, and
+        is failed after too many attempts, while the search goes on.
+
+        :param item: tuple with the url, if it is a product and its validators
+
+        :type item: tuple
+
+        :param response: the downloaded web page, None if it was not downloaded
+
+        :type response: Response
+
+        :param error: the exception raised by the stage
+
+        :type error: Exception
+
+        :rtype: Response
+        """
+        url = item[0]
+        print('It was not possible process {}: {}'.format(url, error))
+        return Response(url, response.status if response else 0, error='{}: {}'.format(type(error).__name__, error),
+                        transient=True)
+
+    def __receive(self, database):
+        """
+        Inserts in the database the urls that the other nodes sent to the
+        shard of this node, looking for them from time to time.
+
+        :param database: the connection with the database
+
+        :type database: URLDatabase
+        """
+        if self.__router is not None:
+            database.insert_url_list(self.__router.poll())
+
+    def __has_unvisited(self, database):
+        """
+        Checks if there are unvisited urls, inserting the urls that the
+        other nodes sent to this shard. When only urls waiting to be tried
+        again are left, it waits for the first of them. A node without
+        unvisited urls waits for the other nodes before the search ends.
+
+        :param database: the connection with the database
+
+        :type database: URLDatabase
+
+        :rtype: bool
+        """
+        while True:
+            self.__receive(database)
+            database.release_due_retries()
+            if database.has_unvisited():
+                return True
+            due = database.next_attempt()
+            if due is None:
+                break
+            # only the urls with transient errors are left
+            time.sleep(min(max(0.0, due - time.time()), 1.0))
+        if self.__router is None:
+            return False
+        # the urls found for the other nodes may be the ones they are waiting for
+        self.__router.flush()
+        deadline = time.monotonic() + self.__shard_wait
+        while time.monotonic() < deadline:
+            time.sleep(0.5)
+            database.insert_url_list(self.__router.receive())
+            if database.has_unvisited():
+                return True
+        return False
+
+    def __validators(self, database, url):
+        """
+        Gets how a web page was the last time it was read, only when the
+        site is being read again.
+
+        :param database: the connection with the database
+
+        :type database: URLDatabase
+
+        :param url: the url of the web page
+
+        :type url: str
+
+        :return: a tuple with the ETag, the Last-Modified and the content hash
+
+        :rtype: tuple
+        """
+        return database.get_validators(url) if self.__recrawl else (None, None, None)
+
+    def __visit(self, database, url, product):
+        """
+        Opens a web page, asking the server if it changed when the site is
+        being read again, and saves it.
+
+        :param database: the connection with the database
+
+        :type database: URLDatabase
+
+        :param url: the url of the web page
+
+        :type url: str
+
+        :param product: True if the url is a product url
+
+        :type product: bool
+        """
+        def visit():
+            etag, last_modified, content_hash = self.__validators(database, url)
+            response = self.__crawler.fetch(url, etag, last_modified)
+            self.__save_response(database, response, product, content_hash)
+
+        self.__profiled(visit)
+
+    def __profiled(self, function, *arguments):
+        """
+        Calls a function that processes a web page, with the profiler if
+        there is one.
+
+        :param function: the function called
+
+        :type function: callable
+
+        :return: what the function returns
+        """
+        if self.__profiler is None:
+            return function(*arguments)
+        return self.__profiler.run(function, *arguments)
+
+    @staticmethod
+    def __must_parse(response, product, content_hash):
+        """
+        Checks if an opened web page must be processed.
+        The urls of a web page that did not change are already in the
+        database, so it is only processed again if it is a product whose
+        content is known.
+
+        :param response: the opened web page
+
+        :type response: Response
+
+        :param product: True if the url is a product url
+
+        :type product: bool
+
+        :param content_hash: the hash of the web page content the last time it was read
+
+        :type content_hash: str
+
+        :rtype: bool
+        """
+        unchanged = response.status == 304 or (response.content and response.content_hash == content_hash)
+        return not unchanged or bool(product and response.content)
+
+    def __parse(self, content):
+        """
+        Processes the content of a web page, in a parser process if there
+        are parser processes.
+
+        :param content: the web page content
+
+        :type content: bytes
+
+        :rtype: ParsedPage
+        """
+        if self.__parse_pool is None:
+            return self.__crawler.parse_page(content)
+        return self.__parse_pool.submit(self.__crawler.extract, content).result()
+
+    def __save_response(self, database, response, product, content_hash=None, page=None):
+        """
+        Processes an opened web page, saving its data if it is a product
+        and the urls found in it.
+
+        :param database: the connection with the database
+
+        :type database: URLDatabase
+
+        :param response: the opened web page
+
+        :type response: Response
+
+        :param product: True if the url is a product url
+
+        :type product: bool
+
+        :param content_hash: the hash of the web page content the last time it was read
+
+        :type content_hash: str
+
+        :param page: the web page already processed, if it is None it is processed here
+
+        :type page: ParsedPage
+        """
+        url = response.url
+        if response.transient:
+            # the url waits to be tried again without blocking the others
+            if database.retry_later(url, response.error, max_retries=self.__max_retries,
+                                    delay=self.__retry_delay):
+                METRICS.count('fetch_retries')
             else:
-                self.__search_in_not_product_url()
-                # show search details
+                METRICS.count('urls_failed')
+            return
+        # the validators are only saved when the server sent the whole web page
+        validators = ()
+        if response.status == 200:
+            validators = (response.etag, response.last_modified, response.content_hash)
+        # the time is saved only when the server answered how the web page is
+        fetched = time.time() if response.status in (200, 304) else None
+        METRICS.count('pages_visited')
+        if not self.__must_parse(response, product, content_hash):
+            METRICS.count('pages_unchanged')
+            database.set_visited(url, (), *validators, fetched=fetched, error=response.error)
+            return
+        if page is None:
+            page = self.__parse(response.content)
+        if product:
+            # save the data of file in the csv
+            self.__crawler.save_data(page, url)
+        url_list = self.__crawler.get_product_urls(page, response.final_url)
+        if self.__sitemap_only:
+            # the category pages are not needed when the sitemaps list the products
+            url_list = [found for found in url_list if database.is_product(found)]
+        simhash = None
+        if not product and self.__near_duplicates is not None:
+            # the near duplicate web pages of a url pattern make its other urls be read last
+            simhash = self.__crawler.page_simhash(page, url_list)
+        # sets url as visited inserting the url list in the same transaction
+        database.set_visited(url, url_list, *validators, fetched=fetched, error=response.error, simhash=simhash)
+        if not product and self.__compact_every and next(self.__visited_pages) % self.__compact_every == 0:
+            METRICS.count('urls_compacted', database.compact_visited())
+
+    def search_for_products_async(self, concurrency=10, per_host=None):
+        """
+        Search for products in the web site keeping many web pages
+        being downloaded at the same time.
+        Product urls still have preference to be downloaded.
+
+        :param concurrency: maximum of web pages being downloaded at the same time
+
+        :type concurrency: int
+
+        :param per_host: maximum of web pages being downloaded from the same host
+
+        :type per_host: int
+        """
+        fetcher = AsyncFetcher(self.__crawler.fetch, concurrency, per_host)
+        loop = asyncio.new_event_loop()
+        try:
+            # just show search details
+            self.show_status()
+            loop.run_until_complete(self.__crawl_async(fetcher))
+        finally:
+            loop.close()
+            fetcher.close()
+
+    async def __crawl_async(self, fetcher):
+        """
+        Keeps the fetcher full of urls and saves each downloaded web page
+        as soon as it is ready.
+
+        :param fetcher: the fetcher that downloads the web pages
+
+        :type fetcher: AsyncFetcher
+        """
+        loop = asyncio.get_event_loop()
+        # each task in flight is mapped to if it is a product url and its last content hash
+        in_flight = {}
+        # each web page being processed is mapped to its response, kind and last content hash
+        parsing = {}
+        # the downloads wait while the parser processes are behind
+        backlog = fetcher.concurrency * 2
+        worker = self.__worker_id('async')
+        while True:
+            if len(parsing) < backlog:
+                self.__fill_fetcher(fetcher, in_flight, worker)
+            # there is no url in flight, no web page being processed and no url unvisited
+            if not in_flight and not parsing:
+                if not self.__has_unvisited(self.__database):
+                    break
+                continue
+            done, _ = await asyncio.wait(list(in_flight) + list(parsing), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task in parsing:
+                    response, product, content_hash = parsing.pop(task)
+                    self.__profiled(self.__save_response, self.__database, response, product, content_hash,
+                                    task.result())
+                else:
+                    product, content_hash = in_flight.pop(task)
+                    response = task.result()
+                    if self.__parse_pool is not None and self.__must_parse(response, product, content_hash):
+                        # the web page is processed by a parser process without blocking the loop
+                        parse_task = loop.run_in_executor(self.__parse_pool, self.__crawler.extract,
+                                                          response.content)
+                        parsing[parse_task] = (response, product, content_hash)
+                        continue
+                    self.__profiled(self.__save_response, self.__database, response, product, content_hash)
+                if not product:
+                    # show search details
+                    self.show_status()
+
+    def __fill_fetcher(self, fetcher, in_flight, worker):
+        """
+        Claims unvisited urls and starts their download until the fetcher
+        is full. Product urls are started first.
+
+        :param fetcher: the fetcher that downloads the web pages
+
+        :type fetcher: AsyncFetcher
+
+        :param in_flight: dict of tasks in flight mapped to its kind and last content hash
+
+        :type in_flight: dict
+
+        :param worker: the identification used to claim the urls
+
+        :type worker: str
+        """
+        self.__receive(self.__database)
+        for product in (True, False):
+            free = fetcher.concurrency - len(in_flight)
+            if free <= 0:
+                return
+            for url in self.__database.claim_batch(worker, free, product):
+                etag, last_modified, content_hash = self.__validators(self.__database, url)
+                task = asyncio.ensure_future(fetcher.fetch(url, etag, last_modified))
+                in_flight[task] = (product, content_hash)
+
+    def search_for_products_parallel(self, workers=4, lease=LEASE_TIME):
+        """
+        Search for products in the web site with many workers sharing the
+        same database file. Each worker claims a url before opening it, so
+        two workers never open the same url, and the urls of a worker that
+        stopped return to the others when its lease expires.
+
+        :param workers: amount of worker threads
+
+        :type workers: int
+
+        :param lease: seconds that a worker can hold a url
+
+        :type lease: float
+        """
+        stop = threading.Event()
+        errors = []
+        threads = [threading.Thread(target=self.__worker, daemon=True,
+                                    args=(self.__worker_id(index), lease, stop, errors))
+                   for index in range(workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                # show search details while the workers are running
                 self.show_status()
+                for thread in threads:
+                    thread.join(timeout=1.0)
+        finally:
+            # allow the workers to finish their current url
+            stop.set()
+        if errors:
+            raise errors[0]
+        self.show_status()
+
+    @staticmethod
+    def __worker_id(index):
+        """
+        Creates a name for a worker that is unique even with many processes
+        or machines sharing the same database file.
+
+        :param index: the worker index in this process
+
+        :type index: int
+
+        :rtype: str
+        """
+        return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), index)
+
+    def __worker(self, worker, lease, stop, errors):
+        """
+        Claims urls from the database and processes them until there is no
+        url pending nor in flight.
+
+        :param worker: the worker identification
+
+        :type worker: str
+
+        :param lease: seconds that the worker can hold a url
+
+        :type lease: float
+
+        :param stop: event set when the search must be stopped
+
+        :type stop: threading.Event
 
-    def __search_in_product_url(self):
-        """
-        Search for urls in product urls and save
-        its title, name and url in the csv file.
-        """
-        # get a unvisited product url from database
-        url = self.__database.get_unvisited_product()
-        # get the open page with crawler
-        page = self.__crawler.get_page(url)
-        # save the data of file in the csv
-        self.__crawler.save_data(page, url)
-        # get the url list of the opened web page
-        url_list = self.__crawler.get_product_urls(page)
-        # inserts the url list in the database
-        self.__database.insert_url_list(url_list)
-        # sets the url as visited
-        self.__database.set_visited(url)
-
-    def __search_in_not_product_url(self):
-        """
-        Does the search for urls in a not product url.
-        """
-        # get one unvisited url from the database
-        url = self.__database.get_unvisited_url()
-        # get a list of urls presents in the web page
-        url_list = self.__crawler.get_links_list(url)
-        # inserts the url list in the database
-        self.__database.insert_url_list(url_list)
-        # sets url as visited
-        self.__database.set_visited(url)
+        :param errors: list where the worker saves the exception that stopped it
+
+        :type errors: list
+        """
+        database = None
+        try:
+            # each thread needs its own connection with the database
+            database = URLDatabase(self.database_file_name, self.__product_pattern, self.__wal,
+                                   self.__seen_filter, self.__router, near_duplicates=self.__near_duplicates,
+                                   skip_duplicates=self.__skip_duplicates)
+            while not stop.is_set():
+                self.__receive(database)
+                # gives preferences to product urls
+                product = True
+                url = database.claim(worker, True, lease)
+                if url is None:
+                    product = False
+                    url = database.claim(worker, False, lease)
+                if url is None:
+                    # another worker or another node can still find new urls
+                    if not database.has_in_flight() and not self.__has_unvisited(database):
+                        break
+                    time.sleep(0.5)
+                    continue
+                self.__visit(database, url, product)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if database:
+                database.close()
 
     def close_database(self):
         """
@@ -123,12 +975,33 @@ class Main:
         """
         self.__database.close()
 
+    def close(self):
+        """
+        Writes the products still in memory in the csv file and closes the database.
+        """
+        if self.__parse_pool is not None and self.__own_parse_pool:
+            self.__parse_pool.shutdown()
+        self.__parse_pool = None
+        self.__crawler.close()
+        if self.__own_http_pool:
+            self.__http_pool.close()
+        if self.__router is not None:
+            # the urls found for the other nodes are not lost
+            self.__router.flush()
+        if self.__metrics_writer is not None:
+            self.__metrics_writer.close()
+            self.__metrics_writer = None
+        if self.__metrics_server is not None:
+            self.__metrics_server.close()
+            self.__metrics_server = None
+        self.close_database()
+
     def delete_database(self):
         """
         Ask user if he wants to delete the database file
         and delete it or not.
         """
-        self.close_database()
+        self.close()
         if self.__confirmation('Would you want to delete the database [Y/N]? '):
             try:
                 # Delete the database file.
@@ -157,18 +1030,35 @@ class Main:
             return True
         return False
 
+    def status(self):
+        """
+        Gets the amounts of urls of the search.
+
+        :return: dict with the amount of 'urls', 'unvisited' urls, product
+        urls ('products') and 'unvisited_products'
+
+        :rtype: dict
+        """
+        return {
+            # gets the total of urls from the database
+            'urls': self.__database.total(),
+            # gets the amount of unvisited urls in the database
+            'unvisited': self.__database.unvisited(),
+            # gets the amount of product urls in the database
+            'products': self.__database.total_products(),
+            # gets the amount of unvisited product urls in the database
+            'unvisited_products': self.__database.unvisited_product(),
+        }
+
     def show_status(self):
         """
         Show to user the status of the search.
         """
-        # gets the total of urls from the database
-        total = self.__database.total()
-        # gets the amount of unvisited urls in the database
-        total_unvisited = self.__database.unvisited()
-        # gets the amount of product urls in the database
-        products = self.__database.total_products()
-        # gets the amount of unvisited product urls in the database
-        products_unvisted = self.__database.unvisited_product()
+        if self.__quiet:
+            return
+        status = self.status()
+        total, total_unvisited = status['urls'], status['unvisited']
+        products, products_unvisted = status['products'], status['unvisited_products']
         # calculates the percentage of visited urls avoiding the division by zero
         percent_total = (total - total_unvisited) / total * 100 if total != 0 else 0
         # calculates the percentage of visited product urls avoiding the division by zero
@@ -188,27 +1078,168 @@ class Main:
         print(message)
 
 
+def parse_arguments():
+    """
+    Reads the command line arguments.
+
+    :rtype: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description='Search for products in a web site.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='web pages downloaded at the same time (default: 1)')
+    parser.add_argument('--per-host', type=int, default=None,
+                        help='web pages downloaded at the same time from the same host')
+    parser.add_argument('--wal', action='store_true',
+                        help='use the sqlite write ahead log journal with synchronous NORMAL')
+    parser.add_argument('--seen-memory', type=int, default=8,
+                        help='megabytes used to remember the urls already found, 0 disables it (default: 8)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='soup',
+                        help='how the web pages are processed (default: soup)')
+    parser.add_argument('--fetchers', type=int, default=1,
+                        help='threads that download the web pages in the staged search (default: 1)')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='maximum of urls between the stages of the search (default: 64)')
+    parser.add_argument('--max-memory', type=int, default=64,
+                        help='megabytes of web pages kept between the stages of the search (default: 64)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='workers sharing the database file (default: 1)')
+    parser.add_argument('--recrawl', action='store_true',
+                        help='read again the web pages visited, downloading only the ones that changed')
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory where the web pages are saved compressed')
+    parser.add_argument('--cache-compression', choices=['gzip', 'zstd'], default='gzip',
+                        help='compression of the saved web pages (default: gzip)')
+    parser.add_argument('--polite', action='store_true',
+                        help='follow robots.txt and adapt the speed to the web site answers')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='maximum of web pages opened per second with --polite (default: 10)')
+    parser.add_argument('--parsers', type=int, default=0,
+                        help='processes that process the web pages, 0 uses the download thread (default: 0)')
+    parser.add_argument('--metrics-file', default=None,
+                        help='file where the metrics are saved, Prometheus format if it ends with .prom, '
+                             'json otherwise')
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help='seconds between two saves of the metrics file (default: 10)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='local port that answers the metrics in /metrics and /metrics.json')
+    parser.add_argument('--profile-every', type=int, default=0,
+                        help='profile one web page in each N with cProfile, 0 disables it (default: 0)')
+    parser.add_argument('--sitemap', action='store_true',
+                        help='insert the urls of the web site sitemaps before the search')
+    parser.add_argument('--sitemap-only', action='store_true',
+                        help='insert the urls of the sitemaps and follow only product urls')
+    parser.add_argument('--refresh', type=int, default=0,
+                        help='read again up to N visited urls that probably changed, products first, '
+                             'and keep the database (default: 0)')
+    parser.add_argument('--forever', action='store_true',
+                        help='after the search, wait for the next urls due and read them again')
+    parser.add_argument('--output', choices=sorted(SINKS), default='csv',
+                        help='format of the products file, jsonl is gzip json lines and parquet needs '
+                             'pyarrow (default: csv)')
+    parser.add_argument('--max-retries', type=int, default=MAX_RETRIES,
+                        help='attempts of a web page with timeouts or 5xx errors before it is failed '
+                             '(default: {})'.format(MAX_RETRIES))
+    parser.add_argument('--retry-delay', type=float, default=RETRY_DELAY,
+                        help='seconds before the first new attempt of a web page, doubled after each '
+                             'failure (default: {})'.format(RETRY_DELAY))
+    parser.add_argument('--compact', action='store_true',
+                        help='save the urls of a new database without their scheme and host')
+    parser.add_argument('--compact-every', type=int, default=0,
+                        help='keep only fingerprints of the visited web pages that are not products, after '
+                             'each N of them; they are not read again (default: 0)')
+    parser.add_argument('--near-duplicates', type=int, default=10000,
+                        help='web pages remembered to find near duplicates, whose url patterns are read '
+                             'last, 0 disables it (default: 10000)')
+    parser.add_argument('--skip-duplicates', action='store_true',
+                        help='do not read the urls of url patterns that give near duplicate web pages')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='nodes sharing the search, each one reads the urls of its shard (default: 1)')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='the shard read by this node, from 0 to shards - 1 (default: 0)')
+    parser.add_argument('--spool-dir', default=None,
+                        help='directory shared by the nodes where the urls of each shard are sent')
+    parser.add_argument('--shard-wait', type=float, default=30.0,
+                        help='seconds a node without urls waits for the other nodes (default: 30)')
+    parser.add_argument('--sites', default=None,
+                        help='json file with a list of web sites searched together, each one with its '
+                             'domain, product_pattern and optional output')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    # creates the Main class object
-    main = Main(MAIN)
+    arguments = parse_arguments()
+    if arguments.sites:
+        # multisite uses Main, so it is only imported when many web sites are searched
+        from multisite import MultiSite, load_sites
+        # the web sites share the fetch threads, the parsers and the connections
+        main = MultiSite(load_sites(arguments.sites), arguments.fetchers, arguments.parsers,
+                         arguments.queue_size, arguments.max_memory * 1024 * 1024,
+                         metrics_file=arguments.metrics_file, metrics_interval=arguments.metrics_interval,
+                         metrics_port=arguments.metrics_port, wal=arguments.wal,
+                         seen_memory=arguments.seen_memory * 1024 * 1024, engine=arguments.engine,
+                         recrawl=arguments.recrawl, cache_dir=arguments.cache_dir,
+                         cache_compression=arguments.cache_compression, polite=arguments.polite,
+                         max_rate=arguments.rate, sitemap=arguments.sitemap,
+                         sitemap_only=arguments.sitemap_only, refresh=arguments.refresh,
+                         output=arguments.output, max_retries=arguments.max_retries,
+                         retry_delay=arguments.retry_delay, compact=arguments.compact,
+                         compact_every=arguments.compact_every, near_duplicates=arguments.near_duplicates,
+                         skip_duplicates=arguments.skip_duplicates)
+    else:
+        # creates the Main class object
+        main = Main(MAIN, arguments.wal, arguments.seen_memory * 1024 * 1024, arguments.engine,
+                    arguments.recrawl, arguments.cache_dir, arguments.cache_compression, arguments.polite,
+                    arguments.rate, arguments.parsers, metrics_file=arguments.metrics_file,
+                    metrics_interval=arguments.metrics_interval, metrics_port=arguments.metrics_port,
+                    profile_every=arguments.profile_every, sitemap=arguments.sitemap,
+                    sitemap_only=arguments.sitemap_only, refresh=arguments.refresh, shard=arguments.shard,
+                    shards=arguments.shards, spool_dir=arguments.spool_dir, shard_wait=arguments.shard_wait,
+                    output=arguments.output, max_retries=arguments.max_retries,
+                    retry_delay=arguments.retry_delay, queue_size=arguments.queue_size,
+                    max_memory=arguments.max_memory * 1024 * 1024, compact=arguments.compact,
+                    compact_every=arguments.compact_every, near_duplicates=arguments.near_duplicates,
+                    skip_duplicates=arguments.skip_duplicates)
     try:
-        # does the search for product urls
-        main.search_for_products()
+        while True:
+            # does the search for product urls
+            if arguments.sites:
+                main.search_for_products()
+            elif arguments.workers > 1:
+                main.search_for_products_parallel(arguments.workers)
+            elif arguments.concurrency > 1:
+                main.search_for_products_async(arguments.concurrency, arguments.per_host)
+            else:
+                main.search_for_products(arguments.fetchers)
+            if not arguments.forever:
+                break
+            # waits until a web page is due to be read again
+            due = main.next_refresh()
+            time.sleep(max(0.0, due - time.time()) if due is not None else 3600.0)
+            main.refresh(arguments.refresh or None)
         print('SEARCH COMPLETED')
+        if arguments.skip_duplicates:
+            savings = main.duplicate_savings()
+            print('{} near duplicate web pages skipped, about {:.1f} MB and {:.1f} s saved'.format(
+                savings['pages'], savings['bytes'] / 1024 / 1024, savings['seconds']))
     # allow search to be stopped at any time and can be resumed later
     except KeyboardInterrupt:
         print('Keyboard Interrupt received.')
         print('Stopping search.')
         input('Press ENTER to finish')
-        # closes the database
-        main.close_database()
+        # saves the products in memory and closes the database
+        main.close()
     except Exception as error:
         # forces the database to be closed in case of some error
         print(error)
         print('It was not possible read all url found. Please, try again.')
         print('The program is able to resume where it stopped. Please, try again.')
         input('Press ENTER to finish')
-        main.close_database()
+        main.close()
     else:
-        # closes and delete the database
-        main.delete_database()
+        if arguments.refresh or arguments.recrawl or arguments.forever:
+            # the database keeps the validators and when each web page changed
+            # for the next conditional recrawl or refresh
+            main.close()
+        else:
+            # closes and delete the database
+            main.delete_database()
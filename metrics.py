@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+# upper limits, in seconds, of the buckets of every histogram
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        """
+        Histogram counts how long the calls of a stage took, in buckets,
+        and how many of them failed.
+        """
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, seconds, error=False):
+        """
+        Adds a call to the histogram.
+
+        :param seconds: how long the call took
+        :param error: True if the call failed
+
+        :type seconds: float
+        :type error: bool
+        """
+        for index, limit in enumerate(BUCKETS):
+            if seconds <= limit:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile of the calls time by the upper limit of its bucket.
+
+        :param fraction: the quantile, between 0 and 1
+
+        :type fraction: float
+
+        :rtype: float
+        """
+        wanted = fraction * self.count
+        seen = 0
+        for index, amount in enumerate(self.buckets):
+            seen += amount
+            if amount and seen >= wanted:
+                return BUCKETS[index]
+        return 0.0
+
+    def summary(self):
+        """
+        Gets the histogram as a dict.
+
+        :rtype: dict
+        """
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'error_rate': self.errors / self.count if self.count else 0.0,
+            'seconds': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': {str(limit): amount for limit, amount in zip(BUCKETS, self.buckets)},
+        }
+
+
+class Timer:
+    def __init__(self, metrics, name):
+        """
+        Timer measures a block of code as one call of a stage.
+        The call is counted as an error if the block raises an exception or
+        if failed is set True inside it.
+
+        :type metrics: Metrics
+        :type name: str
+        """
+        self.__metrics = metrics
+        self.__name = name
+        self.__start = None
+        self.failed = False
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.__metrics.observe(self.__name, time.perf_counter() - self.__start,
+                               self.failed or error_type is not None)
+        return False
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Metrics keeps a latency histogram for each stage of the search and
+        counters of what was found. It can be used by many threads.
+        """
+        self.__histograms = {}
+        self.__counters = {}
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+
+    def timer(self, name):
+        """
+        Measures a block of code, used in a with statement.
+
+        :param name: the stage name
+
+        :type name: str
+
+        :rtype: Timer
+        """
+        return Timer(self, name)
+
+    def observe(self, name, seconds, error=False):
+        """
+        Adds a call to the histogram of a stage.
+
+        :param name: the stage name
+        :param seconds: how long the call took
+        :param error: True if the call failed
+
+        :type name: str
+        :type seconds: float
+        :type error: bool
+        """
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = Histogram()
+            histogram.observe(seconds, error)
+
+    def count(self, name, amount=1):
+        """
+        Adds an amount to a counter.
+
+        :param name: the counter name
+        :param amount: the amount added
+
+        :type name: str
+        :type amount: int
+        """
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        Gets all the metrics as a dict.
+
+        :rtype: dict
+        """
+        with self.__lock:
+            return {
+                'uptime': time.time() - self.__started,
+                'counters': dict(self.__counters),
+                'stages': {name: histogram.summary() for name, histogram in self.__histograms.items()},
+            }
+
+    def reset(self):
+        """
+        Forgets every measure.
+        """
+        with self.__lock:
+            self.__histograms = {}
+            self.__counters = {}
+            self.__started = time.time()
+
+    def to_json(self):
+        """
+        Gets all the metrics as a json text.
+
+        :rtype: str
+        """
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Gets all the metrics in the Prometheus text format.
+
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        lines = ['# TYPE crawler_uptime_seconds gauge', 'crawler_uptime_seconds {}'.format(snapshot['uptime'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE crawler_{}_total counter'.format(name))
+            lines.append('crawler_{}_total {}'.format(name, value))
+        stages = sorted(snapshot['stages'].items())
+        if stages:
+            lines.append('# TYPE crawler_stage_seconds histogram')
+        for name, summary in stages:
+            cumulative = 0
+            for limit in BUCKETS:
+                cumulative += summary['buckets'][str(limit)]
+                le = '+Inf' if limit == float('inf') else repr(limit)
+                lines.append('crawler_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, le, cumulative))
+            lines.append('crawler_stage_seconds_sum{{stage="{}"}} {}'.format(name, summary['seconds']))
+            lines.append('crawler_stage_seconds_count{{stage="{}"}} {}'.format(name, summary['count']))
+        if stages:
+            lines.append('# TYPE crawler_stage_errors_total counter')
+        for name, summary in stages:
+            lines.append('crawler_stage_errors_total{{stage="{}"}} {}'.format(name, summary['errors']))
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of the whole program, used by every module
+METRICS = Metrics()
+
+
+class MetricsWriter:
+    def __init__(self, file_name, interval=10.0, metrics=METRICS):
+        """
+        MetricsWriter saves the metrics in a file from time to time, in the
+        Prometheus text format if the file name ends with '.prom' and in
+        json otherwise.
+
+        :param file_name: the file where the metrics are saved
+        :param interval: seconds between two saves
+        :param metrics: the metrics saved
+
+        :type file_name: str
+        :type interval: float
+        :type metrics: Metrics
+        """
+        self.__file_name = file_name
+        self.__interval = interval
+        self.__metrics = metrics
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def write(self):
+        """
+        Saves the metrics now. A reader never gets half a file.
+        """
+        if self.__file_name.endswith('.prom'):
+            text = self.__metrics.to_prometheus()
+        else:
+            text = self.__metrics.to_json()
+        temporary = '{}.{}.tmp'.format(self.__file_name, os.getpid())
+        try:
+            with open(temporary, 'w', encoding='utf-8') as metrics_file:
+                metrics_file.write(text)
+            os.replace(temporary, self.__file_name)
+        except IOError as e:
+            print('It was not possible save the metrics: {}'.format(e))
+
+    def __run(self):
+        while not self.__stop.wait(self.__interval):
+            self.write()
+
+    def close(self):
+        """
+        Stops saving the metrics, saving them a last time.
+        """
+        self.__stop.set()
+        self.__thread.join()
+        self.write()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path == '/metrics':
+            content, content_type = metrics.to_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            content, content_type = metrics.to_json(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        content = content.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, metrics=METRICS, host='127.0.0.1'):
+        """
+        MetricsServer answers the metrics in http://host:port/metrics, in
+        the Prometheus text format, and in /metrics.json.
+
+        :param port: the port, 0 chooses a free one
+        :param metrics: the metrics answered
+        :param host: the address listened
+
+        :type port: int
+        :type metrics: Metrics
+        :type host: str
+        """
+        super().__init__((host, port), MetricsHandler)
+        self.metrics = metrics
+        self.__thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def close(self):
+        """
+        Stops answering the metrics.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class PageProfiler:
+    def __init__(self, every, file_name):
+        """
+        PageProfiler runs cProfile in one of each amount of web pages and
+        saves the statistics of all profiled web pages in a file, that can
+        be read with pstats.
+
+        :param every: one web page is profiled in each 'every' web pages
+        :param file_name: the file where the statistics are saved
+
+        :type every: int
+        :type file_name: str
+        """
+        if every < 1:
+            raise ValueError('every must be at least 1')
+        self.__every = every
+        self.__file_name = file_name
+        self.__pages = 0
+        self.__stats = None
+        self.__lock = threading.Lock()
+        # cProfile can not profile two calls at the same time
+        self.__profiling = False
+
+    def run(self, function, *arguments):
+        """
+        Calls a function that processes a web page, profiling it if it is
+        its turn.
+
+        :param function: the function called
+
+        :type function: callable
+
+        :return: what the function returns
+        """
+        with self.__lock:
+            self.__pages += 1
+            sampled = self.__pages % self.__every == 0 and not self.__profiling
+            if sampled:
+                self.__profiling = True
+        if not sampled:
+            return function(*arguments)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *arguments)
+        finally:
+            with self.__lock:
+                if self.__stats is None:
+                    self.__stats = pstats.Stats(profile)
+                else:
+                    self.__stats.add(profile)
+                self.__stats.dump_stats(self.__file_name)
+                self.__profiling = False
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from httppool import HTTPPool
+from main import Main
+from metrics import METRICS, MetricsServer, MetricsWriter
+from pipeline import Pipeline
+from sinks import SINKS
+
+# seconds between two updates of the status of the sites
+STATUS_INTERVAL = 1.0
+
+# the counters of each web site that only grow, the others are amounts of urls
+SITE_COUNTERS = ('pages', 'bytes', 'errors')
+SITE_GAUGES = ('urls', 'unvisited', 'products', 'unvisited_products')
+
+
+def load_sites(file_name):
+    """
+    Reads the web sites searched together from a json file with a list of
+    objects, each one with the 'domain' of a web site, the 'product_pattern'
+    of its product urls, a sql LIKE pattern, and, optionally, the 'output'
+    format of its products file:
+
+    [{"domain": "https://www.site.com.br", "product_pattern": "https://www.site.com.br%/p",
+      "output": "jsonl"}]
+
+    :param file_name: the json file name
+
+    :type file_name: str
+
+    :return: list of dicts with the configuration of each web site
+
+    :rtype: list
+    """
+    with open(file_name, encoding='utf-8') as sites_file:
+        sites = json.load(sites_file)
+    if not isinstance(sites, list) or not sites:
+        raise ValueError('{} must have a list of web sites'.format(file_name))
+    domains = set()
+    for site in sites:
+        if not isinstance(site, dict) or not site.get('domain') or not site.get('product_pattern'):
+            raise ValueError('each web site needs a domain and a product_pattern: {}'.format(site))
+        if site.get('output', 'csv') not in SINKS:
+            raise ValueError('unknown output {}, use one of {}'.format(site['output'], ', '.join(SINKS)))
+        if site['domain'] in domains:
+            raise ValueError('the web site {} is repeated'.format(site['domain']))
+        domains.add(site['domain'])
+    return sites
+
+
+class SiteMetrics:
+    def __init__(self, metrics=METRICS):
+        """
+        SiteMetrics adds the counters of each web site of a MultiSite,
+        labeled by its domain, to the metrics of the whole program. The
+        latencies of the stages and the other counters are measured for all
+        the web sites together. It can be given to MetricsWriter and
+        MetricsServer as the metrics saved.
+
+        :param metrics: the metrics of the whole program
+
+        :type metrics: Metrics
+        """
+        self.__metrics = metrics
+        self.__sites = {}
+        self.__lock = threading.Lock()
+
+    def update(self, counters):
+        """
+        Keeps the last counters of each web site. The databases are only
+        used by the thread of the search, so the counters are read by it
+        and not by the thread that saves or answers the metrics.
+
+        :param counters: dict of each domain mapped to its counters, see
+        MultiSite.counters
+
+        :type counters: dict
+        """
+        with self.__lock:
+            self.__sites = {domain: dict(counter) for domain, counter in counters.items()}
+
+    def snapshot(self):
+        """
+        Gets all the metrics as a dict, with the counters of each web site in 'sites'.
+
+        :rtype: dict
+        """
+        snapshot = self.__metrics.snapshot()
+        with self.__lock:
+            snapshot['sites'] = {domain: dict(counter) for domain, counter in self.__sites.items()}
+        return snapshot
+
+    def to_json(self):
+        """
+        Gets all the metrics as a json text.
+
+        :rtype: str
+        """
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        Gets all the metrics in the Prometheus text format, the counters of
+        each web site with a site label.
+
+        :rtype: str
+        """
+        with self.__lock:
+            sites = sorted(self.__sites.items())
+        lines = [self.__metrics.to_prometheus().rstrip('\n')]
+        for kind, names, suffix in (('counter', SITE_COUNTERS, '_total'), ('gauge', SITE_GAUGES, '')):
+            for name in names:
+                metric = 'crawler_site_{}{}'.format(name, suffix)
+                lines.append('# TYPE {} {}'.format(metric, kind))
+                for domain, counter in sites:
+                    lines.append('{}{{site="{}"}} {}'.format(metric, domain, counter.get(name, 0)))
+        return '\n'.join(lines) + '\n'
+
+
+class MultiSite:
+    def __init__(self, sites, fetchers=4, parsers=0, queue_size=64, max_memory=64 * 1024 * 1024, quiet=False,
+                 metrics_file=None, metrics_interval=10.0, metrics_port=None, **options):
+        """
+        MultiSite searches many web sites at the same time in one process.
+        Each web site has its own search, with its own database, products
+        file and counters, and every search shares the same pipeline: the
+        same fetch threads, parse threads, parser processes and connections.
+        The urls are claimed from the web sites in turns, so a big web site
+        does not hold back the others.
+
+        :param sites: list of dicts with the 'domain', the 'product_pattern'
+        and, optionally, the 'output' format of each web site, see load_sites
+
+        :type sites: list
+
+        :param fetchers: amount of threads that download the web pages
+
+        :type fetchers: int
+
+        :param parsers: amount of processes that process the web pages, 0
+        processes them in the parse threads
+
+        :type parsers: int
+
+        :param queue_size: maximum of urls between the stages of the search
+
+        :type queue_size: int
+
+        :param max_memory: maximum of bytes of web pages kept between the
+        stages of the search
+
+        :type max_memory: int
+
+        :param quiet: if True, the status of the sites is not shown
+
+        :type quiet: bool
+
+        :param metrics_file: file where the metrics of every search are saved
+        from time to time, with the counters of each web site, see SiteMetrics
+
+        :type metrics_file: str
+
+        :param metrics_interval: seconds between two saves of the metrics file
+
+        :type metrics_interval: float
+
+        :param metrics_port: local port where the metrics are answered by http
+
+        :type metrics_port: int
+
+        :param options: other arguments of Main used by the search of every
+        web site, as wal, engine, polite or skip_duplicates
+        """
+        self.__fetchers = fetchers
+        self.__parsers = parsers
+        self.__queue_size = queue_size
+        self.__max_memory = max_memory
+        self.__quiet = quiet
+        # the connections and the parser processes are shared by every web site
+        self.__http_pool = HTTPPool()
+        self.__parse_pool = ProcessPoolExecutor(parsers) if parsers else None
+        output = options.pop('output', 'csv')
+        self.__searches = [Main({'domain': site['domain'], 'product_pattern': site['product_pattern']},
+                                output=site.get('output', output), quiet=True, parse_pool=self.__parse_pool,
+                                http_pool=self.__http_pool, **options)
+                           for site in sites]
+        # what each web site read, counted apart
+        self.__counters = [{'pages': 0, 'bytes': 0, 'errors': 0} for _ in sites]
+        self.__site_metrics = SiteMetrics()
+        self.__metrics_writer = (MetricsWriter(metrics_file, metrics_interval, self.__site_metrics)
+                                 if metrics_file else None)
+        self.__metrics_server = (MetricsServer(metrics_port, self.__site_metrics)
+                                 if metrics_port is not None else None)
+
+    @property
+    def searches(self):
+        """
+        The search of each web site, in the order of the sites
+
+        :rtype: list
+        """
+        return list(self.__searches)
+
+    def counters(self):
+        """
+        Gets the counters of each web site.
+
+        :return: dict of each domain mapped to a dict with the web pages
+        read ('pages'), their 'bytes', the web pages with 'errors' and the
+        amounts of urls of its search, see Main.status
+
+        :rtype: dict
+        """
+        counters = {}
+        for search, counter in zip(self.__searches, self.__counters):
+            counters[search.domain] = dict(counter, **search.status())
+        return counters
+
+    def refresh(self, amount=None):
+        """
+        Changes to unvisited the visited urls of every web site whose web
+        pages probably changed, see Main.refresh.
+
+        :param amount: maximum of urls changed in each web site, None changes
+        every due url
+
+        :type amount: int
+
+        :return: amount of urls that will be read again
+
+        :rtype: int
+        """
+        return sum(search.refresh(amount) for search in self.__searches)
+
+    def next_refresh(self):
+        """
+        Gets when the first visited url of any web site will be due to be
+        read again.
+
+        :return: the time or None if there is no visited url
+
+        :rtype: float
+        """
+        due = [search.next_refresh() for search in self.__searches]
+        due = [value for value in due if value is not None]
+        return min(due) if due else None
+
+    def duplicate_savings(self):
+        """
+        Estimates what the urls skipped in every web site saved, see
+        Main.duplicate_savings.
+
+        :return: dict with the skipped 'pages', the 'bytes' and the 'seconds' saved
+
+        :rtype: dict
+        """
+        savings = {'pages': 0, 'bytes': 0.0, 'seconds': 0.0}
+        for search in self.__searches:
+            for key, value in search.duplicate_savings().items():
+                savings[key] += value
+        return savings
+
+    def __fetch(self, task):
+        """
+        Downloads the web page of a url, in a fetch thread.
+
+        :param task: tuple with the index of the web site and the url item
+
+        :type task: tuple
+
+        :rtype: Response
+        """
+        index, item = task
+        return self.__searches[index].fetch_stage(item)
+
+    def __parse(self, task, response):
+        """
+        Processes a downloaded web page, in a parse thread.
+
+        :param task: tuple with the index of the web site and the url item
+
+        :type task: tuple
+
+        :param response: the downloaded web page
+
+        :type response: Response
+
+        :rtype: ParsedPage
+        """
+        index, item = task
+        return self.__searches[index].parse_stage(item, response)
+
+    def __failed(self, task, response, error):
+        """
+        Gets the Response persisted for a url whose stage raised an exception.
+
+        :param task: tuple with the index of the web site and the url item
+
+        :type task: tuple
+
+        :param response: the downloaded web page, None if it was not downloaded
+
+        :type response: Response
+
+        :param error: the exception raised by the stage
+
+        :type error: Exception
+
+        :rtype: Response
+        """
+        index, item = task
+        return self.__searches[index].failed_stage(item, response, error)
+
+    def __dequeue(self, pipeline, worker, active, queued):
+        """
+        Claims unvisited urls of the web sites in turns and puts them in the
+        pipeline. Only two urls for each fetch thread wait to be downloaded,
+        shared by the web sites that still have urls. A web site without
+        urls to read and without urls in the pipeline is finished.
+
+        :param pipeline: the shared pipeline
+
+        :type pipeline: Pipeline
+
+        :param worker: the identification used to claim the urls
+
+        :type worker: str
+
+        :param active: the indexes of the web sites not finished, in the
+        order of their next turns
+
+        :type active: list
+
+        :param queued: amount of urls of each web site in the pipeline
+
+        :type queued: list
+
+        :return: amount of urls put in the pipeline
+
+        :rtype: int
+        """
+        if not pipeline.empty() and pipeline.waiting() > pipeline.fetchers:
+            return 0
+        free = min(pipeline.free, pipeline.fetchers * 2 - pipeline.waiting())
+        put = 0
+        for index in list(active):
+            if free - put <= 0:
+                break
+            # each web site gets its part of the free places
+            share = max(1, (free - put) // len(active))
+            items = self.__searches[index].claim(worker, share)
+            for item in items:
+                pipeline.put((index, item))
+            queued[index] += len(items)
+            put += len(items)
+            # the next web site starts the next turn
+            active.remove(index)
+            if items or queued[index] or self.__searches[index].has_work():
+                active.append(index)
+        return put
+
+    def search_for_products(self):
+        """
+        Searches for products in every web site until all of them are read.
+        """
+        pipeline = Pipeline(self.__fetch, self.__parse, self.__fetchers, max(1, self.__parsers),
+                            self.__queue_size, self.__max_memory, self.__failed)
+        worker = '{}:{}:multisite'.format(socket.gethostname(), os.getpid())
+        active = list(range(len(self.__searches)))
+        queued = [0] * len(self.__searches)
+        shown = 0.0
+        self.__update_status()
+        try:
+            while active or not pipeline.empty():
+                put = self.__dequeue(pipeline, worker, active, queued)
+                if pipeline.empty():
+                    if not put:
+                        # only urls waiting to be tried again are left
+                        time.sleep(0.5)
+                    continue
+                done = pipeline.result(timeout=1.0)
+                if done is None:
+                    continue
+                (index, item), response, page = done
+                queued[index] -= 1
+                counter = self.__counters[index]
+                counter['pages'] += 1
+                counter['bytes'] += len(response.content)
+                counter['errors'] += response.error is not None
+                self.__searches[index].persist(item, response, page)
+                if time.monotonic() - shown >= STATUS_INTERVAL:
+                    shown = time.monotonic()
+                    self.__update_status()
+        finally:
+            pipeline.close()
+            # the urls still in the pipeline return to pending
+            for search in self.__searches:
+                search.release_worker(worker)
+        self.__update_status()
+
+    def __update_status(self):
+        """
+        Updates the counters of each web site in the metrics and shows them.
+        """
+        counters = self.counters()
+        self.__site_metrics.update(counters)
+        self.show_status(counters)
+
+    def show_status(self, counters=None):
+        """
+        Shows to user the status of the search of each web site.
+
+        :param counters: the counters of each web site, see counters, None
+        reads them
+
+        :type counters: dict
+        """
+        if self.__quiet:
+            return
+        if counters is None:
+            counters = self.counters()
+        message = '{:<40} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8}\n'.format(
+            'Web site', 'URLs', 'Unvisited', 'Products', 'Pages', 'MB', 'Errors')
+        for domain, counter in counters.items():
+            message += '{:<40} {:>10} {:>10} {:>10} {:>10} {:>10.1f} {:>8}\n'.format(
+                domain[:40], counter['urls'], counter['unvisited'], counter['products'], counter['pages'],
+                counter['bytes'] / 1024 / 1024, counter['errors'])
+        # clean the screen
+        os.system('cls' if os.name == 'nt' else 'clear')
+        print(message)
+
+    def close(self):
+        """
+        Writes the products still in memory and closes the database of every
+        web site, and the shared connections and parser processes.
+        """
+        for search in self.__searches:
+            search.close()
+        self.__http_pool.close()
+        if self.__parse_pool is not None:
+            self.__parse_pool.shutdown()
+            self.__parse_pool = None
+        if self.__metrics_writer is not None:
+            self.__metrics_writer.close()
+            self.__metrics_writer = None
+        if self.__metrics_server is not None:
+            self.__metrics_server.close()
+            self.__metrics_server = None
+
+    def delete_database(self):
+        """
+        Closes the searches and asks user once if he wants to delete the
+        database of every web site.
+        """
+        self.close()
+        answer = input('Would you want to delete the databases [Y/N]? ')
+        while answer.upper() != 'Y' and answer.upper() != 'N':
+            print('It was not possible understand your answer, please try again.')
+            answer = input('Would you want to delete the databases [Y/N]? ')
+        if answer.upper() == 'N':
+            return
+        for search in self.__searches:
+            try:
+                # Delete the database file.
+                os.remove(search.database_file_name)
+            except os.error as e:
+                print('It was not possible delete database file.')
+                print(e)
@@ -2,9 +2,41 @@
 # author: Thiago da Cunha Borges
 
 
+import asyncio
+import gzip
+import io
+import json
+import multiprocessing
 import os
-from unittest import TestCase
-from database import URLDatabase
+import random
+import shutil
+import sqlite3
+import threading
+import time
+from urllib import request
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import TestCase, skipIf
+from bs4 import BeautifulSoup
+from benchmark import SORTS, ShopServer, ShopSite
+from canonical import URLCanonicalizer
+from crawler import Crawler, PageValues, Response
+from database import URLDatabase, url_pattern
+from extractor import ParsedPage, soup_extract, stream_extract
+from fetcher import AsyncFetcher
+from httppool import HTTPPool
+from main import Main
+from metrics import Metrics, MetricsServer, PageProfiler
+from multisite import MultiSite, SiteMetrics, load_sites
+from pagecache import PageCache
+from pipeline import Pipeline
+from politeness import PolitenessScheduler
+from seenfilter import SeenFilter
+from shards import ShardRouter, SpoolTransport, shard_of
+from simhash import NearDuplicateIndex, distance, simhash
+from sinks import JSONLinesSink, ProductWriter, pyarrow
+from sitemap import SitemapSeeder, read_sitemap, robots_sitemaps
 
 
 class MyTest(TestCase):
@@ -48,6 +80,983 @@ class MyTest(TestCase):
         db.close()
         os.remove(db_name)
 
+    def test_claim(self):
+        db_name = 'testsDb2.db'
+        pattern = 'https://www.epocacosmeticos.com.br%/p'
+        first = URLDatabase(db_name, pattern)
+        first.create_schema()
+        second = URLDatabase(db_name, pattern)
+        urls = ['https://www.epocacosmeticos.com.br/a', 'https://www.epocacosmeticos.com.br/b']
+        first.insert_url_list(urls)
+
+        # two workers never claim the same url
+        claimed = {first.claim('worker-1'), second.claim('worker-2')}
+        self.assertEqual(set(urls), claimed, 'each worker claims a different url')
+        self.assertIsNone(first.claim('worker-1'), 'nothing left to claim')
+        self.assertFalse(first.has_unvisited(), 'claimed urls are not pending')
+        self.assertTrue(first.has_in_flight(), 'claimed urls are in flight')
+
+        # a finished url does not return to pending
+        first.set_visited(urls[0])
+        self.assertEqual(1, first.in_flight(), 'one url in flight')
+
+        # an expired lease returns the url to pending
+        first.insert_new_url('https://www.epocacosmeticos.com.br/c')
+        url = first.claim('worker-1', lease=-1)
+        self.assertEqual('https://www.epocacosmeticos.com.br/c', url, 'claimed with expired lease')
+        self.assertEqual(url, second.claim('worker-2'), 'expired url claimed again')
+
+        first.close()
+        second.close()
+        os.remove(db_name)
+
+    def test_claim_batch(self):
+        db_name = 'testsDb3.db'
+        # a database file created before the kind column existed
+        connection = sqlite3.connect(db_name)
+        connection.execute('CREATE TABLE links (url TEXT NOT NULL PRIMARY KEY, visited INTEGER DEFAULT 0);')
+        connection.execute("INSERT INTO links (url) VALUES ('https://www.epocacosmeticos.com.br/old/p');")
+        connection.commit()
+        connection.close()
+
+        db = URLDatabase(db_name, 'https://www.epocacosmeticos.com.br%/p')
+        db.create_schema()
+        self.assertEqual(1, db.total_products(), 'old product url classified')
+        db.insert_url_list(['https://www.epocacosmeticos.com.br/{}/p'.format(i) for i in range(5)])
+        db.insert_url_list(['https://www.epocacosmeticos.com.br/{}'.format(i) for i in range(5)])
+        self.assertEqual(6, db.unvisited_product(), 'product urls classified on insert')
+
+        products = db.claim_batch('worker', 4, product=True)
+        self.assertEqual(4, len(products), 'four product urls claimed')
+        self.assertTrue(all(db.is_product(url) for url in products), 'only product urls claimed')
+        self.assertEqual(2, len(db.claim_batch('worker', 10, product=True)), 'remaining product urls')
+        others = db.claim_batch('worker', 10)
+        self.assertEqual(5, len(others), 'other urls claimed')
+        self.assertFalse(any(db.is_product(url) for url in others), 'no product url claimed')
+        self.assertEqual([], db.claim_batch('worker', 10), 'nothing left to claim')
+
+        db.close()
+        os.remove(db_name)
+
+    def test_bulk_insert(self):
+        db_name = 'testsDb4.db'
+        db = URLDatabase(db_name, 'https://www.epocacosmeticos.com.br%/p', wal=True)
+        db.create_schema()
+        journal = db.cursor.execute('PRAGMA journal_mode;').fetchone()[0]
+        self.assertEqual('wal', journal, 'write ahead log journal')
+
+        url = 'https://www.epocacosmeticos.com.br'
+        links = ['https://www.epocacosmeticos.com.br/{}'.format(i % 3) for i in range(9)]
+        db.insert_new_url(url)
+        db.set_visited(url, links + [url])
+        self.assertEqual(4, db.total(), 'repeated urls inserted once')
+        self.assertEqual(3, db.unvisited(), 'visited url not inserted again')
+        db.insert_url_list(links)
+        self.assertEqual(4, db.total(), 'urls in the database ignored')
+
+        db.close()
+        for name in (db_name, db_name + '-wal', db_name + '-shm'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_seen_filter(self):
+        db_name = 'testsDb5.db'
+        pattern = 'https://www.epocacosmeticos.com.br%/p'
+        menu = ['https://www.epocacosmeticos.com.br/menu/{}'.format(i) for i in range(5)]
+        seen = SeenFilter(memory=1024, recent=10)
+        db = URLDatabase(db_name, pattern, seen_filter=seen)
+        db.create_schema()
+
+        # the second time the links are found they start in the LRU
+        db.insert_url_list(menu)
+        db.insert_url_list(menu)
+        self.assertEqual(5, len(seen), 'repeated links remembered')
+        self.assertEqual([], seen.unknown(menu), 'repeated links rejected')
+        self.assertEqual(5, db.total(), 'links inserted once')
+
+        # a new url is never rejected
+        new_url = 'https://www.epocacosmeticos.com.br/new/p'
+        self.assertEqual([new_url], seen.unknown([new_url]), 'new url goes to the database')
+        db.set_visited(menu[0], menu + [new_url])
+        self.assertEqual(6, db.total(), 'new url inserted')
+        db.close()
+
+        # a resumed search rebuilds the filter from the database
+        seen = SeenFilter(memory=1024, recent=10)
+        db = URLDatabase(db_name, pattern, seen_filter=seen)
+        db.create_schema()
+        self.assertEqual([], seen.unknown(menu + [new_url]), 'urls of the database rejected')
+        db.close()
+        os.remove(db_name)
+
+    def test_product_writer(self):
+        csv_name = 'testsCsv1.csv'
+        writer = ProductWriter(csv_name, flush_rows=2, flush_interval=60)
+        products = [PageValues('product {}'.format(i), 'title {}'.format(i),
+                               'https://www.epocacosmeticos.com.br/{}/p'.format(i), csv_name)
+                    for i in range(3)]
+        writer.write(products[0])
+        self.assertFalse(os.path.exists(csv_name), 'row kept in memory')
+        writer.write(products[1])
+        with open(csv_name, encoding='utf-8') as csv_file:
+            self.assertEqual(3, len(csv_file.readlines()), 'header and two rows written')
+        writer.write(products[2])
+        writer.close()
+
+        # a resumed search saves a product again only if it changed, and keeps one row for each product
+        writer = ProductWriter(csv_name, flush_rows=2, flush_interval=60)
+        self.assertFalse(writer.write(products[0]), 'product already saved')
+        changed = PageValues('product 0', 'new title', products[0].url, csv_name)
+        self.assertTrue(writer.write(changed))
+        self.assertFalse(writer.write(changed), 'repeated in memory')
+        writer.close()
+        with open(csv_name, encoding='utf-8') as csv_file:
+            lines = csv_file.readlines()
+        self.assertEqual('product_name;title;url\n', lines[0], 'header')
+        self.assertEqual(4, len(lines), 'header and one row for each product')
+        self.assertEqual('product 0;new title;{}\n'.format(products[0].url), lines[1], 'last values of the product')
+        os.remove(csv_name)
+
+        # a row is not kept in memory for more than flush_interval seconds, even without new rows
+        threads = set(threading.enumerate())
+        writer = ProductWriter(csv_name, flush_rows=100, flush_interval=0.2)
+        writer.write(products[0])
+        self.assertFalse(os.path.exists(csv_name), 'row kept in memory')
+        time.sleep(0.6)
+        with open(csv_name, encoding='utf-8') as csv_file:
+            self.assertEqual(2, len(csv_file.readlines()), 'header and the row written')
+        writer.close()
+        self.assertEqual(set(), set(threading.enumerate()) - threads,
+                         'the flush thread stops when the writer is closed')
+        os.remove(csv_name)
+
+        json_name = 'testsJson1.jsonl.gz'
+        for _ in range(2):
+            writer = ProductWriter(json_name, flush_rows=2, flush_interval=60, output='jsonl')
+            for page_values in products:
+                writer.write(page_values)
+            writer.close()
+        rows = list(JSONLinesSink(json_name).read())
+        self.assertEqual([page_values.values for page_values in products], rows, 'each product once')
+        with gzip.open(json_name, 'rt', encoding='utf-8') as json_file:
+            self.assertEqual(3, len(json_file.readlines()), 'a valid gzip file')
+        writer = ProductWriter(json_name, flush_rows=1, flush_interval=60, output='jsonl')
+        writer.write(PageValues('product 1', 'new title', products[1].url, json_name))
+        writer.close()
+        rows = list(JSONLinesSink(json_name).read())
+        self.assertEqual([products[1].url], [row['url'] for row in rows if row['title'] == 'new title'])
+        self.assertEqual([page_values.url for page_values in products], [row['url'] for row in rows],
+                         'exactly one row for each product')
+        os.remove(json_name)
+        self.assertRaises(ValueError, ProductWriter, json_name, output='xml')
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_writer(self):
+        parquet_name = 'testsParquet1.parquet'
+        products = [PageValues('product {}'.format(i), 'title {}'.format(i),
+                               'https://www.epocacosmeticos.com.br/{}/p'.format(i), parquet_name)
+                    for i in range(5)]
+        for stop in (3, 5):
+            writer = ProductWriter(parquet_name, flush_rows=2, flush_interval=60, output='parquet')
+            for page_values in products[:stop]:
+                writer.write(page_values)
+            writer.close()
+        table = pyarrow.parquet.read_table(parquet_name)
+        self.assertEqual([page_values.url for page_values in products], table.column('url').to_pylist())
+        writer = ProductWriter(parquet_name, flush_rows=2, flush_interval=60, output='parquet')
+        writer.write(PageValues('product 4', 'new title', products[4].url, parquet_name))
+        writer.close()
+        table = pyarrow.parquet.read_table(parquet_name)
+        self.assertEqual([page_values.url for page_values in products], table.column('url').to_pylist(),
+                         'exactly one row for each product')
+        self.assertEqual('new title', table.column('title').to_pylist()[4])
+        os.remove(parquet_name)
+
+    def test_stats(self):
+        db_name = 'testsDb6.db'
+        db = URLDatabase(db_name, 'https://www.epocacosmeticos.com.br%/p')
+        db.create_schema()
+        products = ['https://www.epocacosmeticos.com.br/{}/p'.format(i) for i in range(4)]
+        others = ['https://www.epocacosmeticos.com.br/{}'.format(i) for i in range(6)]
+        db.insert_url_list(products + others + products)
+        db.set_visited(products[0], others)
+        db.claim_batch('worker', 2, product=True)
+        db.claim_batch('worker', 1)
+
+        def counted(where):
+            return db.cursor.execute('SELECT COUNT(*) FROM links ' + where).fetchone()[0]
+
+        def check(message):
+            self.assertEqual(counted(''), db.total(), message)
+            self.assertEqual(counted('WHERE visited = 0'), db.unvisited(), message)
+            self.assertEqual(counted('WHERE kind = 1'), db.total_products(), message)
+            self.assertEqual(counted('WHERE visited = 0 AND kind = 1'), db.unvisited_product(), message)
+            self.assertEqual(counted('WHERE visited = 2'), db.in_flight(), message)
+
+        check('amounts updated by inserts and state changes')
+        self.assertEqual((10, 1, 4, 6), (db.total(), db.unvisited_product(), db.total_products(), db.unvisited()))
+
+        # the amounts are counted again when the schema is created
+        db.cursor.execute('UPDATE link_stats SET amount = 0;')
+        db.connection.commit_db()
+        db.create_schema()
+        check('amounts counted again')
+
+        db.close()
+        os.remove(db_name)
+
+    def test_validators(self):
+        db_name = 'testsDb7.db'
+        db = URLDatabase(db_name, 'https://www.epocacosmeticos.com.br%/p')
+        db.create_schema()
+        url = 'https://www.epocacosmeticos.com.br/maquiagem'
+        db.insert_new_url(url)
+        self.assertEqual((None, None, None), db.get_validators(url), 'unknown validators')
+        db.set_visited(url, (), '"v1"', 'Mon, 01 Jan 2018 00:00:00 GMT', 'hash')
+        db.requeue_visited()
+        self.assertEqual(url, db.get_unvisited_url(), 'visited url pending again')
+        # a web page that did not change keeps its validators
+        db.set_visited(url)
+        self.assertEqual(('"v1"', 'Mon, 01 Jan 2018 00:00:00 GMT', 'hash'), db.get_validators(url))
+        db.close()
+        os.remove(db_name)
+
+        cache_dir = 'testsCache1'
+        cache = PageCache(cache_dir)
+        self.assertIsNone(cache.get(url), 'web page not saved')
+        cache.put(url, b'<html>page</html>')
+        self.assertEqual(b'<html>page</html>', cache.get(url), 'web page saved')
+        shutil.rmtree(cache_dir)
+
+    def test_refresh(self):
+        db_name = 'testsDb9.db'
+        db = URLDatabase(db_name, 'https://www.epocacosmeticos.com.br%/p')
+        db.create_schema()
+        product = 'https://www.epocacosmeticos.com.br/perfume/p'
+        category = 'https://www.epocacosmeticos.com.br/perfumes'
+        stable = 'https://www.epocacosmeticos.com.br/institucional'
+        db.insert_url_list([product, category, stable])
+        day = 24 * 3600.0
+        for url in (product, category, stable):
+            db.set_visited(url, (), None, None, 'v0', fetched=0.0)
+        # the category changes every day, the other web pages never change
+        for fetched in (day, 2 * day, 3 * day):
+            db.set_visited(category, (), None, None, 'v{}'.format(fetched), fetched=fetched)
+            db.set_visited(stable, (), None, None, 'v0', fetched=fetched)
+        # a web page not read does not change its fetch history
+        db.set_visited(stable)
+        line = db.cursor.execute('SELECT fetches, changes, last_changed FROM links WHERE url = ?;',
+                                 (category, )).fetchone()
+        self.assertEqual((4, 3, 3 * day), tuple(line))
+        line = db.cursor.execute('SELECT fetches, changes, last_changed FROM links WHERE url = ?;',
+                                 (stable, )).fetchone()
+        self.assertEqual((4, 0, 0.0), tuple(line))
+
+        # a web page never seen changing is read again after two days
+        self.assertEqual(2 * day, db.next_due())
+        self.assertEqual(1, db.requeue_due(now=4 * day))
+        self.assertEqual(product, db.get_unvisited_product())
+        # the category changing every day is due before the stable web page
+        db.set_visited(product, (), None, None, 'v0', fetched=4 * day)
+        self.assertEqual(1, db.requeue_due(now=4.5 * day))
+        self.assertEqual(category, db.get_unvisited_url())
+        db.set_visited(category, (), None, None, 'v4', fetched=4.5 * day)
+        # the products come first
+        self.assertEqual(1, db.requeue_due(amount=1, now=100 * day))
+        self.assertEqual(product, db.get_unvisited_product())
+        self.assertEqual(2, db.requeue_due(now=100 * day))
+        self.assertEqual(3, db.unvisited())
+        db.close()
+        os.remove(db_name)
+
+    def test_retries(self):
+        db_name = 'testsDb10.db'
+        db = URLDatabase(db_name, 'https://www.epocacosmeticos.com.br%/p')
+        db.create_schema()
+        url = 'https://www.epocacosmeticos.com.br/perfume/p'
+        db.insert_new_url(url)
+        now = time.time()
+        self.assertTrue(db.retry_later(url, 'timeout', now=now, max_retries=3, delay=10.0))
+        self.assertFalse(db.has_unvisited(), 'waiting url is not pending')
+        self.assertTrue(now + 5.0 <= db.next_attempt() <= now + 10.0, 'first wait with jitter')
+        self.assertEqual([], db.claim_batch('worker', 1, True), 'claim respects the wait')
+        db.release_due_retries(now=now + 4.0)
+        self.assertFalse(db.has_unvisited(), 'not due yet')
+        db.release_due_retries(now=now + 10.0)
+        self.assertEqual(url, db.claim('worker', True))
+        self.assertTrue(db.retry_later(url, 'HTTP Error 503: Unavailable', now=now, max_retries=3, delay=10.0))
+        self.assertTrue(now + 10.0 <= db.next_attempt() <= now + 20.0, 'the wait doubles')
+        self.assertFalse(db.retry_later(url, 'timeout', now=now, max_retries=3, delay=10.0))
+        self.assertEqual((1, None), (db.failed(), db.next_attempt()), 'failed after the retries')
+        line = db.cursor.execute('SELECT failures, last_error FROM links WHERE url = ?;', (url, )).fetchone()
+        self.assertEqual((3, 'timeout'), tuple(line))
+        db.requeue_failed()
+        self.assertEqual((0, 1), (db.failed(), db.unvisited()), 'failed url tried again')
+        db.set_visited(url)
+        line = db.cursor.execute('SELECT failures, last_error FROM links WHERE url = ?;', (url, )).fetchone()
+        self.assertEqual((0, None), tuple(line), 'failures forgotten after a success')
+        db.close()
+        os.remove(db_name)
+
+        requests = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests[self.path] = requests.get(self.path, 0) + 1
+                if self.path == '/broken/p' or (self.path == '/1/p' and requests[self.path] <= 2):
+                    self.send_error(503)
+                    return
+                content = b"<html><title>t</title><h1>x</h1><a href='/1/p'>1</a><a href='/broken/p'>b</a></html>"
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        main_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        main = Main({'domain': main_url, 'product_pattern': main_url + '%/p'}, quiet=True, max_retries=3,
+                    retry_delay=0.05)
+        main.search_for_products()
+        main.close()
+        self.assertEqual({'/': 1, '/1/p': 3, '/broken/p': 3}, requests, 'retried until the limit')
+        with open(main.csv_file_name, encoding='utf-8') as csv_file:
+            self.assertEqual(2, len(csv_file.readlines()), 'product saved after the retries')
+        db = URLDatabase(main.database_file_name, main_url + '%/p')
+        self.assertEqual(1, db.failed(), 'the broken url is kept')
+        db.close()
+        os.remove(main.database_file_name)
+        os.remove(main.csv_file_name)
+
+        # a web page whose processing raises an error is tried again and failed, the search goes on
+        class BrokenParser(Main):
+            def parse_stage(self, item, response):
+                if item[0].endswith('/1/p'):
+                    raise ValueError('broken page')
+                return super().parse_stage(item, response)
+
+        requests.clear()
+        main = BrokenParser({'domain': main_url, 'product_pattern': main_url + '%/p'}, quiet=True, max_retries=4,
+                            retry_delay=0.05)
+        main.search_for_products()
+        main.close()
+        self.assertEqual({'/': 1, '/1/p': 4, '/broken/p': 4}, requests, 'the search completed')
+        db = URLDatabase(main.database_file_name, main_url + '%/p')
+        self.assertEqual(2, db.failed(), 'the web page that could not be processed is failed')
+        db.close()
+        self.assertFalse(os.path.exists(main.csv_file_name), 'no product saved')
+        os.remove(main.database_file_name)
+        server.shutdown()
+        server.server_close()
+
+    def test_frontier(self):
+        self.assertEqual('/categoria-#?order&page', url_pattern('https://loja.com/categoria-3?page=2&order=preco'))
+        self.assertEqual('/institucional/*', url_pattern('https://loja.com/institucional/sobre'))
+        db_name = 'testsDb11.db'
+        db = URLDatabase(db_name, 'https://loja.com%/p')
+        db.create_schema()
+        main_url = 'https://loja.com/'
+        db.insert_new_url(main_url)
+        db.set_visited(main_url, ['https://loja.com/categoria-1', 'https://loja.com/institucional/sobre'])
+        # a category page with new products
+        db.set_visited('https://loja.com/categoria-1', ['https://loja.com/categoria-1/produto-{}/p'.format(number)
+                                                        for number in range(5)] +
+                       ['https://loja.com/categoria-1?page=2', 'https://loja.com/categoria-1?order=preco&page=1'])
+        # a sort of the category page has only the products already found
+        db.set_visited('https://loja.com/categoria-1?order=preco&page=1',
+                       ['https://loja.com/categoria-1/produto-{}/p'.format(number) for number in range(5)] +
+                       ['https://loja.com/categoria-1?order=preco&page=2'])
+        line = db.cursor.execute('SELECT pages, products FROM pattern_stats WHERE pattern = ?;',
+                                 ('/categoria-#?order&page', )).fetchone()
+        self.assertEqual((1, 0), tuple(line))
+        depth = db.cursor.execute('SELECT depth FROM links WHERE url = ?;',
+                                  ('https://loja.com/categoria-1?order=preco&page=2', )).fetchone()[0]
+        self.assertEqual(3, depth)
+        for url in db.claim_batch('worker', 5, True):
+            db.set_visited(url)
+        self.assertEqual(['https://loja.com/categoria-1?page=2', 'https://loja.com/institucional/sobre',
+                          'https://loja.com/categoria-1?order=preco&page=2'],
+                         db.get_unvisited_urls(3), 'the best pages first')
+        db.close()
+        os.remove(db_name)
+
+    def test_compact_storage(self):
+        db_name = 'testsDb12.db'
+        db = URLDatabase(db_name, 'https://loja.com%/p', seen_filter=SeenFilter(64 * 1024), compact=True)
+        db.create_schema()
+        main_url = 'https://loja.com/'
+        links = ['https://loja.com/categoria-1', 'https://loja.com/categoria-1/produto-1/p',
+                 'https://cdn.loja.com/categoria-1?page=2']
+        db.insert_new_url(main_url)
+        self.assertEqual([main_url], db.claim_batch('worker', 5))
+        db.set_visited(main_url, links, '"v1"', None, 'hash', fetched=1.0)
+        keys = sorted(line[0] for line in db.cursor.execute('SELECT url FROM links;'))
+        self.assertEqual(['1/', '1/categoria-1', '1/categoria-1/produto-1/p', '2/categoria-1?page=2'], keys)
+        self.assertIn('WITHOUT ROWID', db.cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'links';"
+                                                         ).fetchone()[0])
+        self.assertEqual(('"v1"', None, 'hash'), db.get_validators(main_url))
+        self.assertEqual(['https://loja.com/categoria-1/produto-1/p'], db.get_unvisited_urls(1, True))
+        db.close()
+
+        # the layout of the file does not change when it is opened again
+        db = URLDatabase(db_name, 'https://loja.com%/p')
+        db.create_schema()
+        self.assertTrue(db.compact)
+        self.assertEqual(sorted(links), sorted(db.get_unvisited_urls(5)))
+        # the visited pages that are not products are kept by their fingerprints
+        self.assertEqual(1, db.compact_visited())
+        self.assertEqual((4, 1), (db.total(), db.compacted()))
+        db.insert_url_list([main_url, 'https://loja.com/categoria-2'])
+        self.assertEqual((5, 4), (db.total(), db.unvisited()), 'a compacted url is not inserted again')
+        db.close()
+        db = URLDatabase(db_name, 'https://loja.com%/p')
+        db.create_schema()
+        self.assertEqual((5, 1), (db.total(), db.compacted()), 'counted again when the schema is created')
+        db.close()
+        os.remove(db_name)
+
+    def test_near_duplicates(self):
+        products = ['https://loja.com/categoria-1/produto-{}/p'.format(number) for number in range(20)]
+        first = simhash(products + ['categoria', '1', 'página', '1'])
+        self.assertEqual(first, simhash(reversed(products + ['categoria', '1', 'página', '1'])), 'a set of features')
+        near = simhash(products + ['categoria', '1', 'página', '2'])
+        other = simhash(['https://loja.com/categoria-2/produto-{}/p'.format(number) for number in range(20)])
+        self.assertLessEqual(distance(first, near), 6)
+        self.assertGreater(distance(first, other), 6)
+        index = NearDuplicateIndex(capacity=2)
+        self.assertEqual((False, True, False), (index.check(first), index.check(near), index.check(other)))
+        index.check(other ^ 1 << 40)
+        self.assertFalse(index.check(first), 'the oldest hashes are forgotten')
+
+        db_name = 'testsDb13.db'
+        db = URLDatabase(db_name, 'https://loja.com%/p', near_duplicates=NearDuplicateIndex(), skip_duplicates=True)
+        db.create_schema()
+        category = 'https://loja.com/categoria-1'
+        sorts = ['https://loja.com/categoria-1?order={}&page=1'.format(order) for order in range(6)]
+        db.insert_new_url(category)
+        db.set_visited(category, products + sorts, simhash=first)
+        for number in range(3):
+            self.assertEqual(0, db.skipped(), 'the pattern is not known as giving near duplicates yet')
+            db.set_visited(sorts[number], products + sorts, simhash=near)
+        db.insert_new_url('https://loja.com/categoria-1?order=new&page=1')
+        line = db.cursor.execute('SELECT pages, products, duplicates FROM pattern_stats WHERE pattern = ?;',
+                                 ('/categoria-#?order&page', )).fetchone()
+        self.assertEqual((3, 0, 3), tuple(line))
+        self.assertEqual(4, db.skipped(), 'the sorts still pending and the new one are skipped')
+        self.assertEqual(len(products), db.unvisited())
+        line = db.cursor.execute('SELECT simhash FROM links WHERE url = ?;', (category, )).fetchone()
+        self.assertEqual(first, line[0])
+        db.close()
+        os.remove(db_name)
+
+    def test_near_duplicates_workers(self):
+        # two connections share the statistics of the url patterns
+        db_name = 'testsDb14.db'
+        index = NearDuplicateIndex()
+        first, second = [URLDatabase(db_name, 'https://loja.com%/p', near_duplicates=index, skip_duplicates=True)
+                         for _ in range(2)]
+        first.create_schema()
+        second.create_schema()
+        products = ['https://loja.com/categoria-1/produto-{}/p'.format(number) for number in range(20)]
+        sorts = ['https://loja.com/categoria-1?order={}&page=1'.format(order) for order in range(6)]
+        page = simhash(products)
+        first.insert_new_url('https://loja.com/categoria-1')
+        first.set_visited('https://loja.com/categoria-1', products + sorts, simhash=page)
+        for db, url in zip((second, first, second), sorts):
+            self.assertEqual(0, db.skipped())
+            db.set_visited(url, products + sorts, simhash=page)
+        self.assertEqual(3, second.skipped(), 'the duplicates found by the other connection are counted')
+        first.close()
+        second.close()
+        os.remove(db_name)
+
+        shop = ShopSite(categories=3, products=6, per_page=3, filler=10, sorts=SORTS)
+        server = ShopServer(shop, 0, multiprocessing.Value('i', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        main_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        main = Main({'domain': main_url, 'product_pattern': main_url + '%/p'}, quiet=True, seen_memory=0,
+                    skip_duplicates=True)
+        main.search_for_products_parallel(2)
+        self.assertEqual(shop.total_products, main.status()['products'], 'every product found')
+        self.assertGreater(main.duplicate_savings()['pages'], 0, 'the sorts are skipped')
+        main.close()
+        db = URLDatabase(main.database_file_name, main_url + '%/p')
+        line = db.cursor.execute('SELECT pages, duplicates FROM pattern_stats WHERE pattern = ?;',
+                                 ('/categoria-#?order&page', )).fetchone()
+        db.close()
+        self.assertGreaterEqual(line[1], 3, 'duplicates of both workers')
+        os.remove(main.database_file_name)
+        os.remove(main.csv_file_name)
+        server.shutdown()
+        server.server_close()
+
+    def test_pipeline(self):
+        lock = threading.Lock()
+        counts = {'fetched': 0, 'persisted': 0, 'ahead': 0}
+
+        def fetch(item):
+            with lock:
+                counts['fetched'] += 1
+                counts['ahead'] = max(counts['ahead'], counts['fetched'] - counts['persisted'])
+            return Response(item[0], 200, b'x' * 1000)
+
+        def parse(item, response):
+            return ParsedPage([], item[0], None, False)
+
+        pipeline = Pipeline(fetch, parse, fetchers=2, parsers=2, capacity=20, max_memory=3000)
+        for index in range(20):
+            pipeline.put(('https://loja.com/{}'.format(index), False))
+        self.assertEqual(0, pipeline.free, 'pipeline full')
+        titles = set()
+        while not pipeline.empty():
+            item, response, page = pipeline.result(timeout=5.0)
+            time.sleep(0.01)
+            titles.add(page.title)
+            with lock:
+                counts['persisted'] += 1
+        pipeline.close()
+        self.assertEqual(20, len(titles), 'every url persisted')
+        # three web pages in the budget, one downloaded by each fetch thread and one being persisted
+        self.assertLessEqual(counts['ahead'], 6, 'the fetch stage waits for the persist stage')
+
+        def broken(item, response):
+            raise ValueError('broken page')
+
+        pipeline = Pipeline(fetch, broken)
+        pipeline.put(('https://loja.com/x', False))
+        self.assertRaises(ValueError, pipeline.result, 5.0)
+        pipeline.close()
+
+        # with failed, the error of a url is persisted and the other urls go on
+        def failed(item, response, error):
+            return Response(item[0], 0, error=str(error), transient=True)
+
+        pipeline = Pipeline(fetch, lambda item, response: broken(item, response) if item[1] else parse(item, response),
+                            max_memory=3000, failed=failed)
+        for index in range(4):
+            pipeline.put(('https://loja.com/{}'.format(index), index == 2))
+        results = {}
+        while not pipeline.empty():
+            item, response, page = pipeline.result(timeout=5.0)
+            results[item[0]] = response.error if page is None else page.title
+        pipeline.close()
+        self.assertEqual('broken page', results.pop('https://loja.com/2'), 'error persisted')
+        self.assertEqual(['https://loja.com/{}'.format(index) for index in (0, 1, 3)], sorted(results.values()))
+
+    def test_async_fetcher(self):
+        lock = threading.Lock()
+        running = {'now': 0, 'max': 0}
+
+        def download(url):
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.05)
+            with lock:
+                running['now'] -= 1
+            return url.encode()
+
+        async def fetch_all(fetcher, urls):
+            return await asyncio.gather(*[fetcher.fetch(url) for url in urls])
+
+        urls = ['https://www.epocacosmeticos.com.br/{}'.format(i) for i in range(12)]
+        fetcher = AsyncFetcher(download, concurrency=4)
+        loop = asyncio.new_event_loop()
+        contents = loop.run_until_complete(fetch_all(fetcher, urls))
+        self.assertEqual([url.encode() for url in urls], contents, 'contents in order')
+        self.assertEqual(4, running['max'], 'global limit reached')
+        fetcher.close()
+
+        # the same host can not use all the concurrency
+        running['max'] = 0
+        fetcher = AsyncFetcher(download, concurrency=4, per_host=2)
+        loop.run_until_complete(fetch_all(fetcher, urls))
+        self.assertEqual(2, running['max'], 'per host limit reached')
+        fetcher.close()
+        loop.close()
+
+    def test_http_pool(self):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path == '/old':
+                    self.send_response(301)
+                    self.send_header('Location', '/new')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                content = self.path.encode() * 100
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    content = gzip.compress(content)
+                self.send_response(200)
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        main_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        pool = HTTPPool()
+        for i in range(5):
+            page = pool.request('{}/{}'.format(main_url, i))
+            self.assertEqual(200, page.status)
+            self.assertEqual('/{}'.format(i).encode() * 100, page.content, 'content decompressed')
+        self.assertEqual(1, pool.opened, 'connection kept alive')
+        page = pool.request(main_url + '/old')
+        self.assertEqual(main_url + '/new', page.url, 'redirect followed')
+        self.assertEqual(b'/new' * 100, page.content)
+        # a pool shared with a crawler is not closed by it
+        crawler = Crawler(main_url, 'testsCsv3.csv', http_pool=pool)
+        crawler.close()
+        pool.request(main_url + '/0')
+        self.assertEqual(1, pool.opened, 'connection still open')
+        # a streamed answer is decompressed while it is read and gives its connection back
+        with pool.open(main_url + '/old') as answer:
+            self.assertEqual(main_url + '/new', answer.url, 'redirect followed')
+            self.assertEqual(b'/new' * 100, b''.join(iter(lambda: answer.read(7), b'')))
+        pool.request(main_url + '/0')
+        self.assertEqual(1, pool.opened, 'connection given back')
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+    def test_politeness(self):
+        robots = {'status': 200, 'delay': 0.0}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(robots['delay'])
+                content = b'User-agent: *\nDisallow: /private\nCrawl-delay: 1\n'
+                self.send_response(robots['status'])
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        main_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        scheduler = PolitenessScheduler(max_rate=100)
+        self.assertFalse(scheduler.allowed(main_url + '/private/1'), 'disallowed by robots.txt')
+        self.assertTrue(scheduler.allowed(main_url + '/public'))
+        self.assertEqual((1.0, 1), scheduler.limits(main_url), 'crawl delay followed')
+        start = time.monotonic()
+        for _ in range(2):
+            scheduler.acquire(main_url)
+            scheduler.release(main_url, 200, 0.01)
+        self.assertGreaterEqual(time.monotonic() - start, 0.9, 'requests spaced by the crawl delay')
+        robots['status'] = 404
+        self.assertTrue(PolitenessScheduler().allowed(main_url + '/private/1'), 'no robots.txt allows everything')
+        robots['status'] = 503
+        self.assertFalse(PolitenessScheduler().allowed(main_url + '/public'), 'server error disallows for now')
+        # a robots.txt that does not answer waits only the timeout of the connections
+        robots['status'], robots['delay'] = 200, 2.0
+        pool = HTTPPool(timeout=0.3)
+        start = time.monotonic()
+        self.assertFalse(PolitenessScheduler(http_pool=pool).allowed(main_url + '/public'), 'timeout disallows')
+        self.assertLess(time.monotonic() - start, 1.5)
+        pool.close()
+        server.shutdown()
+        server.server_close()
+
+        url = 'https://www.epocacosmeticos.com.br/'
+        scheduler = PolitenessScheduler(max_rate=100, max_concurrency=8, robots=False)
+        self.assertEqual((100, 8), scheduler.limits(url))
+        scheduler.acquire(url)
+        scheduler.release(url, 429, 0.01, '1')
+        self.assertEqual((50, 4), scheduler.limits(url), 'limits cut in half')
+        start = time.monotonic()
+        scheduler.acquire(url)
+        self.assertGreaterEqual(time.monotonic() - start, 0.9, 'Retry-After followed')
+        scheduler.release(url, 200, 0.01)
+        for _ in range(40):
+            scheduler.acquire(url)
+            scheduler.release(url, 400, 0.01)
+        self.assertEqual((100, 8), scheduler.limits(url), 'limits grow again')
+        # a much slower answer reduces the limits
+        scheduler.acquire(url)
+        scheduler.release(url, 200, 1.0)
+        self.assertEqual((50, 4), scheduler.limits(url))
+
+    def test_benchmark_site(self):
+        shop = ShopSite(categories=2, products=3, per_page=2, filler=10)
+        self.assertIsNotNone(shop.page('/'))
+        self.assertIsNone(shop.page('/categoria-2'), 'unknown category')
+        self.assertIsNone(shop.page('/categoria-0?page=3'), 'unknown category page')
+        page = stream_extract(shop.page('/categoria-1/produto-2/p'))
+        self.assertEqual('Produto 1-2', page.product_name)
+        self.assertIn('/categoria-1', page.links)
+
+        # the files of a local web site have valid names
+        main = Main({'domain': 'http://127.0.0.1:8000', 'product_pattern': 'http://127.0.0.1:8000%/p'},
+                    seen_memory=0, quiet=True)
+        self.assertEqual('127-0-0-1-8000.db', main.database_file_name)
+        main.close()
+        os.remove(main.database_file_name)
+
+    def test_metrics(self):
+        metrics = Metrics()
+        with metrics.timer('fetch'):
+            pass
+        with metrics.timer('fetch') as timer:
+            timer.failed = True
+        with self.assertRaises(ValueError):
+            with metrics.timer('fetch'):
+                raise ValueError()
+        metrics.count('pages', 2)
+        fetch = metrics.snapshot()['stages']['fetch']
+        self.assertEqual((3, 2), (fetch['count'], fetch['errors']))
+        self.assertEqual(0.0005, fetch['p50'], 'fast calls in the first bucket')
+
+        server = MetricsServer(0, metrics)
+        main_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        text = request.urlopen(main_url + '/metrics').read().decode()
+        self.assertIn('crawler_pages_total 2', text)
+        self.assertIn('crawler_stage_seconds_count{stage="fetch"} 3', text)
+        self.assertIn('crawler_stage_errors_total{stage="fetch"} 2', text)
+        answer = json.loads(request.urlopen(main_url + '/metrics.json').read().decode())
+        self.assertEqual(2, answer['counters']['pages'])
+        server.close()
+
+        profile_name = 'testsProfile1.prof'
+        profiler = PageProfiler(2, profile_name)
+        self.assertEqual([1, 2, 3], [profiler.run(lambda page: page, page) for page in (1, 2, 3)])
+        self.assertTrue(os.path.exists(profile_name), 'second web page profiled')
+        os.remove(profile_name)
+
+    def test_sitemap(self):
+        self.assertEqual(['https://loja.com/a.xml', 'https://loja.com/b.xml.gz'],
+                         robots_sitemaps(b'User-agent: *\nSitemap: https://loja.com/a.xml\n'
+                                         b'sitemap:https://loja.com/b.xml.gz\nDisallow: /x\n'))
+        content = (b'<?xml version="1.0"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                   b'<url><loc> https://loja.com/1/p </loc><lastmod>2018-01-01</lastmod></url>'
+                   b'<url><loc>https://loja.com/2/p</loc></url></urlset>')
+        expected = [(False, 'https://loja.com/1/p'), (False, 'https://loja.com/2/p')]
+        self.assertEqual(expected, list(read_sitemap(content)))
+        self.assertEqual(expected, list(read_sitemap(gzip.compress(content))), 'gzip sitemap')
+        self.assertEqual(expected, list(read_sitemap(io.BytesIO(gzip.compress(content)))), 'gzip file read')
+
+        server = ShopServer(ShopSite(categories=3, products=4, filler=10), 0, multiprocessing.Value('i', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        main_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        db_name = 'testsDb8.db'
+        db = URLDatabase(db_name, main_url + '%/p')
+        db.create_schema()
+        crawler = Crawler(main_url, 'testsCsv2.csv')
+        self.assertEqual(12, SitemapSeeder(crawler, db, products_only=True).seed(), 'products of the index')
+        self.assertEqual((12, 12), (db.total(), db.total_products()))
+        self.assertEqual(15, SitemapSeeder(crawler, db, batch=5).seed(), 'products and categories')
+        self.assertEqual(15, db.total())
+        crawler.close()
+        db.close()
+        os.remove(db_name)
+        server.shutdown()
+        server.server_close()
+
+    def test_shards(self):
+        urls = ['https://loja.com/{}/p'.format(number) for number in range(200)]
+        self.assertEqual([shard_of(url, 4) for url in urls], [shard_of(url, 4) for url in urls], 'stable')
+        self.assertEqual({0, 1, 2, 3}, {shard_of(url, 4) for url in urls})
+        spool = 'testsSpool'
+        routers = [ShardRouter(shard, 2, SpoolTransport(spool), batch=50, interval=60.0) for shard in (0, 1)]
+        own = routers[0].split(urls + urls)
+        self.assertEqual([url for url in urls + urls if shard_of(url, 2) == 0], own)
+        self.assertTrue(all(routers[1].owns(url) for url in routers[1].receive()), 'full batch sent')
+        routers[0].flush()
+        self.assertEqual([], routers[0].receive())
+        self.assertEqual([], routers[1].receive(), 'repeated urls sent once')
+        routers[0].split(['https://loja.com/novo/p', 'https://loja.com/outro/p'] * 2)
+        routers[0].flush()
+        received = routers[1].receive()
+        self.assertEqual([url for url in ['https://loja.com/novo/p', 'https://loja.com/outro/p']
+                          if shard_of(url, 2) == 1], received)
+        shutil.rmtree(spool)
+
+        server = ShopServer(ShopSite(categories=3, products=4, filler=10), 0, multiprocessing.Value('i', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        main_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        nodes = {}
+
+        def search(shard):
+            # the database connections must be used by the thread that created them
+            node = nodes[shard] = Main({'domain': main_url, 'product_pattern': main_url + '%/p'}, quiet=True,
+                                       shard=shard, shards=2, spool_dir=spool, shard_wait=2.0)
+            node.search_for_products_async(4)
+            node.close()
+
+        threads = [threading.Thread(target=search, args=(shard, )) for shard in (0, 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        found = []
+        for shard, node in sorted(nodes.items()):
+            db = URLDatabase(node.database_file_name, main_url + '%/p')
+            urls = [line[0] for line in db.cursor.execute('SELECT url FROM links WHERE visited = 1;')]
+            db.close()
+            self.assertTrue(all(shard_of(url, 2) == shard for url in urls), 'only urls of the shard')
+            found.extend(urls)
+            with open(node.csv_file_name, encoding='utf-8') as csv_file:
+                self.assertEqual(sum(1 for url in urls if url.endswith('/p')), sum(1 for _ in csv_file) - 1)
+            os.remove(node.database_file_name)
+            os.remove(node.csv_file_name)
+        self.assertEqual(len(found), len(set(found)), 'each url read by one node')
+        self.assertEqual(12, sum(1 for url in found if url.endswith('/p')), 'every product found')
+        shutil.rmtree(spool)
+        server.shutdown()
+        server.server_close()
+
+    def test_multisite(self):
+        servers = [ShopServer(ShopSite(categories=categories, products=4, filler=10), 0,
+                              multiprocessing.Value('i', 0)) for categories in (2, 3)]
+        for server in servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        sites = [{'domain': 'http://127.0.0.1:{}'.format(server.server_address[1]),
+                  'product_pattern': 'http://127.0.0.1:{}%/p'.format(server.server_address[1])}
+                 for server in servers]
+        sites[1]['output'] = 'jsonl'
+        sites_name = 'testsSites1.json'
+        with open(sites_name, 'w', encoding='utf-8') as sites_file:
+            json.dump(sites + [dict(sites[0])], sites_file)
+        self.assertRaises(ValueError, load_sites, sites_name)
+        with open(sites_name, 'w', encoding='utf-8') as sites_file:
+            json.dump(sites, sites_file)
+        self.assertEqual(sites, load_sites(sites_name))
+        os.remove(sites_name)
+
+        metrics_name = 'testsMetrics1.json'
+        multisite = MultiSite(sites, fetchers=3, quiet=True, metrics_file=metrics_name, metrics_interval=60,
+                              seen_memory=0)
+        multisite.search_for_products()
+        counters = multisite.counters()
+        for site, server, categories in zip(sites, servers, (2, 3)):
+            counter = counters[site['domain']]
+            self.assertEqual(categories * 4, counter['products'], 'every product of the web site')
+            self.assertEqual(0, counter['unvisited'])
+            self.assertEqual(server.served.value, counter['pages'], 'web pages counted by web site')
+        multisite.close()
+        with open(metrics_name, encoding='utf-8') as metrics_file:
+            saved = json.load(metrics_file)['sites']
+        self.assertEqual([8, 12], [saved[site['domain']]['products'] for site in sites], 'metrics of each site')
+        os.remove(metrics_name)
+        site_metrics = SiteMetrics(Metrics())
+        site_metrics.update(counters)
+        self.assertIn('crawler_site_products{{site="{}"}} 8'.format(sites[0]['domain']), site_metrics.to_prometheus())
+        first, second = multisite.searches
+        with open(first.output_file_name, encoding='utf-8') as csv_file:
+            self.assertEqual(8, sum(1 for _ in csv_file) - 1)
+        self.assertEqual(12, sum(1 for _ in JSONLinesSink(second.output_file_name).read()), 'output of the site')
+        for search in multisite.searches:
+            os.remove(search.database_file_name)
+            os.remove(search.output_file_name)
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_canonical(self):
+        canonicalizer = URLCanonicalizer('https://www.epocacosmeticos.com.br')
+        page = 'https://www.epocacosmeticos.com.br/perfumes/feminino'
+        variants = ['/perfumes?b=2&a=1', 'http://www.epocacosmeticos.com.br/perfumes/?a=1&b=2#top',
+                    'HTTPS://WWW.EPOCACOSMETICOS.COM.BR:443/perfumes?a=1&utm_source=news&b=2',
+                    '../perfumes/./?a=1&b=2&gclid=abc', ' //www.epocacosmeticos.com.br/perfumes?a=1&b=2 ']
+        canonical = {canonicalizer.canonical(href, page) for href in variants}
+        self.assertEqual({'https://www.epocacosmeticos.com.br/perfumes?a=1&b=2'}, canonical, 'one name')
+        self.assertEqual('https://www.epocacosmeticos.com.br/perfumes/outro',
+                         canonicalizer.canonical('outro', page), 'relative to the page')
+        self.assertEqual('https://www.epocacosmeticos.com.br/',
+                         canonicalizer.canonical('https://www.epocacosmeticos.com.br'), 'root path')
+        self.assertIsNone(canonicalizer.canonical('mailto:sac@epocacosmeticos.com.br'), 'not http')
+        # the query keeps its meaning
+        search = 'https://www.epocacosmeticos.com.br/busca'
+        self.assertEqual(search + '?q=a%2Bb', canonicalizer.canonical('/busca?q=a%2bb'), 'escaped plus')
+        self.assertEqual(search + '?q=a+b', canonicalizer.canonical('/busca?q=a+b'), 'plus is a space')
+        self.assertEqual(search + '?q=a%26b&x=1', canonicalizer.canonical('/busca?x=1&q=a%26b'), 'escaped &')
+        self.assertEqual(search + '?flag&q=1', canonicalizer.canonical('/busca?q=1&flag'), 'parameter without value')
+        self.assertEqual(search + '?flag=&q=1', canonicalizer.canonical('/busca?q=1&flag='), 'empty value')
+        self.assertEqual(search + '?q=caf%C3%A9%20x', canonicalizer.canonical('/busca?q=café x&utm_medium=y'))
+
+        crawler = Crawler('https://www.epocacosmeticos.com.br', 'testsCsv3.csv')
+        self.assertIsNone(crawler.canonical('https://outro.com.br/x'), 'another site')
+        links = ['/x/p#d', 'x/p', 'https://outro.com.br/x/p']
+        self.assertEqual(['https://www.epocacosmeticos.com.br/x/p'] * 2,
+                         crawler.get_product_urls(ParsedPage(links, None, None, False),
+                                                  'https://www.epocacosmeticos.com.br/'),
+                         'canonical urls of the site')
+
+
+class ExtractorTest(TestCase):
+    # web pages where the stream engine must find the same as BeautifulSoup
+    pages = [
+        b"<html><head><title>Perfume &amp; Cia</title></head><body><h1>Hypnose <b>Lancome</b></h1>"
+        b"<a href='/a'>a</a><a>no href</a><a href>empty</a><a href='1' href='2'>repeated</a></body></html>",
+        b"<title><b>bold</b></title><h1><span>inner</span> tail</h1>",
+        b"<title>a<!--comment-->b</title><h1><!--comment-->x</h1>",
+        b"<h1></h1><h1>second</h1><title></title>",
+        b"<h1/><title/>",
+        b"<div><h1>open <p>para</div> after</h1><a href=x/>",
+        b"<h1><br>text</h1><title>x<br></title>",
+        b"<h1>  </h1><title>\n </title>",
+        b"<h1><span><i>deep</i></span></h1>",
+        b"<script>var a='<a href=\"/js\">';</script><a href=\"/real\">r</a>",
+        b"<title>caf\xc3\xa9</title><h1>\xc3\xa9</h1>",
+        b"<h1>x</h1></body></html><a href='/late'>",
+        b"<h1>a &nbsp b &copy c &#169; &lt;</h1>",
+        b"<p><h1>in p</p>out</h1>",
+        b"<h1>x</br>y<?php echo ?><![CDATA[data]]></h1>",
+        b"<h1 class=name>\n  Perfume X\n</h1><a href='/a?x=1&amp;y=2'>q</a><A HREF='/UP'>u</A>",
+    ]
+
+    def test_pages(self):
+        for content in self.pages:
+            self.assertEqual(soup_extract(content), stream_extract(content), content)
+
+    def test_parser_processes(self):
+        # the parser processes receive bytes and return pages that can be pickled
+        with ProcessPoolExecutor(2) as parsers:
+            for engine in (soup_extract, stream_extract):
+                self.assertEqual([engine(content) for content in self.pages],
+                                 list(parsers.map(engine, self.pages)), engine.__name__)
+
+    def test_random_pages(self):
+        parts = ['<h1>', '</h1>', '<title>', '</title>', '<a href="/{}">', '<a>', '</a>', '<div>', '</div>',
+                 '<p>', '</p>', '<br>', '</br>', '<b>', '</b>', 'text', ' ', '\n', '&amp;', '<!--c-->',
+                 '<img src=x>', '<span/>', '<h1/>', '<?pi x?>', '<![CDATA[cd]]>', '<script>a<b</script>']
+        generator = random.Random(2018)
+        for index in range(500):
+            size = generator.randint(1, 25)
+            content = ''.join(generator.choice(parts).format(index) for _ in range(size)).encode()
+            self.assertEqual(soup_extract(content), stream_extract(content), content)
+
+    def test_crawler_engines(self):
+        content = (b"<title>Produto</title><h1>Nome</h1><a href='/produto/p'>p</a>"
+                   b"<a href='mailto:a@b.c'>e</a><a href='https://www.epocacosmeticos.com.br/x'>x</a>"
+                   b"<a href='https://outro.com.br/y'>y</a>")
+        soup = Crawler('https://www.epocacosmeticos.com.br', 'testsCsv2.csv', engine='soup')
+        stream = Crawler('https://www.epocacosmeticos.com.br', 'testsCsv2.csv', engine='stream')
+        self.assertEqual(soup.get_product_urls(soup.parse_page(content)),
+                         stream.get_product_urls(stream.parse_page(content)), 'same urls')
+        self.assertEqual(soup.get_product_urls(BeautifulSoup(content, 'html.parser')),
+                         stream.get_product_urls(stream.parse_page(content)), 'BeautifulSoup accepted')
+        self.assertRaises(ValueError, Crawler, 'https://www.epocacosmeticos.com.br', 'testsCsv2.csv',
+                          engine='unknown')
+
 
 if __name__ == '__main__':
     tests = MyTest
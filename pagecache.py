@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import gzip
+import hashlib
+import os
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is optional, gzip is always available
+    zstandard = None
+
+
+class PageCache:
+    def __init__(self, directory, compression='gzip'):
+        """
+        PageCache saves the content of the web pages compressed in a
+        directory, so a web page that did not change since the last
+        search can be processed again without downloading it.
+
+        :param directory: directory where the web pages are saved
+
+        :type directory: str
+
+        :param compression: 'gzip' or 'zstd', zstd needs the zstandard package
+
+        :type compression: str
+        """
+        if compression not in ('gzip', 'zstd'):
+            raise ValueError('unknown compression {}, use gzip or zstd'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        self.__directory = directory
+        self.__compression = compression
+        self.__extension = '.gz' if compression == 'gzip' else '.zst'
+        os.makedirs(directory, exist_ok=True)
+
+    def __path(self, url):
+        """
+        Gets the file name of a url in the cache.
+        The files are split in sub directories, so no directory gets too big.
+
+        :param url: a url
+
+        :type url: str
+
+        :rtype: str
+        """
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.__directory, key[:2], key + self.__extension)
+
+    def __compress(self, content):
+        if self.__compression == 'gzip':
+            return gzip.compress(content)
+        return zstandard.ZstdCompressor().compress(content)
+
+    def __decompress(self, content):
+        if self.__compression == 'gzip':
+            return gzip.decompress(content)
+        return zstandard.ZstdDecompressor().decompress(content)
+
+    def get(self, url):
+        """
+        Gets the content of a web page saved in the cache.
+
+        :param url: the web page url
+
+        :type url: str
+
+        :return: the web page content or None if it is not in the cache
+
+        :rtype: bytes
+        """
+        try:
+            with open(self.__path(url), 'rb') as cache_file:
+                return self.__decompress(cache_file.read())
+        except (IOError, EOFError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print('It was not possible read {} from the cache: {}'.format(url, e))
+            return None
+
+    def put(self, url, content):
+        """
+        Saves the content of a web page in the cache.
+
+        :param url: the web page url
+
+        :type url: str
+
+        :param content: the web page content
+
+        :type content: bytes
+        """
+        path = self.__path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # writes in a temporary file, so a reader never gets half a web page
+        temporary = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(temporary, 'wb') as cache_file:
+                cache_file.write(self.__compress(content))
+            os.replace(temporary, path)
+        except IOError as e:
+            print('It was not possible save {} in the cache: {}'.format(url, e))
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import queue
+import threading
+
+
+# item put in a queue to stop the threads of a stage
+STOP = object()
+
+
+class MemoryBudget:
+    def __init__(self, limit):
+        """
+        MemoryBudget limits the bytes of web page content kept between the
+        stages of a pipeline. A stage that needs more bytes than are free
+        waits until a later stage releases them.
+
+        :param limit: maximum of bytes kept, a single web page bigger than
+        the limit is accepted when no other web page is kept
+
+        :type limit: int
+        """
+        self.__limit = limit
+        self.__used = 0
+        self.__condition = threading.Condition()
+
+    @property
+    def used(self):
+        """
+        Bytes kept now
+
+        :rtype: int
+        """
+        return self.__used
+
+    def acquire(self, amount, stop):
+        """
+        Waits until there are enough free bytes and takes them.
+
+        :param amount: bytes taken
+
+        :type amount: int
+
+        :param stop: event set when the pipeline is closed
+
+        :type stop: threading.Event
+
+        :return: False if the pipeline was closed while waiting
+
+        :rtype: bool
+        """
+        with self.__condition:
+            while self.__used and self.__used + amount > self.__limit:
+                if stop.is_set():
+                    return False
+                self.__condition.wait(0.5)
+            self.__used += amount
+            return True
+
+    def release(self, amount):
+        """
+        Gives back bytes taken.
+
+        :param amount: bytes given back
+
+        :type amount: int
+        """
+        with self.__condition:
+            self.__used -= amount
+            self.__condition.notify_all()
+
+
+class Pipeline:
+    def __init__(self, fetch, parse, fetchers=1, parsers=1, capacity=64, max_memory=64 * 1024 * 1024,
+                 failed=None):
+        """
+        Pipeline runs the fetch and parse stages of the search in their own
+        threads, connected by bounded queues. The dequeue and persist stages
+        are done by the thread that uses the pipeline, so only it uses the
+        database.
+        At most capacity urls are between the dequeue and the persist stages
+        and at most max_memory bytes of web pages are kept, so the memory
+        used does not grow with the size of the web site nor with the amount
+        of threads: a stage that gets ahead waits for the next one.
+        An exception raised by a stage for a single url does not stop the
+        pipeline: the Response given by failed is persisted in its place,
+        without a processed web page. Only an error of the pipeline itself,
+        or of a stage without failed, is raised by result.
+
+        :param fetch: function that receives an item and returns its Response
+
+        :type fetch: callable
+
+        :param parse: function that receives an item and its Response and
+        returns the processed web page, or None if it is not needed
+
+        :type parse: callable
+
+        :param fetchers: amount of threads that download the web pages
+
+        :type fetchers: int
+
+        :param parsers: amount of threads that process the web pages
+
+        :type parsers: int
+
+        :param capacity: maximum of urls in the pipeline
+
+        :type capacity: int
+
+        :param max_memory: maximum of bytes of web pages kept in the pipeline
+
+        :type max_memory: int
+
+        :param failed: function that receives an item, its Response, or None
+        if it was not downloaded, and the exception raised by a stage for
+        it, and returns the Response persisted in its place
+
+        :type failed: callable
+        """
+        if fetchers < 1 or parsers < 1 or capacity < 1:
+            raise ValueError('fetchers, parsers and capacity must be at least 1')
+        self.__fetch = fetch
+        self.__parse = parse
+        self.__failed = failed
+        self.__capacity = capacity
+        self.__budget = MemoryBudget(max_memory)
+        self.__stop = threading.Event()
+        # the queues can hold every url of the pipeline, the backpressure
+        # comes from the capacity and the memory budget
+        self.__fetch_queue = queue.Queue(capacity)
+        self.__parse_queue = queue.Queue(capacity)
+        self.__done_queue = queue.Queue(capacity)
+        self.__pending = 0
+        self.__errors = []
+        self.__threads = ([threading.Thread(target=self.__fetcher, daemon=True) for _ in range(fetchers)] +
+                          [threading.Thread(target=self.__parser, daemon=True) for _ in range(parsers)])
+        self.__fetchers = fetchers
+        for thread in self.__threads:
+            thread.start()
+
+    @property
+    def free(self):
+        """
+        Amount of urls that can still be put in the pipeline
+
+        :rtype: int
+        """
+        return self.__capacity - self.__pending
+
+    @property
+    def capacity(self):
+        """
+        Maximum of urls in the pipeline
+
+        :rtype: int
+        """
+        return self.__capacity
+
+    @property
+    def fetchers(self):
+        """
+        Amount of threads that download the web pages
+
+        :rtype: int
+        """
+        return self.__fetchers
+
+    def waiting(self):
+        """
+        Gets the amount of urls waiting to be downloaded.
+
+        :rtype: int
+        """
+        return self.__fetch_queue.qsize()
+
+    def empty(self):
+        """
+        Checks if there is no url in the pipeline.
+
+        :rtype: bool
+        """
+        return self.__pending == 0
+
+    def put(self, item):
+        """
+        Puts a url in the fetch stage.
+
+        :param item: tuple whose first value is the url
+        """
+        self.__pending += 1
+        self.__fetch_queue.put(item)
+
+    def __fetcher(self):
+        """
+        Downloads the web pages of the fetch queue.
+        """
+        while True:
+            item = self.__fetch_queue.get()
+            if item is STOP:
+                return
+            try:
+                try:
+                    response = self.__fetch(item)
+                except Exception as e:
+                    # the url is persisted as failed, without being processed
+                    self.__done_queue.put((item, self.__item_failed(item, None, e), None))
+                    continue
+                # a fast download waits while the web pages already downloaded use the memory
+                if not self.__budget.acquire(len(response.content), self.__stop):
+                    return
+                self.__parse_queue.put((item, response))
+            except Exception as e:
+                self.__fail(e)
+                return
+
+    def __parser(self):
+        """
+        Processes the web pages of the parse queue.
+        """
+        while True:
+            task = self.__parse_queue.get()
+            if task is STOP:
+                return
+            item, response = task
+            try:
+                try:
+                    page = self.__parse(item, response)
+                except Exception as e:
+                    failed = self.__item_failed(item, response, e)
+                    # the downloaded web page is not kept, the Response of the failure takes its place
+                    self.__budget.release(len(response.content) - len(failed.content))
+                    response, page = failed, None
+                self.__done_queue.put((item, response, page))
+            except Exception as e:
+                self.__fail(e)
+                return
+
+    def __item_failed(self, item, response, error):
+        """
+        Gets the Response persisted in place of a url whose stage raised an exception.
+
+        :param item: the item of the url
+
+        :type item: tuple
+
+        :param response: the downloaded web page, None if it was not downloaded
+
+        :type response: Response
+
+        :param error: the exception raised by the stage
+
+        :type error: Exception
+
+        :rtype: Response
+        """
+        if self.__failed is None:
+            # without failed, the error of a url stops the pipeline
+            raise error
+        return self.__failed(item, response, error)
+
+    def __fail(self, error):
+        """
+        Keeps an error that stopped a stage to be raised by the thread that uses the pipeline.
+
+        :param error: the exception raised by the stage
+
+        :type error: Exception
+        """
+        self.__errors.append(error)
+        self.__done_queue.put(None)
+
+    def result(self, timeout=None):
+        """
+        Waits for a url that finished the parse stage, to be persisted.
+
+        :param timeout: maximum of seconds waited
+
+        :type timeout: float
+
+        :return: a tuple with the item, its Response and its processed web
+        page, or None if no url finished in the timeout
+
+        :rtype: tuple
+        """
+        try:
+            done = self.__done_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if self.__errors:
+            raise self.__errors[0]
+        response = done[1]
+        self.__pending -= 1
+        self.__budget.release(len(response.content))
+        return done
+
+    def close(self):
+        """
+        Stops the threads of the stages, discarding the urls still in the
+        pipeline. They are still claimed by the worker that put them, which
+        must release them, or they return to pending when their lease expires.
+        """
+        self.__stop.set()
+        for _ in range(self.__fetchers):
+            self.__put_stop(self.__fetch_queue)
+        for _ in range(len(self.__threads) - self.__fetchers):
+            self.__put_stop(self.__parse_queue)
+        for thread in self.__threads:
+            thread.join(timeout=5.0)
+
+    @staticmethod
+    def __put_stop(stage_queue):
+        """
+        Puts the stop item in a queue, discarding the oldest item if it is full.
+
+        :param stage_queue: the queue of a stage
+
+        :type stage_queue: queue.Queue
+        """
+        while True:
+            try:
+                stage_queue.put_nowait(STOP)
+                return
+            except queue.Full:
+                try:
+                    stage_queue.get_nowait()
+                except queue.Empty:
+                    pass
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib import parse, robotparser
+
+from httppool import USER_AGENT, HTTPPool
+
+
+# statuses that mean the server wants less requests
+SLOW_DOWN = {429, 503}
+
+# seconds until a robots.txt that could not be read is read again, the
+# host is not read meanwhile
+ROBOTS_RETRY = 60.0
+
+
+def retry_after(value):
+    """
+    Reads the Retry-After header, given in seconds or as a date.
+
+    :param value: the header value
+
+    :type value: str
+
+    :return: seconds to wait or None if the header is not valid
+
+    :rtype: float
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+class HostState:
+    def __init__(self, rate, concurrency, robots, robots_expiry=None):
+        """
+        HostState keeps how fast a host can be read.
+
+        :param rate: requests per second allowed
+        :param concurrency: requests in flight allowed
+        :param robots: the robots.txt rules of the host, None allows everything
+        :param robots_expiry: when the robots.txt must be read again, None if
+        it was read
+
+        :type rate: float
+        :type concurrency: float
+        :type robots: robotparser.RobotFileParser
+        :type robots_expiry: float
+        """
+        self.robots = robots
+        self.robots_expiry = robots_expiry
+        self.rate = rate
+        self.max_rate = rate
+        self.concurrency = concurrency
+        self.max_concurrency = concurrency
+        self.tokens = 1.0
+        self.refilled = time.monotonic()
+        self.in_flight = 0
+        self.backoff_until = 0.0
+        self.failures = 0
+        # the fastest answers of the host, used as the normal latency
+        self.base_latency = None
+
+    def refill(self, now):
+        """
+        Adds to the bucket the tokens earned since the last refill.
+
+        :param now: the current time
+
+        :type now: float
+        """
+        burst = max(1.0, self.rate)
+        self.tokens = min(burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def wait_time(self, now):
+        """
+        Gets how long a new request must wait.
+
+        :param now: the current time
+
+        :type now: float
+
+        :return: seconds to wait, 0 if the request can be sent, None if it
+        must wait for a request in flight to finish
+
+        :rtype: float
+        """
+        if now < self.backoff_until:
+            return self.backoff_until - now
+        if self.in_flight >= int(self.concurrency):
+            return None
+        self.refill(now)
+        if self.tokens < 1.0:
+            return (1.0 - self.tokens) / self.rate
+        return 0.0
+
+
+class PolitenessScheduler:
+    def __init__(self, max_rate=10.0, max_concurrency=8, robots=True, user_agent=USER_AGENT,
+                 latency_factor=3.0, max_backoff=300.0, http_pool=None):
+        """
+        PolitenessScheduler decides when a request can be sent to each host.
+        It follows the robots.txt rules and its Crawl-delay, and limits each
+        host with a token bucket and a maximum of requests in flight.
+        Both limits grow slowly while the host answers fast and are cut in
+        half when it answers 429 or 503 or much slower than normal, so the
+        search runs at the highest rate that the host accepts.
+
+        :param max_rate: maximum of requests per second to a host
+        :param max_concurrency: maximum of requests in flight to a host
+        :param robots: if True, robots.txt is read and followed
+        :param user_agent: the name used to find the robots.txt rules
+        :param latency_factor: how many times slower than normal an answer
+        must be to reduce the limits
+        :param max_backoff: maximum of seconds waited after a 429 or 503
+        :param http_pool: the connections used to read the robots.txt, with
+        their timeout and User-Agent, if it is None a new one is used
+
+        :type max_rate: float
+        :type max_concurrency: int
+        :type robots: bool
+        :type user_agent: str
+        :type latency_factor: float
+        :type max_backoff: float
+        :type http_pool: HTTPPool
+        """
+        if max_rate <= 0 or max_concurrency < 1:
+            raise ValueError('max_rate must be positive and max_concurrency at least 1')
+        self.__max_rate = max_rate
+        self.__max_concurrency = max_concurrency
+        self.__robots = robots
+        self.__user_agent = user_agent
+        self.__latency_factor = latency_factor
+        self.__max_backoff = max_backoff
+        self.__http_pool = http_pool if http_pool is not None else HTTPPool()
+        self.__hosts = {}
+        self.__condition = threading.Condition()
+        # only one thread reads the robots.txt of a host
+        self.__robots_locks = {}
+
+    def __read_robots(self, scheme, host):
+        """
+        Reads the robots.txt of a host. As robotparser does, a 401 or 403
+        disallows every url and another 4xx allows every url. A 5xx or an
+        error disallows every url until the robots.txt is read again.
+
+        :param scheme: the scheme of the host urls
+        :param host: the host and port
+
+        :type scheme: str
+        :type host: str
+
+        :return: a tuple with the robots.txt rules and when they must be
+        read again, None if they were read
+
+        :rtype: tuple
+        """
+        url = '{}://{}/robots.txt'.format(scheme, host)
+        robots = robotparser.RobotFileParser(url)
+        try:
+            answer = self.__http_pool.request(url)
+        except Exception as e:
+            print('It was not possible read the robots.txt of {}: {}'.format(host, e))
+            robots.disallow_all = True
+            return robots, time.monotonic() + ROBOTS_RETRY
+        if answer.status in (401, 403):
+            robots.disallow_all = True
+        elif 400 <= answer.status < 500:
+            robots.allow_all = True
+        elif answer.status >= 400:
+            robots.disallow_all = True
+            return robots, time.monotonic() + ROBOTS_RETRY
+        else:
+            robots.parse(answer.content.decode('utf-8', errors='replace').splitlines())
+        return robots, None
+
+    def __limits(self, robots):
+        """
+        Gets the limits of a host that follow the Crawl-delay of its robots.txt.
+
+        :param robots: the robots.txt rules of the host, None allows everything
+
+        :type robots: robotparser.RobotFileParser
+
+        :return: a tuple with the requests per second and the requests in flight allowed
+
+        :rtype: tuple
+        """
+        rate = self.__max_rate
+        concurrency = float(self.__max_concurrency)
+        delay = robots.crawl_delay(self.__user_agent) if robots else None
+        if delay:
+            # the Crawl-delay is the time between two requests
+            rate = min(rate, 1.0 / float(delay))
+            concurrency = 1.0
+        return rate, concurrency
+
+    @staticmethod
+    def __robots_due(state):
+        """
+        Checks if the robots.txt of a host must be read again.
+
+        :param state: the state of the host, None if it is not known yet
+
+        :type state: HostState
+
+        :rtype: bool
+        """
+        return state is None or (state.robots_expiry is not None and time.monotonic() >= state.robots_expiry)
+
+    def __host(self, url):
+        """
+        Gets the state of the host of a url, creating it the first time.
+
+        :param url: a url
+
+        :type url: str
+
+        :rtype: HostState
+        """
+        parts = parse.urlsplit(url)
+        host = parts.netloc
+        with self.__condition:
+            state = self.__hosts.get(host)
+            if not self.__robots_due(state):
+                return state
+            lock = self.__robots_locks.setdefault(host, threading.Lock())
+        with lock:
+            with self.__condition:
+                state = self.__hosts.get(host)
+                if not self.__robots_due(state):
+                    return state
+            robots, expiry = self.__read_robots(parts.scheme, host) if self.__robots else (None, None)
+            rate, concurrency = self.__limits(robots)
+            with self.__condition:
+                if state is None:
+                    state = self.__hosts[host] = HostState(rate, concurrency, robots, expiry)
+                else:
+                    # the robots.txt could not be read before
+                    state.robots, state.robots_expiry = robots, expiry
+                    state.rate = state.max_rate = rate
+                    state.concurrency = state.max_concurrency = concurrency
+            return state
+
+    def allowed(self, url):
+        """
+        Checks if the robots.txt of the host allows reading a url.
+
+        :param url: a url
+
+        :type url: str
+
+        :rtype: bool
+        """
+        robots = self.__host(url).robots
+        return robots is None or robots.can_fetch(self.__user_agent, url)
+
+    def acquire(self, url):
+        """
+        Waits until a request to the host of a url can be sent.
+
+        :param url: a url
+
+        :type url: str
+        """
+        state = self.__host(url)
+        with self.__condition:
+            while True:
+                wait = state.wait_time(time.monotonic())
+                if wait == 0.0:
+                    state.tokens -= 1.0
+                    state.in_flight += 1
+                    return
+                self.__condition.wait(wait)
+
+    def release(self, url, status, latency, retry=None):
+        """
+        Tells that a request finished and adapts the limits of its host.
+
+        :param url: the url requested
+        :param status: the http status, 0 if the request failed
+        :param latency: seconds the request took
+        :param retry: the Retry-After header of the answer
+
+        :type url: str
+        :type status: int
+        :type latency: float
+        :type retry: str
+        """
+        state = self.__host(url)
+        with self.__condition:
+            state.in_flight -= 1
+            if status in SLOW_DOWN:
+                state.failures += 1
+                wait = retry_after(retry)
+                if wait is None:
+                    wait = 2.0 ** state.failures
+                state.backoff_until = time.monotonic() + min(wait, self.__max_backoff)
+                self.__decrease(state)
+            elif status == 0 or (state.base_latency and latency > state.base_latency * self.__latency_factor):
+                self.__decrease(state)
+            else:
+                state.failures = 0
+                # additive increase, one more request in flight after a whole window of answers
+                state.concurrency = min(state.max_concurrency, state.concurrency + 1.0 / state.concurrency)
+                state.rate = min(state.max_rate, state.rate + state.max_rate / 10.0)
+            if status and status not in SLOW_DOWN:
+                # the normal latency follows the fast answers and forgets old slow ones
+                if state.base_latency is None or latency < state.base_latency:
+                    state.base_latency = latency
+                else:
+                    state.base_latency += (latency - state.base_latency) * 0.01
+            self.__condition.notify_all()
+
+    @staticmethod
+    def __decrease(state):
+        """
+        Cuts in half the limits of a host.
+
+        :param state: the state of the host
+
+        :type state: HostState
+        """
+        state.concurrency = max(1.0, state.concurrency / 2.0)
+        state.rate = max(state.max_rate / 100.0, state.rate / 2.0)
+
+    def run(self, url, request):
+        """
+        Sends a request when the host allows it and learns from its answer.
+
+        :param url: the url requested
+        :param request: function without arguments that sends the request and
+        returns an answer with status and headers
+
+        :type url: str
+        :type request: callable
+
+        :return: the answer of the request
+        """
+        self.acquire(url)
+        start = time.monotonic()
+        status, retry = 0, None
+        try:
+            answer = request()
+            status, retry = answer.status, answer.headers.get('Retry-After')
+            return answer
+        finally:
+            self.release(url, status, time.monotonic() - start, retry)
+
+    def limits(self, url):
+        """
+        Gets the current limits of the host of a url.
+
+        :param url: a url
+
+        :type url: str
+
+        :return: a tuple with the requests per second and the requests in flight allowed
+
+        :rtype: tuple
+        """
+        state = self.__host(url)
+        with self.__condition:
+            return state.rate, int(state.concurrency)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class BloomFilter:
+    def __init__(self, memory=8 * 1024 * 1024, hashes=7):
+        """
+        BloomFilter is a set of strings with a fixed memory size.
+        It never says that a string added is absent, but it may say
+        that a string never added is present.
+
+        :param memory: size of the filter in bytes
+
+        :type memory: int
+
+        :param hashes: amount of bits set for each string
+
+        :type hashes: int
+        """
+        self.__bits = bytearray(memory)
+        self.__size = memory * 8
+        self.__hashes = hashes
+
+    def __positions(self, text):
+        """
+        Calculates the bits of a string using double hashing.
+
+        :param text: a string
+
+        :type text: str
+
+        :rtype: generator
+        """
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + index * second) % self.__size for index in range(self.__hashes))
+
+    def add(self, text):
+        """
+        Adds a string to the filter.
+
+        :param text: a string
+
+        :type text: str
+        """
+        for position in self.__positions(text):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, text):
+        return all(self.__bits[position >> 3] & (1 << (position & 7))
+                   for position in self.__positions(text))
+
+
+class SeenFilter:
+    def __init__(self, memory=8 * 1024 * 1024, recent=10000):
+        """
+        SeenFilter remembers the urls already saved in the database, so the
+        links repeated in every web page (menus, header and footer) are
+        rejected without going to the database.
+
+        An exact LRU keeps the recent urls seen at least twice. A bloom
+        filter, with a fixed memory size, tells if a url was seen before,
+        so a url found only once does not take the place of the repeated
+        ones in the LRU. The bloom filter alone never rejects a url, a url
+        that is only in it is checked by the database.
+
+        :param memory: size of the bloom filter in bytes
+
+        :type memory: int
+
+        :param recent: maximum of urls in the LRU
+
+        :type recent: int
+        """
+        self.__bloom = BloomFilter(memory)
+        self.__recent = OrderedDict()
+        self.__maximum = recent
+        self.__lock = threading.Lock()
+        # amount of urls rejected without a database round trip
+        self.hits = 0
+
+    @property
+    def capacity(self):
+        """
+        Maximum of urls in the LRU
+
+        :rtype: int
+        """
+        return self.__maximum
+
+    def __remember(self, url):
+        """
+        Puts a url at the end of the LRU removing the oldest one if it is full.
+
+        :param url: a url saved in the database
+
+        :type url: str
+        """
+        self.__recent[url] = None
+        self.__recent.move_to_end(url)
+        if len(self.__recent) > self.__maximum:
+            self.__recent.popitem(last=False)
+
+    def unknown(self, url_list):
+        """
+        Removes from a list the urls known as saved in the database.
+
+        :param url_list: list of urls
+
+        :type url_list: list
+
+        :return: the urls that must be checked by the database
+
+        :rtype: list
+        """
+        unknown = []
+        with self.__lock:
+            for url in url_list:
+                if url in self.__recent:
+                    self.__recent.move_to_end(url)
+                    self.hits += 1
+                else:
+                    unknown.append(url)
+        return unknown
+
+    def add(self, url_list):
+        """
+        Remembers urls saved in the database.
+
+        :param url_list: list of urls already in the database
+
+        :type url_list: list
+        """
+        with self.__lock:
+            for url in url_list:
+                if url in self.__recent:
+                    self.__recent.move_to_end(url)
+                elif url in self.__bloom:
+                    # seen before, so it is probably a repeated link
+                    self.__remember(url)
+                else:
+                    self.__bloom.add(url)
+
+    def load(self, url_list, recent_list):
+        """
+        Rebuilds the filter from the urls in the database.
+
+        :param url_list: all urls in the database
+
+        :type url_list: iterable
+
+        :param recent_list: urls that will start in the LRU
+
+        :type recent_list: iterable
+        """
+        with self.__lock:
+            for url in url_list:
+                self.__bloom.add(url)
+            for url in recent_list:
+                self.__remember(url)
+
+    def __len__(self):
+        return len(self.__recent)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import hashlib
+import itertools
+import os
+import socket
+import threading
+import time
+
+from metrics import METRICS
+from seenfilter import SeenFilter
+
+
+def shard_of(url, shards):
+    """
+    Gets the shard of a url. The same canonical url has the same shard in
+    every node and every run of the program.
+
+    :param url: a canonical url
+
+    :type url: str
+
+    :param shards: amount of shards
+
+    :type shards: int
+
+    :rtype: int
+    """
+    digest = hashlib.sha1(url.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+
+class SpoolTransport:
+    def __init__(self, directory):
+        """
+        SpoolTransport sends urls to the node of another shard through files
+        in a directory shared by all nodes, a local directory or a network
+        file system. Each shard has its own sub directory, a file is written
+        with a temporary name and renamed when it is complete, so a reader
+        never gets half a file.
+
+        :param directory: the directory shared by the nodes
+
+        :type directory: str
+        """
+        self.__directory = directory
+        self.__prefix = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.__counter = itertools.count()
+
+    def __shard_directory(self, shard):
+        """
+        Gets the directory of a shard, creating it the first time.
+
+        :param shard: a shard number
+
+        :type shard: int
+
+        :rtype: str
+        """
+        path = os.path.join(self.__directory, str(shard))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def send(self, shard, url_list):
+        """
+        Sends urls to the node of a shard.
+
+        :param shard: the shard of the urls
+
+        :type shard: int
+
+        :param url_list: list of urls
+
+        :type url_list: list
+        """
+        directory = self.__shard_directory(shard)
+        # the name starts with the time, so the files are read in the order they were sent
+        name = '{:020d}-{}-{}'.format(int(time.time() * 1000000), self.__prefix, next(self.__counter))
+        temporary = os.path.join(directory, name + '.tmp')
+        with open(temporary, 'w', encoding='utf-8') as spool_file:
+            spool_file.write('\n'.join(url_list))
+        os.replace(temporary, os.path.join(directory, name + '.urls'))
+
+    def receive(self, shard):
+        """
+        Gets the urls sent to a shard, removing its files.
+
+        :param shard: the shard number
+
+        :type shard: int
+
+        :return: list of urls
+
+        :rtype: list
+        """
+        directory = self.__shard_directory(shard)
+        url_list = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.urls'):
+                continue
+            path = os.path.join(directory, name)
+            reading = path + '.reading'
+            try:
+                # only one reader can rename a file
+                os.rename(path, reading)
+            except OSError:
+                continue
+            with open(reading, encoding='utf-8') as spool_file:
+                url_list.extend(line for line in spool_file.read().split('\n') if line)
+            os.remove(reading)
+        return url_list
+
+
+class ShardRouter:
+    def __init__(self, shard, shards, transport, batch=1000, interval=1.0, remembered=100000):
+        """
+        ShardRouter splits the urls found by this node between its own shard
+        and the shards of the other nodes. The urls of other shards are kept
+        in a batch for each shard and sent together when the batch is full or
+        when it is old. It can be used by many threads at the same time.
+
+        :param shard: the shard of this node, from 0 to shards - 1
+
+        :type shard: int
+
+        :param shards: amount of shards
+
+        :type shards: int
+
+        :param transport: sends and receives the urls of each shard
+
+        :type transport: SpoolTransport
+
+        :param batch: amount of urls sent together to a shard
+
+        :type batch: int
+
+        :param interval: maximum of seconds that a url waits to be sent
+
+        :type interval: float
+
+        :param remembered: maximum of urls already sent that are remembered,
+        so the links repeated in every web page are sent only once
+
+        :type remembered: int
+        """
+        if shards < 1 or not 0 <= shard < shards:
+            raise ValueError('the shard must be between 0 and {}'.format(shards - 1))
+        self.__shard = shard
+        self.__shards = shards
+        self.__transport = transport
+        self.__batch = batch
+        self.__interval = interval
+        self.__sent = SeenFilter(64 * 1024, remembered)
+        self.__pending = {}
+        self.__flushed = time.monotonic()
+        self.__received = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def shard(self):
+        """
+        Shard of this node
+
+        :rtype: int
+        """
+        return self.__shard
+
+    def owns(self, url):
+        """
+        Checks if a url belongs to the shard of this node.
+
+        :param url: a canonical url
+
+        :type url: str
+
+        :rtype: bool
+        """
+        return shard_of(url, self.__shards) == self.__shard
+
+    def split(self, url_list):
+        """
+        Keeps the urls of other shards to be sent to their nodes.
+
+        :param url_list: list of canonical urls
+
+        :type url_list: list
+
+        :return: the urls of the shard of this node
+
+        :rtype: list
+        """
+        own = []
+        with self.__lock:
+            for url in url_list:
+                shard = shard_of(url, self.__shards)
+                if shard == self.__shard:
+                    own.append(url)
+                else:
+                    self.__pending.setdefault(shard, []).append(url)
+            full = any(len(pending) >= self.__batch for pending in self.__pending.values())
+        if full or time.monotonic() - self.__flushed >= self.__interval:
+            self.flush()
+        return own
+
+    def flush(self):
+        """
+        Sends now every url kept for the other shards.
+        """
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+            self.__flushed = time.monotonic()
+        for shard, url_list in pending.items():
+            # the urls already sent are known by the node of their shard
+            url_list = self.__sent.unknown(list(dict.fromkeys(url_list)))
+            if not url_list:
+                continue
+            try:
+                self.__transport.send(shard, url_list)
+            except OSError as e:
+                # the urls are kept to be sent again
+                print('It was not possible send urls to the shard {}: {}'.format(shard, e))
+                with self.__lock:
+                    self.__pending.setdefault(shard, []).extend(url_list)
+                continue
+            # the urls sent go straight to the exact part of the filter
+            self.__sent.load((), url_list)
+            METRICS.count('urls_forwarded', len(url_list))
+
+    def receive(self):
+        """
+        Gets the urls that the other nodes found for the shard of this node.
+
+        :rtype: list
+        """
+        try:
+            url_list = self.__transport.receive(self.__shard)
+        except OSError as e:
+            print('It was not possible receive the urls of the shard {}: {}'.format(self.__shard, e))
+            return []
+        METRICS.count('urls_received', len(url_list))
+        return url_list
+
+    def poll(self):
+        """
+        Gets the urls sent to the shard of this node if the last look for
+        them is older than the interval, so the spool is not read for every
+        web page.
+
+        :return: list of urls, empty if it is not time to look for them
+
+        :rtype: list
+        """
+        with self.__lock:
+            now = time.monotonic()
+            if now - self.__received < self.__interval:
+                return []
+            self.__received = now
+        return self.receive()
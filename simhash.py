@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+# bits of a simhash
+BITS = 64
+
+
+def simhash(features):
+    """
+    Gets the SimHash of a set of features: each bit is the vote of the
+    same bit of the hash of every feature, so two sets with almost the
+    same features have hashes with almost the same bits.
+
+    :param features: strings that describe a web page, the repeated ones
+    are counted once
+
+    :type features: iterable
+
+    :return: the hash as a signed 64 bits integer, as it is saved by sqlite
+
+    :rtype: int
+    """
+    votes = [0] * BITS
+    for feature in set(features):
+        value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(BITS):
+            votes[bit] += 1 if value >> bit & 1 else -1
+    value = sum(1 << bit for bit in range(BITS) if votes[bit] > 0)
+    return value - (1 << BITS) if value >> (BITS - 1) else value
+
+
+def distance(first, second):
+    """
+    Gets the amount of different bits of two hashes.
+
+    :param first: a hash
+    :param second: another hash
+
+    :type first: int
+    :type second: int
+
+    :rtype: int
+    """
+    return bin((first ^ second) & ((1 << BITS) - 1)).count('1')
+
+
+class NearDuplicateIndex:
+    def __init__(self, capacity=10000, max_distance=6):
+        """
+        NearDuplicateIndex remembers the SimHashes of the last web pages
+        read and finds if a new one is almost equal to some of them.
+        The hashes are split in max_distance + 1 bands: two hashes with at
+        most max_distance different bits have at least one equal band, so
+        only the hashes with an equal band are compared. It can be used by
+        many threads at the same time.
+
+        :param capacity: maximum of hashes remembered, the oldest ones are
+        forgotten first
+
+        :type capacity: int
+
+        :param max_distance: maximum of different bits of two web pages
+        taken as near duplicates
+
+        :type max_distance: int
+        """
+        self.__capacity = capacity
+        self.__max_distance = max_distance
+        self.__width = BITS // (max_distance + 1)
+        self.__bands = [{} for _ in range(max_distance + 1)]
+        self.__hashes = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        """
+        Maximum of hashes remembered
+
+        :rtype: int
+        """
+        return self.__capacity
+
+    def __keys(self, value):
+        """
+        Gets the bands of a hash.
+
+        :param value: a hash
+
+        :type value: int
+
+        :rtype: list
+        """
+        mask = (1 << self.__width) - 1
+        return [value >> (index * self.__width) & mask for index in range(len(self.__bands))]
+
+    def __find(self, value):
+        """
+        Checks if a hash near to another one is remembered.
+
+        :param value: a hash
+
+        :type value: int
+
+        :rtype: bool
+        """
+        for band, key in zip(self.__bands, self.__keys(value)):
+            for other in band.get(key, ()):
+                if distance(value, other) <= self.__max_distance:
+                    return True
+        return False
+
+    def __add(self, value):
+        """
+        Remembers a hash, forgetting the oldest one if the index is full.
+
+        :param value: a hash
+
+        :type value: int
+        """
+        if value in self.__hashes:
+            self.__hashes.move_to_end(value)
+            return
+        self.__hashes[value] = None
+        for band, key in zip(self.__bands, self.__keys(value)):
+            band.setdefault(key, set()).add(value)
+        if len(self.__hashes) > self.__capacity:
+            oldest, _ = self.__hashes.popitem(last=False)
+            for band, key in zip(self.__bands, self.__keys(oldest)):
+                band[key].discard(oldest)
+                if not band[key]:
+                    del band[key]
+
+    def check(self, value):
+        """
+        Checks if a web page is a near duplicate of a web page read before
+        and remembers it.
+
+        :param value: the SimHash of the web page
+
+        :type value: int
+
+        :return: True if it is a near duplicate
+
+        :rtype: bool
+        """
+        with self.__lock:
+            duplicate = self.__find(value)
+            self.__add(value)
+        return duplicate
+
+    def load(self, values):
+        """
+        Remembers the hashes of the web pages read by a search before.
+
+        :param values: the hashes, the most recent last
+
+        :type values: iterable
+        """
+        with self.__lock:
+            for value in values:
+                self.__add(value)
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import atexit
+import csv
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+
+from metrics import METRICS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # parquet is optional, csv and json lines are always available
+    pyarrow = None
+
+
+# the columns of a product, in the order they are saved
+FIELDS = ['product_name', 'title', 'url']
+
+
+class CSVSink:
+    extension = '.csv'
+
+    def __init__(self, file_name):
+        """
+        CSVSink saves the products in a csv file separated by ';'.
+        A resumed search appends rows without a new header.
+
+        :param file_name: the csv file name
+
+        :type file_name: str
+        """
+        self.__file_name = file_name
+        self.__file = None
+        self.__writer = None
+
+    def read(self):
+        """
+        Reads the products already saved in the file.
+
+        :return: generator of dicts with the values of each product
+
+        :rtype: generator
+        """
+        if not os.path.exists(self.__file_name):
+            return
+        with open(self.__file_name, newline='', encoding='utf-8') as csv_file:
+            yield from csv.DictReader(csv_file, delimiter=';')
+
+    def write(self, rows):
+        """
+        Appends products to the file.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+        """
+        if self.__file is None:
+            self.__file = open(self.__file_name, 'a', newline='', encoding='utf-8')
+            self.__writer = csv.DictWriter(self.__file, fieldnames=FIELDS, delimiter=';')
+            if self.__file.tell() == 0:
+                self.__writer.writeheader()
+        self.__writer.writerows(rows)
+        self.__file.flush()
+
+    def rewrite(self, rows):
+        """
+        Replaces all the products of the closed file.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+        """
+        temporary = '{}.{}.tmp'.format(self.__file_name, os.getpid())
+        with open(temporary, 'w', newline='', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=FIELDS, delimiter=';')
+            writer.writeheader()
+            writer.writerows(rows)
+        # the old file is kept until the new one is complete
+        os.replace(temporary, self.__file_name)
+
+    def close(self):
+        """
+        Closes the file.
+        """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+
+class JSONLinesSink:
+    extension = '.jsonl.gz'
+
+    def __init__(self, file_name):
+        """
+        JSONLinesSink saves the products in a gzip file with one json object
+        in each line. Each block of products is appended as a whole gzip
+        member, so the file is always complete and can be read by any gzip
+        reader, even if the program stops in the middle of the search.
+
+        :param file_name: the file name
+
+        :type file_name: str
+        """
+        self.__file_name = file_name
+
+    def read(self):
+        """
+        Reads the products already saved in the file.
+
+        :return: generator of dicts with the values of each product
+
+        :rtype: generator
+        """
+        if not os.path.exists(self.__file_name):
+            return
+        try:
+            with gzip.open(self.__file_name, 'rt', encoding='utf-8') as json_file:
+                for line in json_file:
+                    if line.strip():
+                        yield json.loads(line)
+        except (EOFError, OSError, zlib.error, ValueError) as e:
+            # the products read before the error are kept
+            print('It was not possible read all the products of {}: {}'.format(self.__file_name, e))
+
+    def write(self, rows):
+        """
+        Appends products to the file as a new gzip member.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+        """
+        with open(self.__file_name, 'ab') as json_file:
+            json_file.write(gzip.compress(self.__text(rows)))
+
+    @staticmethod
+    def __text(rows):
+        """
+        Gets the json lines of products.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+
+        :rtype: bytes
+        """
+        return ''.join(json.dumps(row, ensure_ascii=False, sort_keys=True) + '\n' for row in rows).encode('utf-8')
+
+    def rewrite(self, rows):
+        """
+        Replaces all the products of the file by a single gzip member.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+        """
+        temporary = '{}.{}.tmp'.format(self.__file_name, os.getpid())
+        with open(temporary, 'wb') as json_file:
+            json_file.write(gzip.compress(self.__text(rows)))
+        # the old file is kept until the new one is complete
+        os.replace(temporary, self.__file_name)
+
+    def close(self):
+        """
+        Nothing is kept open between two writes.
+        """
+
+
+class ParquetSink:
+    extension = '.parquet'
+
+    def __init__(self, file_name, row_group=50000):
+        """
+        ParquetSink saves the products in a parquet file, in row groups of
+        many products. A parquet file can not be appended, so the products
+        of a resumed search are copied to a new file with the new ones, and
+        the new file replaces the old one when the sink is closed. So the
+        products are only in the parquet file after the sink is closed, the
+        rows written before are kept in memory or in the new file.
+
+        :param file_name: the parquet file name, it needs the pyarrow package
+
+        :type file_name: str
+
+        :param row_group: amount of products in each row group
+
+        :type row_group: int
+        """
+        if pyarrow is None:
+            raise ValueError('parquet output needs the pyarrow package')
+        self.__file_name = file_name
+        self.__row_group = row_group
+        self.__schema = pyarrow.schema([(field, pyarrow.string()) for field in FIELDS])
+        self.__rows = []
+        self.__writer = None
+        self.__temporary = '{}.{}.tmp'.format(file_name, os.getpid())
+
+    def read(self):
+        """
+        Reads the products already saved in the file.
+
+        :return: generator of dicts with the values of each product
+
+        :rtype: generator
+        """
+        if not os.path.exists(self.__file_name):
+            return
+        parquet_file = pyarrow.parquet.ParquetFile(self.__file_name)
+        for index in range(parquet_file.num_row_groups):
+            yield from parquet_file.read_row_group(index).to_pylist()
+
+    def __write_group(self, rows):
+        """
+        Writes a row group in the new file.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+        """
+        if self.__writer is None:
+            self.__writer = pyarrow.parquet.ParquetWriter(self.__temporary, self.__schema)
+            # the products of the last search are kept
+            if os.path.exists(self.__file_name):
+                parquet_file = pyarrow.parquet.ParquetFile(self.__file_name)
+                for index in range(parquet_file.num_row_groups):
+                    self.__writer.write_table(parquet_file.read_row_group(index))
+        table = pyarrow.Table.from_pydict({field: [row[field] for row in rows] for field in FIELDS},
+                                          schema=self.__schema)
+        self.__writer.write_table(table)
+
+    def write(self, rows):
+        """
+        Keeps products until there are enough for a row group.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+        """
+        self.__rows.extend(rows)
+        if len(self.__rows) >= self.__row_group:
+            self.__write_group(self.__rows)
+            self.__rows = []
+
+    def close(self):
+        """
+        Writes the last row group and replaces the old file with the new one.
+        """
+        if self.__rows:
+            self.__write_group(self.__rows)
+            self.__rows = []
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+            os.replace(self.__temporary, self.__file_name)
+
+    def rewrite(self, rows):
+        """
+        Replaces all the products of the closed file.
+
+        :param rows: list of dicts with the values of each product
+
+        :type rows: list
+        """
+        with pyarrow.parquet.ParquetWriter(self.__temporary, self.__schema) as writer:
+            for start in range(0, len(rows), self.__row_group):
+                group = rows[start:start + self.__row_group]
+                writer.write_table(pyarrow.Table.from_pydict({field: [row[field] for row in group]
+                                                              for field in FIELDS}, schema=self.__schema))
+        os.replace(self.__temporary, self.__file_name)
+
+
+# the output formats that can be used by ProductWriter
+SINKS = {'csv': CSVSink, 'jsonl': JSONLinesSink, 'parquet': ParquetSink}
+
+
+def last_values(rows):
+    """
+    Keeps a single row for each product url, with its last values, in the
+    order the products were first saved.
+
+    :param rows: iterable of dicts with the values of each product
+
+    :type rows: iterable
+
+    :rtype: list
+    """
+    products = {}
+    for row in rows:
+        # a repeated url replaces the values but keeps the position of the first row
+        products[row.get('url')] = row
+    return list(products.values())
+
+
+def fingerprint(row):
+    """
+    Gets a short hash of the values of a product.
+
+    :param row: dict with the values of a product
+
+    :type row: dict
+
+    :rtype: bytes
+    """
+    text = '\0'.join(str(row.get(field, '')) for field in FIELDS)
+    return hashlib.sha1(text.encode('utf-8')).digest()[:8]
+
+
+class ProductWriter:
+    def __init__(self, file_name, flush_rows=100, flush_interval=5.0, output='csv'):
+        """
+        ProductWriter keeps the output file open during the whole search and
+        writes the products in it in blocks of rows.
+        The rows in memory are written when there are flush_rows of them,
+        when the oldest one was kept for flush_interval seconds, even if no
+        other row arrives, and when the writer is closed, even at the
+        program exit. A parquet file is only complete after the writer is
+        closed, see ParquetSink.
+        A product is written once for each canonical url: a product found
+        again by another link or by a resumed search is skipped if its
+        values did not change. The new values of a changed product are
+        appended, and when the writer is closed the file is rewritten with
+        only the last values of each product, so a closed file has exactly
+        one row for each product.
+
+        :param file_name: file name where the products will be saved
+        :param flush_rows: amount of rows that forces a write in the file
+        :param flush_interval: seconds after which a new row forces a write in the file
+        :param output: the file format, 'csv', 'jsonl' or 'parquet'
+
+        :type file_name: str
+        :type flush_rows: int
+        :type flush_interval: float
+        :type output: str
+        """
+        if output not in SINKS:
+            raise ValueError('unknown output {}, use one of {}'.format(output, ', '.join(SINKS)))
+        self.__sink = SINKS[output](file_name)
+        self.__flush_rows = flush_rows
+        self.__flush_interval = flush_interval
+        self.__rows = []
+        self.__last_flush = time.monotonic()
+        # when the oldest row in memory arrived
+        self.__oldest = None
+        # the values written for each product url, so the repeated ones are skipped
+        self.__written = {}
+        # True if a product has more than one row in the file, so it is rewritten when closed
+        self.__changed = False
+        for row in self.__sink.read():
+            # the rows of a search that stopped before the file was rewritten
+            self.__changed = self.__changed or row.get('url') in self.__written
+            self.__written[row.get('url')] = fingerprint(row)
+        # many workers can save products at the same time
+        self.__lock = threading.RLock()
+        # the rows in memory are written even if the program exits without closing the writer
+        atexit.register(self.close)
+        self.__closed = threading.Event()
+        self.__thread = None
+        if flush_interval > 0:
+            # the last rows of a long search without new products are not kept only in memory
+            self.__thread = threading.Thread(target=self.__flush_periodically, daemon=True)
+            self.__thread.start()
+
+    def __flush_periodically(self):
+        """
+        Writes the rows kept in memory for flush_interval seconds, until the
+        writer is closed.
+        """
+        while True:
+            with self.__lock:
+                oldest = self.__oldest if self.__oldest is not None else time.monotonic()
+            if self.__closed.wait(max(0.0, oldest + self.__flush_interval - time.monotonic())):
+                return
+            with self.__lock:
+                if self.__oldest is not None and time.monotonic() - self.__oldest >= self.__flush_interval:
+                    self.flush()
+
+    def write(self, page_values):
+        """
+        Keeps the values of a product to be written in the file.
+
+        :param page_values: the values of a product
+
+        :type page_values: PageValues
+
+        :return: False if the product was already written with the same values
+
+        :rtype: bool
+        """
+        row = page_values.values
+        key = fingerprint(row)
+        with self.__lock:
+            if self.__written.get(row['url']) == key:
+                METRICS.count('products_repeated')
+                return False
+            self.__changed = self.__changed or row['url'] in self.__written
+            self.__written[row['url']] = key
+            self.__rows.append(row)
+            if self.__oldest is None:
+                self.__oldest = time.monotonic()
+            if (len(self.__rows) >= self.__flush_rows or
+                    time.monotonic() - self.__last_flush >= self.__flush_interval):
+                self.flush()
+        return True
+
+    def flush(self):
+        """
+        Writes the rows in memory in the file.
+        """
+        with self.__lock:
+            if self.__rows:
+                with METRICS.timer('csv_write'):
+                    self.__sink.write(self.__rows)
+                # the rows are forgotten only after being written, so an
+                # interruption in the middle of the write does not lose them
+                self.__rows = []
+                self.__oldest = None
+            self.__last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Writes the rows in memory and closes the file, stopping the thread
+        that writes them from time to time. If a product changed, the file
+        is rewritten with only the last values of each product.
+        """
+        self.__closed.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        with self.__lock:
+            self.flush()
+            self.__sink.close()
+            if self.__changed:
+                with METRICS.timer('csv_write'):
+                    self.__sink.rewrite(last_values(self.__sink.read()))
+                self.__changed = False
+        # a closed writer is not kept until the program exit
+        atexit.unregister(self.close)
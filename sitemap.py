@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# author: Thiago da Cunha Borges
+
+
+import gzip
+import io
+from urllib import parse
+from xml.etree.ElementTree import ParseError, iterparse
+
+
+# first bytes of a gzip file
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def local_name(tag):
+    """
+    Removes the namespace of a xml tag.
+
+    :param tag: a tag as '{namespace}name'
+
+    :type tag: str
+
+    :rtype: str
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def robots_sitemaps(content):
+    """
+    Finds the 'Sitemap:' lines of a robots.txt.
+
+    :param content: the robots.txt content
+
+    :type content: bytes
+
+    :return: list of sitemap urls
+
+    :rtype: list
+    """
+    sitemaps = []
+    for line in content.decode('utf-8', 'replace').splitlines():
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'sitemap' and value.strip():
+            sitemaps.append(value.strip())
+    return sitemaps
+
+
+def read_sitemap(stream):
+    """
+    Reads a sitemap or a sitemap index, compressed with gzip or not,
+    while it is received and without keeping its whole tree in memory.
+
+    :param stream: the sitemap file, as an answer of the server, or its content
+
+    :type stream: file object or bytes
+
+    :return: generator of tuples with True if the url is of another
+    sitemap and the url
+
+    :rtype: generator
+    """
+    if isinstance(stream, bytes):
+        stream = io.BytesIO(stream)
+    if not hasattr(stream, 'peek'):
+        # the first bytes are looked at without being taken from the stream
+        stream = io.BufferedReader(stream)
+    if stream.peek(len(GZIP_MAGIC))[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        # the file is decompressed while it is read
+        stream = gzip.GzipFile(fileobj=stream)
+    root = None
+    index = False
+    location = None
+    for event, element in iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+                index = local_name(element.tag) == 'sitemapindex'
+            continue
+        name = local_name(element.tag)
+        if name == 'loc':
+            location = (element.text or '').strip()
+        elif name in ('url', 'sitemap'):
+            if location:
+                yield index, location
+            location = None
+            # the urls already read are removed from the tree
+            root.clear()
+
+
+class SitemapSeeder:
+    def __init__(self, crawler, database, batch=10000, max_sitemaps=1000, products_only=False):
+        """
+        SitemapSeeder inserts in the database the urls listed in the
+        sitemaps of the web site, found in its robots.txt or in
+        '/sitemap.xml', so most products are found without opening the
+        category pages.
+
+        :param crawler: opens the sitemaps and gives the canonical urls
+        :param database: the database where the urls are inserted
+        :param batch: amount of urls inserted in each transaction
+        :param max_sitemaps: maximum of sitemap files read
+        :param products_only: if True, only the product urls are inserted
+
+        :type crawler: Crawler
+        :type database: URLDatabase
+        :type batch: int
+        :type max_sitemaps: int
+        :type products_only: bool
+        """
+        self.__crawler = crawler
+        self.__database = database
+        self.__batch = batch
+        self.__max_sitemaps = max_sitemaps
+        self.__products_only = products_only
+
+    def __open(self, url):
+        """
+        Downloads a file of the web site.
+
+        :param url: the file url
+
+        :type url: str
+
+        :return: the file content or None if it was not possible download it
+
+        :rtype: bytes
+        """
+        response = self.__crawler.fetch(url)
+        return response.content if response.status == 200 else None
+
+    def sitemaps(self):
+        """
+        Gets the sitemaps of the web site, from its robots.txt or the
+        default '/sitemap.xml'.
+
+        :rtype: list
+        """
+        main_url = self.__crawler.main_url
+        robots = self.__open(parse.urljoin(main_url, '/robots.txt'))
+        sitemaps = robots_sitemaps(robots) if robots else []
+        return sitemaps if sitemaps else [parse.urljoin(main_url, '/sitemap.xml')]
+
+    def seed(self):
+        """
+        Reads every sitemap of the web site and inserts its urls in the database.
+
+        :return: amount of urls of the web site found in the sitemaps
+
+        :rtype: int
+        """
+        pending = self.sitemaps()
+        read = set()
+        found = 0
+        batch = []
+        while pending and len(read) < self.__max_sitemaps:
+            sitemap_url = pending.pop(0)
+            if sitemap_url in read:
+                continue
+            read.add(sitemap_url)
+            answer = self.__crawler.open(sitemap_url)
+            if answer is None:
+                continue
+            try:
+                for index, url in read_sitemap(answer):
+                    if index:
+                        pending.append(url)
+                        continue
+                    url = self.__crawler.canonical(url)
+                    if url and (not self.__products_only or self.__database.is_product(url)):
+                        batch.append(url)
+                    if len(batch) >= self.__batch:
+                        found += len(batch)
+                        self.__database.insert_url_list(batch)
+                        batch = []
+            except (ParseError, EOFError, OSError) as e:
+                # the urls read before the error are kept
+                print('It was not possible read the sitemap {}: {}'.format(sitemap_url, e))
+            finally:
+                answer.close()
+        found += len(batch)
+        self.__database.insert_url_list(batch)
+        return found